@@ -0,0 +1,275 @@
+"""Akkumuleringsindeks per kumulesone og scenario.
+
+Holder antall, sum SI og sum EML (alle og inkluderte) per (kumulesone, scenario)
+og per kumulesone. Indeksen bygges én gang og oppdateres deretter inkrementelt
+for de nøklene som endres, slik at ekspander-overskrifter og ``st.metric``-
+totaler blir O(1)-oppslag. ``verify`` sammenligner mot en full omberegning.
+
+Indeksen holder også topplisten over hele porteføljen (``leaderboard``): de
+kumulesone × scenario-cellene med høyest EML for inkluderte og de største
+enkeltrisikoene i hver. Rangeringen ligger i hauger med lat sletting (``TopN``)
+som oppdateres for nøklene som endres; topplisten (``BOARD_SIZE`` plasser)
+regnes ut av den som skriver.
+
+Indeksen er ikke trådsikker: ``SharedDatabase`` oppdaterer den under sin lås
+(også fra importjobbens tråd), og lesere må holde den samme låsen.
+Oppslagene gir kopier, slik at resultatet kan brukes etter at låsen er sluppet.
+"""
+import heapq
+import math
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from eml_engine import BATCH_FIELDS, FIELD_DEFAULTS, calc_eml_batch, calc_eml_records
+
+FIELDS = ("n", "si", "eml", "n_inc", "si_inc", "eml_inc", "n_manual", "n_manual_inc")
+# Plasser i topplisten (celler, og risikoer per celle) som holdes ferdig utregnet
+BOARD_SIZE = 25
+
+
+def _empty() -> Dict[str, float]:
+    return {f: 0 for f in FIELDS}
+
+
+def _si(rec: Dict[str, Any]) -> float:
+    return _si_value(rec.get("sum_forsikring", 0))
+
+
+def _si_value(v: Any) -> float:
+    try:
+        return float(v or 0)
+    except Exception:
+        return 0.0
+
+
+class TopN:
+    """De største verdiene i en hauge med lat sletting.
+
+    ``set`` legger inn ny verdi (gamle oppføringer blir liggende og hoppes over),
+    ``top`` plukker de ``n`` største og legger dem tilbake. Haugen bygges på nytt
+    når den har mer enn dobbelt så mange oppføringer som levende verdier.
+    Ikke trådsikker: brukes bare av den som skriver.
+    """
+
+    def __init__(self, items: Iterable[Tuple[Hashable, float]] = ()):
+        self._value: Dict[Hashable, float] = dict(items)
+        self._heap = [(-v, item) for item, v in self._value.items()]
+        heapq.heapify(self._heap)
+
+    def __len__(self) -> int:
+        return len(self._value)
+
+    def set(self, item: Hashable, value: Optional[float]) -> None:
+        """Ny verdi for ``item`` (``None`` = fjern)."""
+        if value is None:
+            self._value.pop(item, None)
+        elif self._value.get(item) != value:
+            self._value[item] = value
+            heapq.heappush(self._heap, (-value, item))
+        if len(self._heap) > 2 * len(self._value) + 32:
+            self._heap = [(-v, i) for i, v in self._value.items()]
+            heapq.heapify(self._heap)
+
+    def top(self, n: int) -> List[Tuple[Hashable, float]]:
+        """(item, verdi) for de ``n`` største, synkende (likt: stigende item)."""
+        out: List[Tuple[Hashable, float]] = []
+        seen = set()
+        while self._heap and len(out) < n:
+            neg, item = heapq.heappop(self._heap)
+            if item in seen or self._value.get(item) != -neg:
+                continue
+            seen.add(item)
+            out.append((item, -neg))
+        for item, v in out:
+            heapq.heappush(self._heap, (-v, item))
+        return out
+
+
+class AccumulationIndex:
+    def __init__(self, default_scenario: str):
+        self.default_scenario = default_scenario
+        # nøkkel -> (kumulesone, scenario, si, eml, include, manuell)
+        self._contrib: Dict[str, Tuple[str, str, float, int, bool, bool]] = {}
+        self._cells: Dict[Tuple[str, str], Dict[str, float]] = {}
+        self._zones: Dict[str, Dict[str, float]] = {}
+        # Rangering: celle -> EML inkl., og per celle nøkkel -> EML for inkluderte risikoer
+        self._top_cells = TopN()
+        self._top_risks: Dict[Tuple[str, str], TopN] = {}
+        self._board: List[Dict[str, Any]] = []
+        # Celler endret siden topplisten sist ble laget (risikolisten deres må hentes på nytt)
+        self._dirty: set = set()
+
+    @classmethod
+    def build(cls, db: Dict[str, Any], default_scenario: str) -> "AccumulationIndex":
+        idx = cls(default_scenario)
+        if hasattr(db, "frame"):
+            idx._add_columns(db)
+        else:
+            idx.update_many(db, db.keys())
+        return idx
+
+    def _add_columns(self, db) -> None:
+        """Bygg fra et kolonnelager (``ColumnarRecords.frame``) uten å materialisere risikoene."""
+        fields = ["kumulesone", "scenario", "include", *BATCH_FIELDS]
+        f = db.frame(fields, defaults={**FIELD_DEFAULTS, "kumulesone": "", "scenario": self.default_scenario,
+                                       "include": False})
+        eml = calc_eml_batch(f)["eml"].tolist()
+        for k, zone, scen, si, e, inc, manual in zip(
+            f["_key"].tolist(), f["kumulesone"].tolist(), f["scenario"].tolist(),
+            f["sum_forsikring"].tolist(), eml, f["include"].tolist(), f["eml_rate_manual_on"].tolist(),
+        ):
+            c = (str(zone), str(scen), _si_value(si), e, bool(inc), bool(manual))
+            self._contrib[k] = c
+            self._apply(c, +1)
+        self._rank_all()
+
+    # ---------- vedlikehold ----------
+    def _apply(self, c: Tuple[str, str, float, int, bool, bool], sign: int) -> None:
+        zone, scen, si, eml, inc, manual = c
+        for agg in (self._cells.setdefault((zone, scen), _empty()), self._zones.setdefault(zone, _empty())):
+            agg["n"] += sign
+            agg["si"] += sign * si
+            agg["eml"] += sign * eml
+            agg["n_manual"] += sign * manual
+            if inc:
+                agg["n_inc"] += sign
+                agg["si_inc"] += sign * si
+                agg["eml_inc"] += sign * eml
+                agg["n_manual_inc"] += sign * manual
+        if sign < 0:
+            # Fjern tomme celler så listene over soner holder seg ryddige
+            if self._cells[(zone, scen)]["n"] == 0:
+                del self._cells[(zone, scen)]
+            if self._zones[zone]["n"] == 0:
+                del self._zones[zone]
+
+    def _rank(self, key: str, c: Tuple[str, str, float, int, bool, bool], sign: int) -> None:
+        """Oppdater rangeringen etter at ``c`` er lagt til (+1) eller trukket fra (-1)."""
+        zone, scen, _, eml, inc, _ = c
+        cell = self._cells.get((zone, scen))
+        self._top_cells.set((zone, scen), cell["eml_inc"] if cell and cell["n_inc"] else None)
+        if not inc:
+            return
+        self._dirty.add((zone, scen))
+        top = self._top_risks.get((zone, scen))
+        if sign > 0:
+            if top is None:
+                top = self._top_risks[(zone, scen)] = TopN()
+            top.set(key, eml)
+        elif top is not None:
+            top.set(key, None)
+            if not len(top):
+                del self._top_risks[(zone, scen)]
+
+    def _rank_all(self) -> None:
+        self._top_cells = TopN((cell, agg["eml_inc"]) for cell, agg in self._cells.items() if agg["n_inc"])
+        by_cell: Dict[Tuple[str, str], List[Tuple[str, int]]] = {}
+        for k, (zone, scen, _, eml, inc, _) in self._contrib.items():
+            if inc:
+                by_cell.setdefault((zone, scen), []).append((k, eml))
+        self._top_risks = {cell: TopN(items) for cell, items in by_cell.items()}
+        self._board = []
+        self._board = self._make_board()
+
+    def _make_board(self) -> List[Dict[str, Any]]:
+        # Risikolistene til celler som ikke er endret, gjenbrukes fra forrige toppliste
+        prev = {(c["kumulesone"], c["scenario"]): c["risks"] for c in self._board}
+        board = []
+        for (zone, scen), eml in self._top_cells.top(BOARD_SIZE):
+            agg = self._cells[(zone, scen)]
+            risks = prev.get((zone, scen)) if (zone, scen) not in self._dirty else None
+            if risks is None:
+                top = self._top_risks.get((zone, scen))
+                risks = [(k, e, self._contrib[k][2]) for k, e in (top.top(BOARD_SIZE) if top else [])]
+            board.append({"kumulesone": zone, "scenario": scen, "eml_inc": eml, "si_inc": agg["si_inc"],
+                          "n_inc": agg["n_inc"], "n_manual_inc": agg["n_manual_inc"], "risks": risks})
+        self._dirty.clear()
+        return board
+
+    def _remove(self, key: str) -> None:
+        old = self._contrib.pop(key, None)
+        if old is not None:
+            self._apply(old, -1)
+            self._rank(key, old, -1)
+
+    def remove(self, key: str) -> None:
+        self._remove(key)
+        self._board = self._make_board()
+
+    def update_many(self, db: Dict[str, Any], keys: Iterable[str]) -> None:
+        """Oppdater bidraget til ``keys`` ut fra nåværende ``db`` (slettede/ikke-dict fjernes)."""
+        recs: List[Tuple[str, Dict[str, Any]]] = []
+        for k in keys:
+            self._remove(k)
+            r = db.get(k)
+            if isinstance(r, dict):
+                recs.append((k, r))
+        eml = calc_eml_records(r for _, r in recs)["eml"].tolist() if recs else []
+        for (k, r), e in zip(recs, eml):
+            c = (
+                str(r.get("kumulesone", "")),
+                str(r.get("scenario", self.default_scenario)),
+                _si(r),
+                e,
+                bool(r.get("include", False)),
+                bool(r.get("eml_rate_manual_on", False)),
+            )
+            self._contrib[k] = c
+            self._apply(c, +1)
+            self._rank(k, c, +1)
+        self._board = self._make_board()
+
+    def rebuild(self, db: Dict[str, Any]) -> None:
+        self._contrib.clear()
+        self._cells.clear()
+        self._zones.clear()
+        self._top_cells = TopN()
+        self._top_risks.clear()
+        self._board = []
+        self.update_many(db, db.keys())
+
+    # ---------- oppslag ----------
+    def cell(self, zone: str, scenario: str) -> Dict[str, float]:
+        return dict(self._cells.get((zone, scenario)) or _empty())
+
+    def zone(self, zone: str) -> Dict[str, float]:
+        return dict(self._zones.get(zone) or _empty())
+
+    def cells(self) -> Dict[Tuple[str, str], Dict[str, float]]:
+        return {cell: dict(agg) for cell, agg in self._cells.items()}
+
+    def zones(self) -> List[str]:
+        return sorted(self._zones)
+
+    def leaderboard(self, n: int = 10) -> List[Dict[str, Any]]:
+        """De ``n`` cellene med høyest EML for inkluderte, hver med sine ``n`` største risikoer.
+
+        Per celle: ``kumulesone``, ``scenario``, ``eml_inc``, ``si_inc``, ``n_inc``,
+        ``n_manual_inc`` og ``risks`` = [(nøkkel, EML, SI)]. Høyst ``BOARD_SIZE``.
+        """
+        return [{**c, "risks": c["risks"][:n]} for c in self._board[:n]]
+
+    def contribution(self, key: str) -> Optional[Tuple[str, str, float, int, bool, bool]]:
+        return self._contrib.get(key)
+
+    def __len__(self) -> int:
+        return len(self._contrib)
+
+    # ---------- kontroll ----------
+    def verify(self, db: Dict[str, Any]) -> List[str]:
+        """Full omberegning; returnerer avvik (tom liste = inkrementelle verdier stemmer)."""
+        fresh = AccumulationIndex.build(db, self.default_scenario)
+        problems = []
+        for name, mine, theirs in (("celle", self._cells, fresh._cells), ("sone", self._zones, fresh._zones)):
+            for k in set(mine) | set(theirs):
+                a, b = mine.get(k) or _empty(), theirs.get(k) or _empty()
+                for f in FIELDS:
+                    if not math.isclose(a[f], b[f], rel_tol=1e-9, abs_tol=1e-6):
+                        problems.append(f"{name} {k}: {f} = {a[f]} (inkrementell) ≠ {b[f]} (omberegnet)")
+        for i, (mine, theirs) in enumerate(zip(self._board, fresh._board), start=1):
+            a = (mine["kumulesone"], mine["scenario"], mine["eml_inc"], [r[:2] for r in mine["risks"]])
+            b = (theirs["kumulesone"], theirs["scenario"], theirs["eml_inc"], [r[:2] for r in theirs["risks"]])
+            if a != b:
+                problems.append(f"toppliste plass {i}: {a[:3]} (inkrementell) ≠ {b[:3]} (omberegnet)")
+        if len(self._board) != len(fresh._board):
+            problems.append(f"toppliste: {len(self._board)} plasser (inkrementell) ≠ {len(fresh._board)} (omberegnet)")
+        return problems
@@ -0,0 +1,248 @@
+"""Benchmark av appens tunge kodeveier på syntetiske porteføljer.
+
+Måler de samme funksjonene som appen kaller: lasting og lagring via
+``storage``/``sqlite_store``, Excel-importen, tabellen og sonetotalene i
+📚 Database-fanen, tekstfiltrene og utvalg/totaler i 📈 EML-scenario-fanen.
+
+Resultatene legges til som JSON-linjer (én per måling) med git-revisjon og
+tidsstempel, slik at kjøringer på ulike versjoner kan sammenlignes:
+
+    python bench_eml.py --sizes 1000 10000 100000 --out bench_results.jsonl
+    python bench_eml.py --sizes 100000 --baseline forrige.jsonl
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from accumulation import AccumulationIndex
+from columnar import ColumnarRecords
+from db_views import build_db_frame, zone_headers, zone_items
+from eml_engine import SCENARIOS, calc_eml_records
+from search_index import SearchIndex
+from serialization import available_export_formats, export_bytes, import_bytes
+from storage import JournalStore
+from synthetic_portfolio import generate_portfolio, write_portfolio_xlsx
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+
+
+def _git_rev() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def timed(fn: Callable[[], Any], repeat: int, setup: Optional[Callable[[], Any]] = None) -> List[float]:
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def run_size(n: int, repeat: int, excel_max: int, workdir: str, seed: int) -> List[Dict[str, Any]]:
+    results: List[Dict[str, Any]] = []
+
+    def record(case: str, times: List[float], items: int, **extra):
+        results.append({
+            "case": case, "n": n, "items": items, "repeat": len(times),
+            "min_s": min(times), "median_s": statistics.median(times),
+            "us_per_item": min(times) / max(items, 1) * 1e6, **extra,
+        })
+        print(f"  {case:<24} {min(times) * 1e3:10.1f} ms", file=sys.stderr)
+
+    db = generate_portfolio(n, seed=seed)
+    n_recs = sum(isinstance(r, dict) for r in db.values())
+    default = SCENARIOS[0]
+
+    # ---------- lasting/lagring (JSON + journal) ----------
+    path = os.path.join(workdir, f"db_{n}.json")
+    store = JournalStore(path)
+    record("save_snapshot", timed(lambda: store.write_snapshot(db), repeat), n_recs,
+           bytes=os.path.getsize(path) if os.path.exists(path) else None)
+    record("load_json", timed(lambda: JournalStore(path).load(), repeat), n_recs, bytes=os.path.getsize(path))
+    for fmt in available_export_formats():
+        raw = export_bytes(db, fmt)
+        record(f"export_{fmt}", timed(lambda: export_bytes(db, fmt), repeat), n_recs, bytes=len(raw))
+        record(f"import_{fmt}", timed(lambda: import_bytes(raw), repeat), n_recs)
+
+    # ---------- tabeller og indekser ----------
+    record("db_frame_build", timed(lambda: build_db_frame(db, default), repeat), n_recs)
+    df = build_db_frame(db, default)
+    record("acc_build", timed(lambda: AccumulationIndex.build(db, default), repeat), n_recs)
+    acc = AccumulationIndex.build(db, default)
+
+    # ---------- kolonnelager (det appen holder i minnet) ----------
+    record("columnar_build", timed(lambda: ColumnarRecords.from_mapping(db), repeat), n_recs)
+    cdb = ColumnarRecords.from_mapping(db)
+    # Binær kolonnefil: skriving, og åpning (minnekartlegging) i stedet for JSON + kolonnebygging
+    import column_file
+
+    col_path = path + ".kolonner"
+    stamp = store.stamp()
+    record("column_file_write", timed(lambda: column_file.write(cdb, col_path, stamp), repeat), n_recs)
+    record("column_file_open", timed(lambda: column_file.open_current(store, col_path), repeat), n_recs,
+           bytes=os.path.getsize(col_path))
+    record("columnar_frame_build", timed(lambda: build_db_frame(cdb, default), repeat), n_recs,
+           bytes=cdb.memory_bytes())
+    record("columnar_acc_build", timed(lambda: AccumulationIndex.build(cdb, default), repeat), n_recs)
+    record("groupby_totals", timed(lambda: zone_headers(df, acc), repeat), n_recs)
+    # Topplisten: oppslag ved visning og inkrementell oppdatering når én risiko endres
+    record("leaderboard_read", timed(lambda: acc.leaderboard(10), repeat), 1)
+    one = acc.leaderboard(1)[0]["risks"][0][0]
+    record("leaderboard_update_1", timed(lambda: acc.update_many(db, [one]), repeat), 1)
+    record("search_build", timed(lambda: SearchIndex.build(db), repeat), n_recs)
+    search = SearchIndex.build(db)
+    record("filter_search", timed(lambda: search.filter(kunde="hansen", adresse="gata 1"), repeat), n_recs)
+    record("filter_str_contains", timed(lambda: df[
+        df["Kunde"].str.contains("hansen", case=False, na=False)
+        & df["Adresse"].str.contains("gata 1", case=False, na=False)], repeat), n_recs)
+
+    # ---------- scenario-fanen (største kumulesone) ----------
+    largest = df["Kumulesone"].value_counts().index[0]
+    items = zone_items(db, largest, default, default)
+    record("scenario_filter", timed(lambda: zone_items(db, largest, default, default), repeat), n_recs)
+    record("scenario_eml", timed(lambda: calc_eml_records(r for _, r in items), repeat), len(items))
+    record("scenario_totals", timed(lambda: acc.cell(largest, default), repeat), 1)
+
+    # ---------- what-if (alle kumulesoner × scenarioer) ----------
+    from whatif import WhatIfMatrix, base_sweep
+
+    record("whatif_build", timed(lambda: WhatIfMatrix(cdb, default), repeat), n_recs)
+    sets = base_sweep(0.4, 0.8, 20)
+    # Ny matrise per måling, så sveipet ikke treffer cachen
+    cur: Dict[str, WhatIfMatrix] = {}
+    record("whatif_sweep20", timed(lambda: cur["w"].sweep(sets), repeat,
+                                   setup=lambda: cur.update(w=WhatIfMatrix(cdb, default))), n_recs * len(sets))
+
+    # ---------- romlig indeks og verste sirkel ----------
+    from spatial_index import SpatialIndex
+
+    record("spatial_build", timed(lambda: SpatialIndex(cdb, default), repeat), n_recs)
+    for radius in (200, 1000):
+        # Ny indeks per måling, så søket ikke treffer resultatcachen
+        cur_geo: Dict[str, SpatialIndex] = {}
+        record(f"worst_circle_{radius}m", timed(lambda: cur_geo["s"].worst_circle(radius), repeat,
+                                                setup=lambda: cur_geo.update(s=SpatialIndex(cdb, default))), n_recs)
+
+    # ---------- halerisiko (Monte Carlo) for største kumulesone ----------
+    from monte_carlo import DEFAULT_EVENTS, simulate_zone
+
+    rates = calc_eml_records(r for _, r in items)["rate_effective"]
+    si = [float(r.get("sum_forsikring", 0) or 0) for _, r in items]
+    record("mc_zone_10k", timed(lambda: simulate_zone(si, rates, largest, default), repeat),
+           len(items) * DEFAULT_EVENTS)
+
+    # ---------- versjoner: første versjon, ny versjon etter 0,1 % endringer og diff ----------
+    from snapshots import SnapshotStore
+
+    snaps = SnapshotStore(os.path.join(workdir, f"versjoner_{n}"))
+    record("snapshot_first", timed(lambda: snaps.snapshot(db), 1), n_recs, bytes=snaps.storage()["bytes"])
+    first = snaps.latest()
+    churn = {k: {**db[k], "sum_forsikring": 1.0} for k in df["_key"].tolist()[::1000]}
+    churned = {**db, **churn}
+    record("snapshot_churn", timed(lambda: snaps.snapshot(churned), repeat), n_recs,
+           bytes=snaps.get(snaps.latest())["new_bytes"])
+    record("snapshot_diff", timed(lambda: snaps.diff(first, snaps.latest()), repeat), len(churn))
+
+    # ---------- Excel-rapport (sammendrag + ett ark per kumulesone) ----------
+    from excel_report import write_report
+
+    xlsx_path = os.path.join(workdir, f"rapport_{n}.xlsx")
+    record("excel_report", timed(lambda: write_report(cdb, xlsx_path, default, cells=acc.cells()), repeat),
+           int(df["Inkluder"].sum()), bytes=os.path.getsize(xlsx_path) if os.path.exists(xlsx_path) else None)
+
+    # ---------- bulk-lagring av én kumulesone ("Velg ALLE i kumule") ----------
+    zone_keys = df.loc[df["Kumulesone"] == largest, "_key"].tolist()
+    record("save_journal_zone", timed(lambda: store.append({k: db[k] for k in zone_keys}), repeat), len(zone_keys))
+
+    from sqlite_store import SqliteStore
+
+    sq_path = os.path.join(workdir, f"db_{n}.sqlite")
+    sq = SqliteStore(sq_path, default_scenario=default)
+    record("sqlite_write_all", timed(lambda: sq.write_snapshot(db), 1), n_recs)
+    record("sqlite_load", timed(sq.load, repeat), n_recs)
+    record("sqlite_zone_query", timed(lambda: sq.records_in(largest, default, True), repeat), n_recs)
+    record("save_sqlite_zone", timed(lambda: sq.append({k: db[k] for k in zone_keys}), repeat), len(zone_keys))
+    sq.close()
+
+    # ---------- Excel-import ----------
+    if n <= excel_max:
+        from excel_import import import_excel
+
+        xlsx = os.path.join(workdir, f"uttrekk_{n}.xlsx")
+        write_portfolio_xlsx(xlsx, db)
+
+        def run_import():
+            with open(xlsx, "rb") as f:
+                import_excel(f, {}, default_scenario=default)
+
+        record("excel_import", timed(run_import, 1), n_recs)
+    return results
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str) -> None:
+    """Skriv forholdet mot siste måling av samme (case, n) i en tidligere resultatfil."""
+    base: Dict[tuple, Dict[str, Any]] = {}
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                r = json.loads(line)
+                base[(r["case"], r["n"])] = r
+    print(f"\n{'case':<24} {'n':>9} {'før ms':>10} {'nå ms':>10} {'faktor':>8}")
+    for r in results:
+        b = base.get((r["case"], r["n"]))
+        if b is None:
+            continue
+        ratio = r["min_s"] / b["min_s"] if b["min_s"] else float("inf")
+        flag = "  ⚠" if ratio > 1.2 else ""
+        print(f"{r['case']:<24} {r['n']:>9} {b['min_s'] * 1e3:>10.1f} {r['min_s'] * 1e3:>10.1f} {ratio:>8.2f}{flag}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Benchmark av EML-appens kodeveier på syntetiske porteføljer.")
+    ap.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Antall risikoer (1k–1M)")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--excel-max", type=int, default=100_000, help="Største størrelse som også Excel-importeres")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", default="bench_results.jsonl", help="Resultatfil (JSON-linjer, legges til)")
+    ap.add_argument("--baseline", help="Tidligere resultatfil å sammenligne mot")
+    args = ap.parse_args(argv)
+
+    meta = {
+        "ts": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "git": _git_rev(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+    all_results: List[Dict[str, Any]] = []
+    with tempfile.TemporaryDirectory(prefix="eml_bench_") as workdir:
+        for n in args.sizes:
+            print(f"n = {n:,}".replace(",", " "), file=sys.stderr)
+            all_results.extend(run_size(n, args.repeat, args.excel_max, workdir, args.seed))
+
+    with open(args.out, "a", encoding="utf-8") as f:
+        for r in all_results:
+            f.write(json.dumps({**meta, **r}, ensure_ascii=False) + "\n")
+    print(f"{len(all_results)} målinger lagt til i {args.out}", file=sys.stderr)
+    if args.baseline:
+        compare(all_results, args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
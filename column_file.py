@@ -0,0 +1,104 @@
+"""Binær kolonnefil ved siden av JSON-databasen, for rask oppstart.
+
+Filen (``risiko_db.json.kolonner``) er kolonnene fra ``ColumnarRecords``
+skrevet rett ut: en kort JSON-header (nøkler, kategoriverdier, layoutene, ``extras``,
+``meta``, kolonnenes plassering og stempelet fra ``JournalStore.stamp``)
+etterfulgt av NumPy-bufferne, hver på en 64-byte-grense. ``read`` minnekartlegger
+filen og lager kolonnene med ``np.frombuffer`` uten å kopiere eller tolke dem;
+sidene leses inn av operativsystemet når de brukes.
+
+Filen er bare en hurtigbuffer: JSON-snapshotet og journalen er fortsatt
+sannheten. Stemmer ikke stempelet med filene på disk (snapshotet er byttet ut
+og har annet innhold, eller journalen er skrevet om), lastes JSON som før og
+kolonnefilen skrives på nytt. Journalposter som er skrevet etter kolonnefilen,
+legges oppå ved åpning.
+"""
+import mmap
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+from columnar import ColumnarRecords
+from serialization import dumps, loads
+from storage import _replay, atomic_write_bytes
+
+MAGIC = b"EMLKOL01"
+FORMAT_VERSION = 2
+ALIGN = 64
+# Så mange journalposter oppå kolonnefilen før den skrives på nytt ved oppstart
+REWRITE_ENTRIES = 20_000
+
+
+def _pad(n: int) -> int:
+    return -n % ALIGN
+
+
+def write(db: ColumnarRecords, path: str, stamp: Dict[str, Any]) -> int:
+    """Skriv kolonnefilen atomisk. Returnerer antall bytes."""
+    cols = db.export_columns()
+    layout: Dict[str, list] = {}
+    buffers = []
+    offset = 0
+    for f, arr in cols["cols"].items():
+        raw = np.ascontiguousarray(arr).tobytes()
+        layout[f] = [arr.dtype.str, offset, len(raw)]
+        buffers.append(raw + b"\0" * _pad(len(raw)))
+        offset += len(raw) + _pad(len(raw))
+    header = dumps({
+        "version": FORMAT_VERSION, "stamp": stamp, "n": len(cols["keys"]), "columns": layout,
+        "keys": cols["keys"], "cats": cols["cats"], "layouts": cols["layouts"], "extras": [[r, e] for r, e in cols["extras"].items()],
+        "meta": cols["meta"],
+    })
+    head = MAGIC + len(header).to_bytes(8, "little") + header
+    head += b"\0" * _pad(len(head))
+    data = b"".join([head, *buffers])
+    atomic_write_bytes(path, data)
+    return len(data)
+
+
+def read(path: str) -> Optional[Tuple[ColumnarRecords, Dict[str, Any]]]:
+    """(database, stempel) fra kolonnefilen, eller ``None`` hvis den mangler eller er ugyldig."""
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            size = int.from_bytes(f.read(8), "little")
+            header = loads(f.read(size))
+            if header.get("version") != FORMAT_VERSION:
+                return None
+            start = len(MAGIC) + 8 + size
+            start += _pad(start)
+            # Kartet lever videre så lenge noen kolonne peker inn i det
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    n = header["n"]
+    cols = {}
+    for f, (dtype, offset, nbytes) in header["columns"].items():
+        dt = np.dtype(dtype)
+        if nbytes != n * dt.itemsize or start + offset + nbytes > len(mm):
+            return None
+        cols[f] = np.frombuffer(mm, dtype=dt, count=n, offset=start + offset)
+    extras = {int(r): e for r, e in header["extras"]}
+    db = ColumnarRecords.from_columns(cols, header["cats"], header["keys"], extras, header["meta"],
+                                      header["layouts"])
+    return db, header["stamp"]
+
+
+def open_current(store, path: str) -> Optional[Tuple[ColumnarRecords, int]]:
+    """Databasen fra kolonnefilen + journalposter skrevet etter den (antall), eller ``None``
+    hvis filen mangler eller er utdatert. Med mange poster oppå skrives filen på nytt."""
+    opened = read(path)
+    if opened is None:
+        return None
+    db, stamp = opened
+    since = store.journal_since(stamp)
+    if since is None:
+        return None
+    entries, new_stamp = since
+    _replay(db, entries)
+    if len(entries) > REWRITE_ENTRIES:
+        db = db.compacted()
+        write(db, path, new_stamp)
+    return db, len(entries)
+
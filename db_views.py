@@ -0,0 +1,110 @@
+"""Tabeller og utvalg som fanene i appen bygger fra databasen.
+
+Ligger utenfor Streamlit-skriptet slik at benchmark og batch-verktøy kan
+kjøre nøyaktig samme kode.
+"""
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from eml_engine import BATCH_FIELDS, FIELD_DEFAULTS, calc_eml_batch, calc_eml_records
+
+DB_FRAME_COLUMNS = ["_key", "Kumulesone", "Forsnr", "Risikonr", "Kunde", "Adresse", "Sum forsikring",
+                    "EML (effektiv)", "Kilde", "Inkluder", "Scenario"]
+
+
+def build_db_frame(db: Dict[str, Any], default_scenario: str) -> pd.DataFrame:
+    """Én rad per risiko for 📚 Database-fanen (EML beregnes vektorisert)."""
+    if hasattr(db, "frame"):
+        return _db_frame_columnar(db, default_scenario)
+    recs = [(key, r) for key, r in db.items() if isinstance(r, dict)]
+    # EML for hele porteføljen i én vektorisert runde
+    eml_all = calc_eml_records(r for _, r in recs)["eml"]
+
+    rows = []
+    for (key, r), eml_val in zip(recs, eml_all.tolist()):
+        rows.append({
+            "_key": key,
+            "Kumulesone": str(r.get("kumulesone", "")),
+            "Forsnr": str(r.get("forsnr", "")),
+            "Risikonr": str(r.get("risikonr", "")),
+            "Kunde": str(r.get("kundenavn", "")),
+            "Adresse": str(r.get("adresse", "")),
+            "Sum forsikring": float(r.get("sum_forsikring", 0) or 0),
+            "EML (effektiv)": eml_val,
+            "Kilde": ("🟩 Manuell" if bool(r.get("eml_rate_manual_on", False)) else "⚙️ Maskinell"),
+            "Inkluder": bool(r.get("include", False)),
+            "Scenario": r.get("scenario", default_scenario),
+        })
+    return pd.DataFrame(rows, columns=DB_FRAME_COLUMNS)
+
+
+# ---------- kolonnelager (ColumnarRecords) ----------
+def _str_col(s: pd.Series) -> pd.Series:
+    """Som ``str(verdi)`` per rad; kategorikolonner med bare tekst beholdes som de er."""
+    return s if isinstance(s.dtype, pd.CategoricalDtype) else s.map(str)
+
+
+def _bool_col(s: pd.Series) -> np.ndarray:
+    return s.to_numpy() if s.dtype == bool else np.fromiter((bool(v) for v in s.tolist()), dtype=bool, count=len(s))
+
+
+def _sorted_categories(s: pd.Series) -> pd.Series:
+    """Kategorier i alfabetisk rekkefølge, så ``sort_values`` sorterer som for tekst."""
+    if not isinstance(s.dtype, pd.CategoricalDtype):
+        return s
+    cats = s.cat.categories
+    order = np.argsort(np.asarray(cats, dtype=object), kind="stable")
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order), dtype=np.int32)
+    codes = s.cat.codes.to_numpy()
+    new_codes = np.where(codes >= 0, rank[np.maximum(codes, 0)], -1).astype(np.int32)
+    return pd.Series(pd.Categorical.from_codes(new_codes, categories=cats[order]), index=s.index, name=s.name)
+
+
+def _db_frame_columnar(db, default_scenario: str) -> pd.DataFrame:
+    text = {"kumulesone": "Kumulesone", "forsnr": "Forsnr", "risikonr": "Risikonr",
+            "kundenavn": "Kunde", "adresse": "Adresse"}
+    f = db.frame([*text, "include", "scenario", *BATCH_FIELDS],
+                 defaults={**FIELD_DEFAULTS, **dict.fromkeys(text, ""), "include": False, "scenario": default_scenario})
+    eml = calc_eml_batch(f)["eml"]
+    si = f["sum_forsikring"]
+    si = si.to_numpy() if si.dtype.kind == "f" else np.array([float(v or 0) for v in si.tolist()], dtype=np.float64)
+    manual = _bool_col(f["eml_rate_manual_on"])
+    out = pd.DataFrame({"_key": f["_key"]}, copy=False)
+    for field, col in text.items():
+        out[col] = _sorted_categories(_str_col(f[field]))
+    out["Sum forsikring"] = si
+    out["EML (effektiv)"] = eml
+    out["Kilde"] = pd.Categorical.from_codes(manual.astype(np.int8), categories=["⚙️ Maskinell", "🟩 Manuell"])
+    out["Inkluder"] = _bool_col(f["include"])
+    out["Scenario"] = f["scenario"].astype(object)
+    return out[DB_FRAME_COLUMNS]
+
+
+def zone_headers(dfv: pd.DataFrame, acc) -> Dict[str, Tuple[int, int, int]]:
+    """Kumulesone -> (antall i utvalget, sum SI i utvalget, sum EML inkluderte fra indeksen)."""
+    g = dfv.groupby("Kumulesone", dropna=False, observed=True)["Sum forsikring"].agg(["size", "sum"])
+    return {
+        kumule: (int(n), int(si), int(acc.zone(kumule)["eml_inc"]))
+        for kumule, n, si in zip(g.index.tolist(), g["size"].tolist(), g["sum"].tolist())
+    }
+
+
+def zone_items(db: Dict[str, Any], kumule: str, scenario: str, default_scenario: str) -> List[Tuple[str, Dict[str, Any]]]:
+    """Inkluderte risikoer i én kumulesone og ett scenario (📈 EML-scenario-fanen)."""
+    if hasattr(db, "frame"):
+        f = db.frame(["kumulesone", "include", "scenario"],
+                     defaults={"kumulesone": "", "include": False, "scenario": default_scenario})
+        mask = ((_str_col(f["kumulesone"]) == str(kumule)).to_numpy()
+                & _bool_col(f["include"])
+                & (_str_col(f["scenario"]) == scenario).to_numpy())
+        return [(k, db[k]) for k in f["_key"].to_numpy()[mask].tolist()]
+    return [
+        (k, r) for k, r in db.items()
+        if isinstance(r, dict)
+        and str(r.get("kumulesone", "")) == str(kumule)
+        and bool(r.get("include", False))
+        and str(r.get("scenario", default_scenario)) == scenario
+    ]
@@ -0,0 +1,308 @@
+"""Hodeløs akkumuleringsrapport (uten Streamlit).
+
+Laster databasen med samme lagring som appen (JSON + journal eller SQLite),
+kan flette inn et Excel-uttrekk med samme import som appen, og regner per
+kumulesone × scenario: antall, SI, effektiv EML, antall overstyringer og de
+største bidragsyterne. Sonene fordeles på en prosesspool. Med ``--mc-events``
+får sonetabellen også simulert halerisiko (``monte_carlo.py``) for inkluderte.
+
+Versjoner (``snapshots.py``, samme lager som appen): ``--snapshot`` lagrer
+databasen som ny versjon, ``--versions`` lister dem og ``--diff FRA [TIL]``
+viser kumulesonene × scenarioene som endret seg mest (uten TIL: mot databasen).
+
+``--format xlsx`` skriver Excel-rapporten fra appen (``excel_report.py``):
+sammendrag + ett ark per kumulesone, strømmet til fil.
+
+Eksempel:
+    python eml_batch.py --db risiko_db.json --out rapport/eml --workers 8
+    python eml_batch.py --excel uttrekk.xlsx --out rapport/eml --format csv
+    python eml_batch.py --excel uttrekk.xlsx --save   # samme importmanifest som appen
+    python eml_batch.py --out rapport/eml --format xlsx
+    python eml_batch.py --mc-events 20000 --mc-seed 7
+    python eml_batch.py --diff 00003 00005 --top 20
+"""
+import argparse
+import heapq
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from accumulation import AccumulationIndex, _si
+from eml_engine import SCENARIOS, calc_eml_records
+from monte_carlo import DEFAULT_SEED, simulate_zone
+from schema import migrate
+from serialization import dumps
+from storage import get_store
+
+# Felt som sendes til arbeiderprosessene (resten av recorden trengs ikke)
+REPORT_FIELDS = (
+    "kumulesone", "scenario", "include", "forsnr", "risikonr", "kundenavn", "adresse", "sum_forsikring",
+    "brannrisiko", "begrensende_faktorer", "deteksjon_beskyttelse", "eksponering_nabo",
+    "eml_rate_manual_on", "eml_rate_manual",
+)
+
+ZONE_COLUMNS = ["kumulesone", "scenario", "antall", "antall_inkl", "sum_si", "sum_si_inkl",
+                "sum_eml_inkl", "antall_overstyrt_inkl"]
+# Med --mc-events (snitt, VaR og TVaR på 99,5 %-nivå for inkluderte)
+MC_COLUMNS = ["mc_mean", "mc_var995", "mc_tvar995"]
+TOP_COLUMNS = ["kumulesone", "scenario", "rang", "key", "forsnr", "risikonr", "kundenavn", "adresse",
+               "sum_si", "eml", "kilde"]
+
+
+# ==========================================================
+# Beregning (kjøres i arbeiderprosessene)
+# ==========================================================
+def summarize_zone(zone: str, items: List[Tuple[str, Dict[str, Any]]], top_n: int,
+                   default_scenario: str, mc_events: int = 0,
+                   mc_seed: int = DEFAULT_SEED) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Rader for sone-tabellen og topp-N-tabellen for én kumulesone."""
+    sub = dict(items)
+    acc = AccumulationIndex.build(sub, default_scenario)
+    zone_rows = []
+    for (z, scen), c in sorted(acc.cells().items()):
+        zone_rows.append({
+            "kumulesone": z,
+            "scenario": scen,
+            "antall": int(c["n"]),
+            "antall_inkl": int(c["n_inc"]),
+            "sum_si": float(c["si"]),
+            "sum_si_inkl": float(c["si_inc"]),
+            "sum_eml_inkl": int(c["eml_inc"]),
+            "antall_overstyrt_inkl": int(c["n_manual_inc"]),
+        })
+
+    # Største inkluderte bidrag per scenario
+    batch = calc_eml_records(r for _, r in items)
+    eml = batch["eml"].tolist()
+    per_scen: Dict[str, List[Tuple[int, str, Dict[str, Any]]]] = {}
+    rates: Dict[str, List[float]] = {}
+    for (k, r), e, rate in zip(items, eml, batch["rate_effective"].tolist()):
+        if bool(r.get("include", False)):
+            scen = str(r.get("scenario", default_scenario))
+            per_scen.setdefault(scen, []).append((e, k, r))
+            rates.setdefault(scen, []).append(rate)
+
+    if mc_events > 0:
+        # Sonene er allerede fordelt på prosesser; simuleringen kjøres i samme prosess
+        for row in zone_rows:
+            scen = row["scenario"]
+            chosen = per_scen.get(scen, [])
+            res = simulate_zone([_si(r) for _, _, r in chosen], rates.get(scen, []), zone, scen,
+                                n_events=mc_events, seed=mc_seed, keys=[k for _, k, _ in chosen])
+            row.update(mc_mean=res["mean"], mc_var995=res["var"], mc_tvar995=res["tvar"])
+
+    top_rows = []
+    for scen in sorted(per_scen):
+        for rank, (e, k, r) in enumerate(heapq.nlargest(top_n, per_scen[scen], key=lambda t: t[0]), start=1):
+            top_rows.append({
+                "kumulesone": zone,
+                "scenario": scen,
+                "rang": rank,
+                "key": k,
+                "forsnr": str(r.get("forsnr", "")),
+                "risikonr": str(r.get("risikonr", "")),
+                "kundenavn": str(r.get("kundenavn", "")),
+                "adresse": str(r.get("adresse", "")),
+                "sum_si": float(r.get("sum_forsikring", 0) or 0),
+                "eml": int(e),
+                "kilde": "manuell" if r.get("eml_rate_manual_on") else "maskinell",
+            })
+    return zone_rows, top_rows
+
+
+def _summarize_batch(batch: List[Tuple[str, List[Tuple[str, Dict[str, Any]]]]], top_n: int, default_scenario: str,
+                     mc_events: int = 0, mc_seed: int = DEFAULT_SEED):
+    zone_rows, top_rows = [], []
+    for zone, items in batch:
+        z, t = summarize_zone(zone, items, top_n, default_scenario, mc_events, mc_seed)
+        zone_rows.extend(z)
+        top_rows.extend(t)
+    return zone_rows, top_rows
+
+
+def group_by_zone(db: Dict[str, Any]) -> Dict[str, List[Tuple[str, Dict[str, Any]]]]:
+    zones: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {}
+    for k, r in db.items():
+        if not isinstance(r, dict):
+            continue
+        slim = {f: r[f] for f in REPORT_FIELDS if f in r}
+        zones.setdefault(str(r.get("kumulesone", "")), []).append((k, slim))
+    return zones
+
+
+def _balanced_batches(zones: Dict[str, list], n_batches: int) -> List[list]:
+    """Fordel soner på ``n_batches`` omtrent like store bunker (største først)."""
+    heap = [(0, i) for i in range(max(n_batches, 1))]
+    batches: List[list] = [[] for _ in heap]
+    for zone, items in sorted(zones.items(), key=lambda kv: -len(kv[1])):
+        size, i = heapq.heappop(heap)
+        batches[i].append((zone, items))
+        heapq.heappush(heap, (size + len(items), i))
+    return [b for b in batches if b]
+
+
+def build_report(db: Dict[str, Any], top_n: int = 10, workers: Optional[int] = None,
+                 default_scenario: str = SCENARIOS[0], mc_events: int = 0,
+                 mc_seed: int = DEFAULT_SEED) -> Dict[str, List[Dict[str, Any]]]:
+    """Sone- og topp-N-tabell for hele porteføljen. ``workers=1`` kjører i samme prosess.
+
+    ``mc_events`` > 0 legger til ``MC_COLUMNS`` i sonetabellen (samme frø gir samme tall).
+    """
+    zones = group_by_zone(db)
+    workers = workers or os.cpu_count() or 1
+    zone_rows: List[Dict[str, Any]] = []
+    top_rows: List[Dict[str, Any]] = []
+    if workers <= 1 or len(zones) <= 1:
+        zone_rows, top_rows = _summarize_batch(list(zones.items()), top_n, default_scenario, mc_events, mc_seed)
+    else:
+        batches = _balanced_batches(zones, workers * 4)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_summarize_batch, b, top_n, default_scenario, mc_events, mc_seed)
+                       for b in batches]
+            for f in futures:
+                z, t = f.result()
+                zone_rows.extend(z)
+                top_rows.extend(t)
+    zone_rows.sort(key=lambda r: (r["kumulesone"], r["scenario"]))
+    top_rows.sort(key=lambda r: (r["kumulesone"], r["scenario"], r["rang"]))
+    return {"soner": zone_rows, "topp": top_rows}
+
+
+# ==========================================================
+# Utskrift
+# ==========================================================
+def write_report(report: Dict[str, List[Dict[str, Any]]], out: str, formats: List[str]) -> List[str]:
+    import pandas as pd
+
+    d = os.path.dirname(os.path.abspath(out))
+    os.makedirs(d, exist_ok=True)
+    written = []
+    if "csv" in formats:
+        with_mc = any("mc_mean" in r for r in report["soner"])
+        for name, cols in (("soner", ZONE_COLUMNS + (MC_COLUMNS if with_mc else [])), ("topp", TOP_COLUMNS)):
+            path = f"{out}_{name}.csv"
+            pd.DataFrame(report[name], columns=cols).to_csv(path, index=False, sep=";", encoding="utf-8-sig")
+            written.append(path)
+    if "json" in formats:
+        path = f"{out}.json"
+        with open(path, "wb") as f:
+            f.write(dumps(report, indent=True))
+        written.append(path)
+    return written
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Akkumuleringsrapport per kumulesone × scenario (uten Streamlit).")
+    ap.add_argument("--db", default="risiko_db.json", help="Databasefil (JSON eller .sqlite)")
+    ap.add_argument("--backend", choices=["json", "sqlite"], default=None,
+                    help="Lagringsbackend (default: ut fra filendelsen)")
+    ap.add_argument("--excel", help="Excel-uttrekk som flettes inn før rapporten lages")
+    ap.add_argument("--save", action="store_true", help="Lagre Excel-importen til databasen")
+    ap.add_argument("--manifest", default=None,
+                    help="Importmanifest for --save (default: <db>.import_manifest.json, som appen)")
+    ap.add_argument("--out", default="eml_rapport", help="Prefiks for utfilene")
+    ap.add_argument("--format", nargs="+", choices=["csv", "json", "xlsx"], default=["csv", "json"])
+    ap.add_argument("--top", type=int, default=10, help="Antall største risikoer per kumulesone × scenario")
+    ap.add_argument("--workers", type=int, default=None, help="Antall prosesser (default: antall kjerner)")
+    ap.add_argument("--mc-events", type=int, default=0,
+                    help="Simuler halerisiko per kumulesone × scenario med så mange hendelser (0 = av)")
+    ap.add_argument("--mc-seed", type=int, default=DEFAULT_SEED, help="Frø for simuleringen")
+    ap.add_argument("--versions-dir", default=None, help="Versjonslager (default: <db>.versjoner, som appen)")
+    ap.add_argument("--snapshot", nargs="?", const="", metavar="ETIKETT",
+                    help="Lagre databasen (etter ev. Excel-import) som ny versjon")
+    ap.add_argument("--versions", action="store_true", help="List lagrede versjoner og avslutt")
+    ap.add_argument("--diff", nargs="+", metavar="VERSJON",
+                    help="FRA [TIL]: største endringer i akkumuleringen (--top stk.) og avslutt")
+    args = ap.parse_args(argv)
+    if args.diff and len(args.diff) > 2:
+        ap.error("--diff tar én eller to versjoner")
+
+    t0 = time.perf_counter()
+    backend = args.backend or ("sqlite" if args.db.endswith((".sqlite", ".db")) else "json")
+    store = get_store(args.db, backend=backend, **({"default_scenario": SCENARIOS[0]} if backend == "sqlite" else {}))
+    # Eldre databaser leses i gjeldende skjema; på disk migreres de bare med --save
+    db, migration = migrate(store.load() or {})
+    if migration["changed"] and args.save:
+        store.write_snapshot(db)
+    print(f"Lastet {sum(isinstance(r, dict) for r in db.values())} risikoer fra {args.db} "
+          f"({time.perf_counter() - t0:.1f} s)", file=sys.stderr)
+
+    if args.excel:
+        import hashlib
+        import io
+
+        from excel_import import ImportManifest, import_excel
+
+        with open(args.excel, "rb") as f:
+            data = f.read()
+        file_hash = hashlib.md5(data).hexdigest()
+        # Med --save går importen gjennom samme manifest som appen, så neste import
+        # (her eller i appen) bare fletter inn radene som er endret siden denne
+        manifest = None
+        if args.save:
+            manifest = ImportManifest(args.manifest or os.path.splitext(args.db)[0] + ".import_manifest.json")
+        if manifest is not None and file_hash == manifest.file_md5:
+            print(f"{args.excel} er allerede importert (samme fil); hopper over importen", file=sys.stderr)
+        else:
+            res = import_excel(
+                io.BytesIO(data), db, default_scenario=SCENARIOS[0],
+                save=(lambda keys: store.append({k: db[k] for k in keys if k in db})) if args.save else None,
+                manifest=manifest, file_md5=file_hash,
+            )
+            # Manifestet lagres først når radene står i databasen
+            if manifest is not None:
+                manifest.save()
+            print(f"Importert {res['rows']} rader fra {args.excel} ({res['rows_per_sec']:.0f} rader/s), "
+                  f"{len(res['inserted'])} nye, {len(res['changed'])} endrede, "
+                  f"{len(res['rejected'])} avvist", file=sys.stderr)
+            for r in res["rejected"][:20]:
+                print(f"  rad {r['rad']}: {r['årsak']}", file=sys.stderr)
+
+    if args.snapshot is not None or args.versions or args.diff:
+        from snapshots import SnapshotStore, top_movers
+
+        snaps = SnapshotStore(args.versions_dir or args.db + ".versjoner")
+        if args.snapshot is not None:
+            info = snaps.snapshot(db, label=args.snapshot)
+            print(f"Versjon {info['id']} lagret ({info['new_objects']} nye objekter, {info['new_bytes']} bytes)",
+                  file=sys.stderr)
+        if args.versions:
+            for v in snaps.versions():
+                print(f"{v['id']}\t{v['created']}\t{v['n_records']}\t{v['label']}")
+            return 0
+        if args.diff:
+            to = args.diff[1] if len(args.diff) > 1 else None
+            d = snaps.diff(args.diff[0], to, db=db, default_scenario=SCENARIOS[0])
+            print(f"{args.diff[0]} -> {to or 'database'}: {d['added']} nye, {d['modified']} endrede, "
+                  f"{d['removed']} fjernede risikoer", file=sys.stderr)
+            print("kumulesone\tscenario\td_eml_inkl\td_si_inkl\td_si\td_antall_inkl\tendrede")
+            for c in top_movers(d["cells"], args.top):
+                print(f"{c['kumulesone']}\t{c['scenario']}\t{c['d_eml_inc']}\t{c['d_si_inc']:.0f}\t"
+                      f"{c['d_si']:.0f}\t{c['d_n_inc']}\t{c['changed']}")
+            return 0
+
+    if "xlsx" in args.format:
+        from excel_report import write_report as write_xlsx
+
+        path = f"{args.out}.xlsx"
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        stats = write_xlsx(db, path, SCENARIOS[0])
+        print(path)
+        print(f"Excel-rapport: {stats['zones']} kumulesoner, {stats['rows']} risikoer ({stats['seconds']:.1f} s)",
+              file=sys.stderr)
+    formats = [f for f in args.format if f != "xlsx"]
+    if not formats:
+        return 0
+
+    t1 = time.perf_counter()
+    report = build_report(db, top_n=args.top, workers=args.workers, mc_events=args.mc_events, mc_seed=args.mc_seed)
+    for path in write_report(report, args.out, formats):
+        print(path)
+    print(f"{len(report['soner'])} kumulesone×scenario beregnet på {time.perf_counter() - t1:.1f} s", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
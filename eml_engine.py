@@ -0,0 +1,243 @@
+"""EML-modell: maskinell sats, effektiv sats og EML.
+
+Skalarfunksjonene (``calc_eml_*``) brukes per risiko. ``calc_eml_batch`` regner
+hele porteføljen som kolonner i én NumPy-runde, med samme 30 %-fallback som
+skalarversjonen – men som en maske per rad i stedet for try/except.
+
+Batchen er delt i to: ``prepare_batch`` tolker kolonnene (faktorkoder, SI,
+manuelle satser) én gang, og ``eml_from_prepared`` regner EML for et gitt
+``EmlParams`` (BASE og de fire tabellene). Parametersveip gjenbruker dermed
+alt som ikke avhenger av parametrene.
+"""
+from typing import Any, Dict, Iterable, Mapping, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+# Scenarioer en risiko kan tilordnes (første er default)
+SCENARIOS = ["Brann", "Skred", "Flom", "Annet"]
+
+# ==========================================================
+# Enkel maskinell EML-modell (rate)
+# ==========================================================
+BASE = 0.6
+ALPHA = [1.00, 1.15, 1.35, 1.60]
+BETA = [0.40, 0.30, 0.20, 0.10]
+GAMMA = [0.05, 0.10, 0.15, 0.20]
+EXPO = [1.30, 1.15, 1.00, 0.85]
+
+# Sats når faktorene mangler/er ugyldige (prototyp)
+FALLBACK_RATE = 0.30
+
+# Faktorfelt -> oppslagstabell
+FACTOR_FIELDS = {
+    "brannrisiko": ALPHA,
+    "begrensende_faktorer": GAMMA,
+    "deteksjon_beskyttelse": BETA,
+    "eksponering_nabo": EXPO,
+}
+
+
+class EmlParams(NamedTuple):
+    """Modellparametre (hashbar, brukes som cache-nøkkel). Tabellene må ha samme lengde som standard."""
+    base: float = BASE
+    alpha: Tuple[float, ...] = tuple(ALPHA)
+    beta: Tuple[float, ...] = tuple(BETA)
+    gamma: Tuple[float, ...] = tuple(GAMMA)
+    expo: Tuple[float, ...] = tuple(EXPO)
+
+    def validated(self) -> "EmlParams":
+        out = EmlParams(float(self.base), *(tuple(float(x) for x in t) for t in self[1:]))
+        for name, t, default in zip(self._fields[1:], out[1:], DEFAULT_PARAMS[1:]):
+            if len(t) != len(default):
+                raise ValueError(f"{name.upper()} må ha {len(default)} verdier (har {len(t)})")
+        return out
+
+
+DEFAULT_PARAMS = EmlParams()
+
+# Alle felt batch-motoren leser
+BATCH_FIELDS = list(FACTOR_FIELDS) + ["sum_forsikring", "eml_rate_manual_on", "eml_rate_manual"]
+
+
+def clamp01(x: float) -> float:
+    return max(0.0, min(1.0, float(x)))
+
+
+def calc_eml_rate_machine(rec: Dict[str, Any]) -> float:
+    # Prototyp – inntil vi kobler faktorer; gi 30 % default hvis mangler
+    try:
+        b = int(rec.get("brannrisiko", 0))
+        lim = int(rec.get("begrensende_faktorer", 0))
+        prot = int(rec.get("deteksjon_beskyttelse", 0))
+        expo = int(rec.get("eksponering_nabo", 0))
+        rate = BASE * ALPHA[b] * EXPO[expo]
+        rate *= (1 - BETA[prot])
+        rate *= (1 - GAMMA[lim])
+        return clamp01(rate)
+    except Exception:
+        return FALLBACK_RATE
+
+
+def calc_eml_rate_effective(rec: Dict[str, Any]) -> float:
+    if rec.get("eml_rate_manual_on"):
+        return clamp01(float(rec.get("eml_rate_manual", 0.0)))
+    return calc_eml_rate_machine(rec)
+
+
+def calc_eml_effective(rec: Dict[str, Any]) -> int:
+    try:
+        si = float(rec.get("sum_forsikring", 0) or 0)
+        return int(round(si * calc_eml_rate_effective(rec)))
+    except Exception:
+        return 0
+
+
+# ==========================================================
+# Batch (hele porteføljen som kolonner)
+# ==========================================================
+def _to_int(v: Any) -> Optional[int]:
+    try:
+        return int(v)
+    except Exception:
+        return None
+
+
+def _to_float(v: Any) -> Optional[float]:
+    try:
+        return float(v)
+    except Exception:
+        return None
+
+
+def _factor_codes(values: Any, n: int, table_len: int):
+    """Faktorkolonne -> (indeks, gyldig-maske). Samme regler som ``int(...)`` + listeoppslag."""
+    if values is None:
+        return np.zeros(n, dtype=np.int64), np.ones(n, dtype=bool)
+    arr = np.asarray(values)
+    if arr.dtype.kind in "biu":
+        codes = arr.astype(np.int64)
+        ok = np.ones(n, dtype=bool)
+    elif arr.dtype.kind == "f":
+        ok = np.isfinite(arr)
+        codes = np.where(ok, np.trunc(np.where(ok, arr, 0)), 0).astype(np.int64)
+    else:
+        conv = [_to_int(v) for v in arr.tolist()]
+        ok = np.fromiter((c is not None for c in conv), dtype=bool, count=n)
+        codes = np.fromiter((c if c is not None else 0 for c in conv), dtype=np.int64, count=n)
+    # Python-lister tillater negative indekser (-len..-1)
+    ok &= (codes >= -table_len) & (codes < table_len)
+    codes = np.where(ok, codes % table_len, 0)
+    return codes, ok
+
+
+def _float_column(values: Any, n: int, default: float, falsy_as_default: bool):
+    """Kolonne -> (float64-verdier, gyldig-maske).
+
+    ``falsy_as_default`` speiler ``float(x or 0)`` (``None``/tom streng blir ``default``).
+    """
+    if values is None:
+        return np.full(n, default, dtype=np.float64), np.ones(n, dtype=bool)
+    arr = np.asarray(values)
+    if arr.dtype.kind in "biuf":
+        return arr.astype(np.float64), np.ones(n, dtype=bool)
+    if falsy_as_default:
+        conv = [_to_float(v or default) for v in arr.tolist()]
+    else:
+        conv = [_to_float(v) for v in arr.tolist()]
+    ok = np.fromiter((c is not None for c in conv), dtype=bool, count=n)
+    out = np.fromiter((c if c is not None else 0.0 for c in conv), dtype=np.float64, count=n)
+    return out, ok
+
+
+def _bool_column(values: Any, n: int):
+    if values is None:
+        return np.zeros(n, dtype=bool)
+    arr = np.asarray(values)
+    if arr.dtype.kind == "b":
+        return arr
+    return np.fromiter((bool(v) for v in arr.tolist()), dtype=bool, count=n)
+
+
+def prepare_batch(cols: Mapping[str, Any], n: Optional[int] = None) -> Dict[str, np.ndarray]:
+    """Tolk kolonnene én gang: alt ``eml_from_prepared`` trenger som ikke avhenger av parametrene.
+
+    ``combo`` er faktorkombinasjonen per rad (indeks i satstabellen fra ``_rate_table``).
+    """
+    if n is None:
+        present = [cols[c] for c in BATCH_FIELDS if c in cols]
+        n = len(present[0]) if present else 0
+
+    combo = np.zeros(n, dtype=np.int64)
+    ok = np.ones(n, dtype=bool)
+    # Rekkefølgen her bestemmer aksene i _rate_table
+    for field in ("brannrisiko", "begrensende_faktorer", "deteksjon_beskyttelse", "eksponering_nabo"):
+        size = len(FACTOR_FIELDS[field])
+        c, c_ok = _factor_codes(cols.get(field), n, size)
+        combo = combo * size + c
+        ok &= c_ok
+
+    manual_on = _bool_column(cols.get("eml_rate_manual_on"), n)
+    manual_rate, manual_ok = _float_column(cols.get("eml_rate_manual"), n, 0.0, falsy_as_default=False)
+    # clamp01(nan) gir 1.0 i skalarversjonen
+    manual_rate = np.clip(np.nan_to_num(manual_rate, nan=1.0), 0.0, 1.0)
+    si, si_ok = _float_column(cols.get("sum_forsikring"), n, 0.0, falsy_as_default=True)
+    return {"combo": combo, "factors_ok": ok, "manual_on": manual_on, "manual_rate": manual_rate,
+            "manual_ok": manual_ok, "si": si, "si_ok": si_ok}
+
+
+def _rate_table(params: EmlParams) -> np.ndarray:
+    """Maskinsats for hver faktorkombinasjon (samme regneoperasjoner og rekkefølge som skalarversjonen)."""
+    a = np.asarray(params.alpha)[:, None, None, None]
+    g = np.asarray(params.gamma)[None, :, None, None]
+    b = np.asarray(params.beta)[None, None, :, None]
+    e = np.asarray(params.expo)[None, None, None, :]
+    rate = params.base * a * e
+    rate = rate * (1 - b)
+    rate = rate * (1 - g)
+    return np.clip(rate, 0.0, 1.0).ravel()
+
+
+def eml_from_prepared(prep: Dict[str, np.ndarray], params: EmlParams = DEFAULT_PARAMS) -> Dict[str, np.ndarray]:
+    rate_machine = np.where(prep["factors_ok"], _rate_table(params)[prep["combo"]], FALLBACK_RATE)
+    rate_effective = np.where(prep["manual_on"], prep["manual_rate"], rate_machine)
+    eml_f = prep["si"] * rate_effective
+    # Skalarversjonen gir 0 når SI eller manuell sats ikke kan tolkes
+    valid = prep["si_ok"] & (prep["manual_ok"] | ~prep["manual_on"]) & np.isfinite(eml_f)
+    eml = np.where(valid, np.rint(np.where(valid, eml_f, 0.0)), 0).astype(np.int64)
+    return {"rate_machine": rate_machine, "rate_effective": rate_effective, "eml": eml}
+
+
+def calc_eml_batch(cols: Mapping[str, Any], base: float = BASE, n: Optional[int] = None,
+                   params: Optional[EmlParams] = None) -> Dict[str, np.ndarray]:
+    """Maskinsats, effektiv sats og EML for alle rader i én vektorisert runde.
+
+    ``cols`` er et dict (eller DataFrame) med kolonnene i ``BATCH_FIELDS``; manglende
+    kolonner tolkes som feltets default. Returnerer ``rate_machine``, ``rate_effective``
+    (float64) og ``eml`` (int64).
+    """
+    if params is None:
+        params = DEFAULT_PARAMS._replace(base=base)
+    return eml_from_prepared(prepare_batch(cols, n), params)
+
+
+# Default når feltet mangler i recorden (samme som rec.get(felt, default) i skalarversjonen)
+FIELD_DEFAULTS = {
+    **{f: 0 for f in FACTOR_FIELDS},
+    "sum_forsikring": 0,
+    "eml_rate_manual_on": False,
+    "eml_rate_manual": 0.0,
+}
+
+
+def records_to_columns(records: Iterable[Dict[str, Any]]) -> Dict[str, list]:
+    """Plukk ut ``BATCH_FIELDS`` fra en samling record-dicts (ett pass)."""
+    cols: Dict[str, list] = {f: [] for f in BATCH_FIELDS}
+    for r in records:
+        for f, lst in cols.items():
+            lst.append(r.get(f, FIELD_DEFAULTS[f]))
+    return cols
+
+
+def calc_eml_records(records: Iterable[Dict[str, Any]], base: float = BASE) -> Dict[str, np.ndarray]:
+    records = list(records)
+    return calc_eml_batch(records_to_columns(records), base=base, n=len(records))
@@ -0,0 +1,392 @@
+"""Strømmende Excel-import.
+
+Arket leses i biter med openpyxl i read-only-modus, kolonnene mappes via
+``EXPECTED_COLS`` og ``tariffsum`` konverteres som kolonneoperasjoner, og hver
+bit flettes inn i databasen og lagres samlet (ikke rad for rad).
+
+Med et ``ImportManifest`` (innholdshash per rad, lagret på disk) blir en ny
+versjon av uttrekket en delta-import: bare nye, endrede og fjernede rader
+røres; uendrede rader beholder ``updated`` og manuelle overstyringer.
+"""
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from serialization import dumps, load_file
+
+# Forventede kolonner (case-insensitiv matching)
+EXPECTED_COLS = {
+    "kumulenr": "Kumulenr",
+    "risikonr": "Risikonr",
+    "forsnr": "Forsnr",
+    "adresse": "Adresse",
+    "kundenavn": "Kundenavn",
+    "tariffsum": "Tariffsum",
+    "latitude": "Breddegrad",
+    "longitude": "Lengdegrad",
+}
+REQUIRED_COLS = ["kumulenr", "risikonr"]
+# Valgfrie koordinatkolonner (desimalgrader, WGS84)
+COORD_FIELDS = ["latitude", "longitude"]
+
+# Antall rader per bit som flettes og lagres samlet
+CHUNK_ROWS = 20_000
+
+# Felt som inngår i innholdshashen per rad (koordinatene i tillegg når raden har dem)
+HASH_FIELDS = ["kumulesone", "risikonr", "forsnr", "adresse", "kundenavn", "sum_forsikring"]
+
+# Excel-kolonne -> felt i databasen (tekstfelt)
+TEXT_FIELDS = {
+    "kumulenr": "kumulesone",
+    "risikonr": "risikonr",
+    "forsnr": "forsnr",
+    "adresse": "adresse",
+    "kundenavn": "kundenavn",
+}
+
+
+class MissingColumnsError(ValueError):
+    def __init__(self, missing: List[str]):
+        super().__init__("Mangler påkrevde kolonner: " + ", ".join(missing))
+        self.missing = missing
+
+
+class ImportCancelled(Exception):
+    """Importen ble avbrutt (``cancel()`` returnerte True) før neste bit."""
+
+    def __init__(self, rows: int):
+        super().__init__(f"Importen ble avbrutt etter {rows} rader")
+        self.rows = rows
+
+
+def now_iso() -> str:
+    return datetime.utcnow().isoformat(timespec="seconds") + "Z"
+
+
+# ==========================================================
+# Lesing
+# ==========================================================
+def resolve_columns(header: Sequence[Any]) -> Dict[str, Optional[int]]:
+    """``EXPECTED_COLS``-nøkkel -> kolonneindeks i arket (None hvis den mangler)."""
+    lower = {}
+    for i, c in enumerate(header):
+        lower.setdefault(str(c).strip().lower(), i)
+    return {k: lower.get(v.lower()) for k, v in EXPECTED_COLS.items()}
+
+
+@contextmanager
+def open_sheet(fileobj):
+    """-> (header, rad-iterator, antall datarader eller None). Kun første ark leses.
+
+    Arbeidsboken (read-only holder filen åpen) lukkes når ``with``-blokken er ferdig.
+    """
+    from openpyxl import load_workbook
+
+    wb = load_workbook(fileobj, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, None) or ()
+        total = (ws.max_row - 1) if ws.max_row else None
+        yield [str(c).strip() if c is not None else "" for c in header], rows, total
+    finally:
+        wb.close()
+
+
+def iter_chunks(rows: Iterator[tuple], chunk_rows: int = CHUNK_ROWS) -> Iterator[Tuple[List[tuple], List[int]]]:
+    """-> (rader, radnumre i arket). Første datarad er rad 2 (under overskriften)."""
+    buf: List[tuple] = []
+    nums: List[int] = []
+    for rownum, r in enumerate(rows, start=2):
+        # Helt tomme rader (typisk formatering nederst i arket) hoppes over
+        if r is None or all(v is None for v in r):
+            continue
+        buf.append(r)
+        nums.append(rownum)
+        if len(buf) >= chunk_rows:
+            yield buf, nums
+            buf, nums = [], []
+    if buf:
+        yield buf, nums
+
+
+# ==========================================================
+# Kolonneoperasjoner
+# ==========================================================
+def _text_column(col: pd.Series) -> pd.Series:
+    """Tekst som i arket: tomme celler -> "", heltallige tall uten ".0"."""
+    if col.dtype.kind in "iu":
+        return col.astype(str).astype(object)
+    if col.dtype.kind == "f":
+        # Heltall + tomme celler gir float64-kolonne; skriv 123.0 som "123"
+        integral = np.isfinite(col) & (col == np.floor(col))
+        out = col.astype(str).astype(object)
+        out[integral] = col[integral].astype("int64").astype(str)
+        out[col.isna()] = ""
+        return out
+    return col.astype(object).where(col.notna(), "").astype(str).astype(object)
+
+
+def map_chunk(rows: List[tuple], colmap: Dict[str, Optional[int]]) -> pd.DataFrame:
+    """Bit med rå rader -> DataFrame med databasefelt + ``key`` (kumule-risiko-adresse).
+
+    ``reject`` er årsaken til at raden avvises ("" = ok): manglende kumulenr/risikonr
+    eller en tariffsum som ikke er et tall (den blir ikke stille til 0).
+    """
+    width = max((len(r) for r in rows), default=0)
+    raw = pd.DataFrame.from_records(rows, columns=range(width), coerce_float=False)
+    n = len(raw)
+    out = pd.DataFrame(index=raw.index)
+    for src, field in TEXT_FIELDS.items():
+        idx = colmap.get(src)
+        if idx is None or idx >= width:
+            out[field] = ""
+        else:
+            out[field] = _text_column(raw[idx])
+    reject = np.full(n, "", dtype=object)
+    idx = colmap.get("tariffsum")
+    if idx is None or idx >= width:
+        out["sum_forsikring"] = np.zeros(n)
+    else:
+        si = pd.to_numeric(raw[idx], errors="coerce")
+        bad = (si.isna() & (_text_column(raw[idx]).str.strip() != "")).to_numpy()
+        if bad.any():
+            reject[bad] = ["Tariffsum er ikke et tall: " + repr(v) for v in raw[idx][bad].tolist()]
+        out["sum_forsikring"] = si.fillna(0.0).astype(float)
+    _map_coords(raw, colmap, out, reject)
+    reject[(out["risikonr"].str.strip() == "").to_numpy()] = "Risikonr mangler"
+    reject[(out["kumulesone"].str.strip() == "").to_numpy()] = "Kumulenr mangler"
+    out["key"] = (out["kumulesone"] + "-" + out["risikonr"] + "-" + out["adresse"]).str.strip("-")
+    out["reject"] = reject
+    return out
+
+
+def _map_coords(raw: pd.DataFrame, colmap: Dict[str, Optional[int]], out: pd.DataFrame,
+                reject: np.ndarray) -> None:
+    """Breddegrad/lengdegrad -> float (NaN når cellen er tom eller kolonnen mangler)."""
+    n, width = len(raw), raw.shape[1]
+    coords = {}
+    for field in COORD_FIELDS:
+        idx = colmap.get(field)
+        if idx is None or idx >= width:
+            coords[field] = pd.Series(np.full(n, np.nan), index=raw.index)
+            continue
+        # Desimalkomma ("59,91") er vanlig i norske uttrekk
+        col = raw[idx].map(lambda v: v.strip().replace(",", ".") if isinstance(v, str) else v)
+        val = pd.to_numeric(col, errors="coerce").astype(float)
+        bad = (val.isna() & (_text_column(raw[idx]).str.strip() != "")).to_numpy()
+        reject[bad] = [f"{EXPECTED_COLS[field]} er ikke et tall: {v!r}" for v in raw[idx][bad].tolist()]
+        coords[field] = val
+    lat, lon = coords["latitude"], coords["longitude"]
+    one_missing = (lat.isna() != lon.isna()).to_numpy() & (reject == "")
+    reject[one_missing] = "Breddegrad og lengdegrad må fylles ut sammen"
+    outside = ((lat.abs() > 90) | (lon.abs() > 180)).to_numpy() & (reject == "")
+    reject[outside] = "Koordinat utenfor gyldig område"
+    out["latitude"], out["longitude"] = lat, lon
+
+
+def merge_chunk(db: Dict[str, Any], chunk: pd.DataFrame, stamp: str, default_scenario: str) -> List[str]:
+    """Flett en mappet bit inn i ``db``; manuelle felt (include/scenario/overstyring) beholdes."""
+    keys = chunk["key"].tolist()
+    cols = [chunk[f].tolist() for f in ("kumulesone", "risikonr", "forsnr", "adresse", "kundenavn", "sum_forsikring")]
+    lats = chunk["latitude"].tolist() if "latitude" in chunk else [np.nan] * len(keys)
+    lons = chunk["longitude"].tolist() if "longitude" in chunk else [np.nan] * len(keys)
+    for key, kumule, risiko, forsnr, adresse, kunde, si, lat, lon in zip(keys, *cols, lats, lons):
+        # Ny dict per post (ikke mutasjon på stedet) – andre sesjoner kan lese den gamle
+        rec = dict(db[key]) if isinstance(db.get(key), dict) else {}
+        rec.update({
+            "kumulesone": kumule,
+            "risikonr": risiko,
+            "forsnr": forsnr,
+            "adresse": adresse,
+            "kundenavn": kunde,
+            "sum_forsikring": si,
+            "eml_rate_manual_on": rec.get("eml_rate_manual_on", False),
+            "eml_rate_manual": rec.get("eml_rate_manual", 0.0),
+            "include": rec.get("include", False),
+            "scenario": rec.get("scenario", default_scenario),
+            "updated": stamp,
+        })
+        # Tomme koordinater i uttrekket overskriver ikke koordinater registrert i appen
+        if lat == lat and lon == lon:
+            rec["latitude"], rec["longitude"] = float(lat), float(lon)
+        db[key] = rec
+    return keys
+
+
+def row_hashes(chunk: pd.DataFrame) -> List[int]:
+    """Innholdshash (uint64) per rad over ``HASH_FIELDS`` (+ koordinatene på rader som har dem).
+
+    Rader uten koordinater får samme hash som før koordinatene ble importert,
+    så et uendret uttrekk uten koordinatkolonner gir fortsatt ingen endringer.
+    """
+    hashes = pd.util.hash_pandas_object(chunk[HASH_FIELDS], index=False)
+    if "latitude" in chunk:
+        has = (chunk["latitude"].notna() & chunk["longitude"].notna()).to_numpy()
+        if has.any():
+            with_coords = pd.util.hash_pandas_object(chunk[HASH_FIELDS + COORD_FIELDS][has], index=False)
+            hashes = hashes.to_numpy().copy()
+            hashes[has] = with_coords.to_numpy()
+            return hashes.tolist()
+    return hashes.tolist()
+
+
+# ==========================================================
+# Import-manifest (persistert innholdshash per rad)
+# ==========================================================
+class ImportManifest:
+    """Hash per rad fra forrige import, nøklet på ``kumule-risiko-adresse``."""
+
+    VERSION = 1
+
+    def __init__(self, path: str):
+        self.path = path
+        self.rows: Dict[str, int] = {}
+        self.file_md5: Optional[str] = None
+        self.imported_at: Optional[str] = None
+        if os.path.exists(path):
+            data = load_file(path)
+            if isinstance(data, dict) and data.get("version") == self.VERSION:
+                self.rows = dict(data.get("rows", {}))
+                self.file_md5 = data.get("file_md5")
+                self.imported_at = data.get("imported_at")
+
+    def save(self) -> None:
+        from storage import atomic_write_bytes
+
+        data = {"version": self.VERSION, "file_md5": self.file_md5, "imported_at": self.imported_at, "rows": self.rows}
+        atomic_write_bytes(self.path, dumps(data))
+
+
+def _count(key: str, db: Dict[str, Any], summary: Dict[str, Any], counted: Dict[str, Any]) -> None:
+    """Ny eller endret nøkkel i ``summary`` – én gang per nøkkel, også når den står flere ganger i uttrekket."""
+    if counted.get(key) in ("inserted", "changed"):
+        return
+    if counted.get(key) == "unchanged":
+        summary["unchanged"] -= 1
+    cls = "inserted" if not isinstance(db.get(key), dict) else "changed"
+    summary[cls].append(key)
+    counted[key] = cls
+
+
+def _split_delta(chunk: pd.DataFrame, hashes: List[int], db: Dict[str, Any],
+                 manifest: ImportManifest, summary: Dict[str, Any], counted: Dict[str, Any],
+                 hashed: Dict[str, int]) -> pd.DataFrame:
+    """Behold bare rader som er nye eller endret siden forrige import.
+
+    ``hashed`` er hashen til forrige rad med samme nøkkel i denne importen: en
+    nøkkel som gjentas, flettes på nytt bare når raden er annerledes (siste rad vinner).
+    """
+    keep = []
+    for key, h in zip(chunk["key"].tolist(), hashes):
+        before = hashed.get(key, manifest.rows.get(key))
+        hashed[key] = h
+        if not isinstance(db.get(key), dict) or before != h:
+            _count(key, db, summary, counted)
+            keep.append(True)
+        else:
+            if key not in counted:
+                summary["unchanged"] += 1
+                counted[key] = "unchanged"
+            keep.append(False)
+    return chunk[np.asarray(keep, dtype=bool)] if keep else chunk
+
+
+# ==========================================================
+# Hele importen
+# ==========================================================
+def import_excel(
+    fileobj,
+    db: Dict[str, Any],
+    default_scenario: str,
+    save: Optional[Callable[[List[str]], Any]] = None,
+    progress: Optional[Callable[[int, Optional[int], int], Any]] = None,
+    chunk_rows: int = CHUNK_ROWS,
+    manifest: Optional[ImportManifest] = None,
+    remove_missing: bool = False,
+    file_md5: Optional[str] = None,
+    cancel: Optional[Callable[[], bool]] = None,
+) -> Dict[str, Any]:
+    """Importer første ark i ``fileobj`` til ``db``.
+
+    ``save(keys)`` kalles én gang per bit med nøklene som ble skrevet (eller
+    slettet), og ``progress(rader_lest, totalt_eller_None, rader_flettet)``
+    etter hver bit. Returnerer ``cancel()`` True, stoppes importen før neste
+    bit med ``ImportCancelled`` (bitene som alt er lagret, blir stående).
+
+    Med ``manifest`` hoppes uendrede rader over, og med ``remove_missing``
+    slettes rader som var med i forrige import men mangler nå. Manifestet
+    oppdateres i minnet; kalleren lagrer det (``manifest.save()``) etter at
+    databasen er lagret. Returnerer ``{"rows", "seconds", "rows_per_sec",
+    "columns", "inserted", "changed", "unchanged", "removed", "rejected"}``, der
+    ``rejected`` er ``[{"rad", "nøkkel", "årsak"}]``.
+    """
+    t0 = time.perf_counter()
+    # Hele importen skjer inne i with-blokken; arbeidsboken lukkes også ved feil og avbrudd
+    with open_sheet(fileobj) as (header, rows, total):
+        colmap = resolve_columns(header)
+        missing = [EXPECTED_COLS[k] for k in REQUIRED_COLS if colmap.get(k) is None]
+        if missing:
+            raise MissingColumnsError(missing)
+
+        stamp = now_iso()
+        done = merged = 0
+        summary: Dict[str, Any] = {"inserted": [], "changed": [], "unchanged": 0, "removed": [], "rejected": []}
+        seen: Dict[str, int] = {}
+        # Nøkler som alt er talt i denne importen (-> "inserted"/"changed"/"unchanged") og siste hash
+        counted: Dict[str, str] = {}
+        hashed: Dict[str, int] = {}
+        for raw_rows, rownums in iter_chunks(rows, chunk_rows):
+            if cancel is not None and cancel():
+                raise ImportCancelled(done)
+            chunk = map_chunk(raw_rows, colmap)
+            bad = (chunk["reject"] != "").to_numpy()
+            if bad.any():
+                for rownum, key, why in zip(np.asarray(rownums)[bad].tolist(), chunk["key"][bad].tolist(),
+                                            chunk["reject"][bad].tolist()):
+                    summary["rejected"].append({"rad": rownum, "nøkkel": key, "årsak": why})
+                    # En avvist rad skal ikke føre til at risikoen slettes (remove_missing)
+                    if manifest is not None and key in manifest.rows:
+                        seen.setdefault(key, manifest.rows[key])
+                chunk = chunk[~bad]
+            if manifest is not None:
+                hashes = row_hashes(chunk)
+                seen.update(zip(chunk["key"].tolist(), hashes))
+                chunk = _split_delta(chunk, hashes, db, manifest, summary, counted, hashed)
+            else:
+                for key in chunk["key"].tolist():
+                    _count(key, db, summary, counted)
+            keys = merge_chunk(db, chunk, stamp, default_scenario)
+            if save is not None and keys:
+                save(keys)
+            done += len(raw_rows)
+            merged += len(keys)
+            if progress is not None:
+                progress(done, total, merged)
+
+        if manifest is not None:
+            if remove_missing:
+                removed = [k for k in manifest.rows if k not in seen and k in db]
+                for k in removed:
+                    del db[k]
+                if save is not None and removed:
+                    save(removed)
+                summary["removed"] = removed
+            manifest.rows = seen if remove_missing else {**manifest.rows, **seen}
+            manifest.file_md5 = file_md5
+            manifest.imported_at = stamp
+
+        secs = time.perf_counter() - t0
+        return {"rows": done, "seconds": secs, "rows_per_sec": done / secs if secs > 0 else 0.0,
+                "columns": header, **summary}
+
+
+def read_excel_columns(fileobj) -> Tuple[List[str], Optional[int]]:
+    """Kun overskriftsraden og antall rader (for forhåndsvisning)."""
+    with open_sheet(fileobj) as (header, _, total):
+        return header, total
@@ -0,0 +1,165 @@
+"""Akkumuleringsrapport som Excel-arbeidsbok.
+
+Arbeidsboken skrives med openpyxl i write-only-modus: radene strømmes rett
+til fil og hvert ark lukkes når det er ferdig, så minnebruken avhenger av den
+største kumulesonen og ikke av porteføljen (openpyxl holder bare noen titalls
+kB metadata per ark til arbeidsboken lagres). Med lxml installert går
+skrivingen flere ganger raskere. Først et
+sammendragsark (én rad per kumulesone × scenario, fra akkumuleringsindeksen),
+deretter ett ark per kumulesone med de inkluderte risikoene – samme utvalg og
+samme beregning (``calc_eml_records``) som 📈 EML-scenario-fanen. Bare én
+kumulesone hentes ut og regnes om om gangen.
+
+Brukes fra appen (📚 Database-fanen) og hodeløst via ``eml_batch.py --format xlsx``.
+"""
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from accumulation import AccumulationIndex, _si
+from eml_engine import SCENARIOS, calc_eml_records
+
+SUMMARY_SHEET = "Sammendrag"
+SUMMARY_COLUMNS = ["Kumulesone", "Scenario", "Antall inkl.", "Sum SI inkl.", "Sum EML inkl.",
+                   "Antall overstyrt inkl.", "Ark"]
+ZONE_COLUMNS = ["Scenario", "Forsnr", "Risikonr", "Kunde", "Adresse", "SI", "Maskinsats", "Effektiv sats",
+                "EML (effektiv)", "Kilde"]
+# Kolonnebredder (tegn) i sonearkene
+ZONE_WIDTHS = [10, 14, 14, 30, 36, 16, 11, 11, 16, 11]
+
+MONEY_FORMAT = "#,##0"
+RATE_FORMAT = "0.0%"
+# Excel: høyst 31 tegn og ingen av disse i arknavn
+_SHEET_MAX = 31
+_SHEET_FORBIDDEN = str.maketrans({c: "_" for c in "[]:*?/\\"})
+
+
+def sheet_title(zone: str, used: set) -> str:
+    """Gyldig og unikt (uten hensyn til store/små bokstaver) arknavn for en kumulesone."""
+    base = (str(zone).translate(_SHEET_FORBIDDEN).strip().strip("'") or "(uten sone)")[:_SHEET_MAX]
+    title, i = base, 1
+    while title.lower() in used:
+        i += 1
+        suffix = f" ({i})"
+        title = base[:_SHEET_MAX - len(suffix)] + suffix
+    used.add(title.lower())
+    return title
+
+
+def included_keys_by_zone(db: Dict[str, Any], default_scenario: str) -> Dict[str, List[str]]:
+    """Kumulesone -> nøklene til de inkluderte risikoene (bare nøkler; recordene hentes per sone)."""
+    if hasattr(db, "frame"):
+        f = db.frame(["kumulesone", "include"], defaults={"kumulesone": "", "include": False})
+        inc = f["include"]
+        mask = inc.to_numpy() if inc.dtype == bool else np.fromiter((bool(v) for v in inc.tolist()), dtype=bool,
+                                                                      count=len(inc))
+        f = f[mask]
+        zones: Dict[str, List[str]] = {}
+        for zone, keys in f.groupby(f["kumulesone"].astype(str), sort=False, observed=True)["_key"]:
+            zones[zone] = keys.tolist()
+        return zones
+    zones = {}
+    for k, r in db.items():
+        if isinstance(r, dict) and bool(r.get("include", False)):
+            zones.setdefault(str(r.get("kumulesone", "")), []).append(k)
+    return zones
+
+
+def _scenario_order(scenario: str) -> Tuple[int, str]:
+    return (SCENARIOS.index(scenario), "") if scenario in SCENARIOS else (len(SCENARIOS), scenario)
+
+
+def write_report(db: Dict[str, Any], out: Any, default_scenario: str = SCENARIOS[0],
+                 cells: Optional[Dict[Tuple[str, str], Dict[str, float]]] = None,
+                 progress: Optional[Callable[[int, int], None]] = None) -> Dict[str, Any]:
+    """Skriv rapporten til ``out`` (filsti eller binært filobjekt).
+
+    ``cells`` er cellene fra akkumuleringsindeksen, (kumulesone, scenario) -> totaler, tatt
+    ut under låsen (``AccumulationIndex.cells``); mangler de, bygges indeksen fra ``db``.
+    ``progress(ferdige, antall)``
+    kalles etter hver kumulesone. Returnerer antall soner, rader og sekunder.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+    from openpyxl.utils import get_column_letter
+
+    t0 = time.perf_counter()
+    if cells is None:
+        cells = AccumulationIndex.build(db, default_scenario).cells()
+    by_zone = included_keys_by_zone(db, default_scenario)
+    zones = sorted(by_zone)
+    used = {SUMMARY_SHEET.lower()}
+    titles = {z: sheet_title(z, used) for z in zones}
+
+    wb = Workbook(write_only=True)
+    bold = Font(bold=True)
+
+    def cell(ws, value: Any, fmt: Optional[str] = None, font: Optional[Font] = None):
+        c = WriteOnlyCell(ws, value=value)
+        if fmt:
+            c.number_format = fmt
+        if font:
+            c.font = font
+        return c
+
+    # ---------- sammendrag ----------
+    ws = wb.create_sheet(SUMMARY_SHEET)
+    ws.freeze_panes = "A2"
+    for j, width in enumerate((30, 10, 12, 18, 18, 12, 30), start=1):
+        ws.column_dimensions[get_column_letter(j)].width = width
+    ws.append([cell(ws, h, font=bold) for h in SUMMARY_COLUMNS])
+    scen_by_zone: Dict[str, List[Tuple[str, Dict[str, float]]]] = {}
+    for (zone, scen), c in cells.items():
+        scen_by_zone.setdefault(zone, []).append((scen, c))
+    total = {"n_inc": 0, "si_inc": 0.0, "eml_inc": 0, "n_manual_inc": 0}
+    for zone in zones:
+        for scen, c in sorted(scen_by_zone.get(zone, []), key=lambda sc: _scenario_order(sc[0])):
+            if not c["n_inc"]:
+                continue
+            for f in total:
+                total[f] += c[f]
+            ws.append([zone, scen, int(c["n_inc"]), cell(ws, float(c["si_inc"]), MONEY_FORMAT),
+                       cell(ws, int(c["eml_inc"]), MONEY_FORMAT), int(c["n_manual_inc"]), titles[zone]])
+    ws.append([cell(ws, "Totalt", font=bold), None, cell(ws, int(total["n_inc"]), font=bold),
+               cell(ws, float(total["si_inc"]), MONEY_FORMAT, bold), cell(ws, int(total["eml_inc"]), MONEY_FORMAT, bold),
+               cell(ws, int(total["n_manual_inc"]), font=bold), None])
+    # Ferdige ark lukkes med en gang (ellers holdes skriveren og temp-filen åpen til save)
+    ws.close()
+
+    # ---------- ett ark per kumulesone ----------
+    rows = 0
+    for i, zone in enumerate(zones, start=1):
+        items = [(k, db[k]) for k in by_zone[zone]]
+        batch = calc_eml_records(r for _, r in items)
+        order = sorted(range(len(items)),
+                       key=lambda j: _scenario_order(str(items[j][1].get("scenario", default_scenario))))
+        ws = wb.create_sheet(titles[zone])
+        ws.freeze_panes = "A2"
+        for j, width in enumerate(ZONE_WIDTHS, start=1):
+            ws.column_dimensions[get_column_letter(j)].width = width
+        ws.append([cell(ws, h, font=bold) for h in ZONE_COLUMNS])
+        rate_m, rate_e, eml = (batch[f].tolist() for f in ("rate_machine", "rate_effective", "eml"))
+        # Formaterte celler gjenbrukes: i write-only-modus skrives raden til fil i append()
+        si_c, rate_m_c, rate_e_c, eml_c = (cell(ws, None, fmt) for fmt in (MONEY_FORMAT, RATE_FORMAT,
+                                                                           RATE_FORMAT, MONEY_FORMAT))
+        for j in order:
+            r = items[j][1]
+            si_c.value, rate_m_c.value, rate_e_c.value, eml_c.value = _si(r), rate_m[j], rate_e[j], int(eml[j])
+            ws.append([
+                str(r.get("scenario", default_scenario)),
+                str(r.get("forsnr", "")),
+                str(r.get("risikonr", "")),
+                str(r.get("kundenavn", "")),
+                str(r.get("adresse", "")),
+                si_c, rate_m_c, rate_e_c, eml_c,
+                "Manuell" if r.get("eml_rate_manual_on") else "Maskinell",
+            ])
+        ws.close()
+        rows += len(items)
+        if progress is not None:
+            progress(i, len(zones))
+
+    wb.save(out)
+    return {"zones": len(zones), "rows": rows, "seconds": time.perf_counter() - t0}
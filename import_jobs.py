@@ -0,0 +1,186 @@
+"""Excel-import som bakgrunnsjobb.
+
+``ImportJobs.submit`` legger en opplastet fil i kø og returnerer en
+``ImportJob`` med én gang; importen kjøres i en egen tråd mens appen kan
+brukes som vanlig. Jobben har id, status, fremdrift (rader lest / flettet
+inn) og kan avbrytes. Resultatet (antall nye/endrede/fjernede og avviste
+rader med årsak) ligger på jobben etter at opplasteren er tømt.
+
+Importer kjøres én om gangen (én arbeidstråd), siden de deler manifestet og
+databasen. Hver bit flettes inn og lagres via ``SharedDatabase.commit``,
+og arbeidskopien følger den delte databasen mellom bitene, så endringer
+andre brukere gjør mens importen pågår, blir ikke overskrevet med gamle verdier.
+
+Med ``snapshots`` (``SnapshotStore``) lagres en versjon etter hver import som
+endret noe, så endringen kan sammenlignes med tidligere versjoner. Versjonen er
+forrige versjon + nøklene importen endret; bare de leses (under låsen) og bare
+bøttene deres skrives.
+"""
+import hashlib
+import io
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from columnar import WriteOverlay
+from excel_import import ImportCancelled, ImportManifest, import_excel
+from schema import ZONES_KEY, zone_table
+
+# Antall jobber (per prosess) som huskes etter at de er ferdige
+KEEP_JOBS = 50
+
+
+class ImportJob:
+    # venter -> kjører -> ferdig | avbrutt | feilet
+    ACTIVE = ("venter", "kjører")
+
+    def __init__(self, filename: str, size: int, remove_missing: bool):
+        self.id = uuid.uuid4().hex[:8]
+        self.filename = filename
+        self.size = size
+        self.remove_missing = remove_missing
+        self.status = "venter"
+        self.rows_total: Optional[int] = None
+        self.rows_parsed = 0
+        self.rows_merged = 0
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.duplicate = False
+        self.error: Optional[str] = None
+        # Versjonen som ble lagret etter importen (med ``snapshots``)
+        self.version: Optional[str] = None
+        self._cancel = threading.Event()
+
+    @property
+    def active(self) -> bool:
+        return self.status in self.ACTIVE
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def fraction(self) -> float:
+        if not self.rows_total:
+            return 0.0
+        return min(self.rows_parsed / self.rows_total, 1.0)
+
+    def seconds(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+
+class ImportJobs:
+    def __init__(self, shared, manifest_path: str, default_scenario: str, per_chunk: bool = True,
+                 snapshots=None):
+        self.shared = shared
+        self.snapshots = snapshots
+        self.manifest_path = manifest_path
+        self.default_scenario = default_scenario
+        # False (snapshot-modus): alt lagres samlet til slutt i stedet for per bit
+        self.per_chunk = per_chunk
+        self._jobs: "OrderedDict[str, ImportJob]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="eml-import")
+
+    def submit(self, data: bytes, filename: str, remove_missing: bool = False) -> ImportJob:
+        job = ImportJob(filename, len(data), remove_missing)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > KEEP_JOBS:
+                oldest = next(iter(self._jobs))
+                if self._jobs[oldest].active:
+                    break
+                del self._jobs[oldest]
+        self._pool.submit(self._run, job, data)
+        return job
+
+    def get(self, job_id: str) -> Optional[ImportJob]:
+        return self._jobs.get(job_id)
+
+    def active(self) -> List[ImportJob]:
+        return [j for j in list(self._jobs.values()) if j.active]
+
+    # ---------- arbeidstråden ----------
+    def _run(self, job: ImportJob, data: bytes) -> None:
+        if job.cancelled():
+            job.status = "avbrutt"
+            job.finished_at = time.time()
+            return
+        job.status = "kjører"
+        job.started_at = time.time()
+        try:
+            self._import(job, data)
+            job.status = "ferdig"
+        except ImportCancelled:
+            job.status = "avbrutt"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "feilet"
+        finally:
+            job.finished_at = time.time()
+
+    def _import(self, job: ImportJob, data: bytes) -> None:
+        shared = self.shared
+        manifest = ImportManifest(self.manifest_path)
+        file_hash = hashlib.md5(data).hexdigest()
+        # Hindre dobbelt-import av samme fil
+        if file_hash == manifest.file_md5:
+            job.duplicate = True
+            return
+        work = WriteOverlay(shared.db)
+
+        def save(keys: List[str]) -> None:
+            shared.commit({k: work.get(k) for k in keys}, replace=True)
+            if self.per_chunk:
+                # Neste bit leser fra den delte databasen slik den er nå
+                work.base, work.own, work.deleted = shared.db, {}, set()
+
+        def progress(done: int, total: Optional[int], merged: int) -> None:
+            job.rows_parsed, job.rows_total, job.rows_merged = done, total, merged
+
+        res = import_excel(
+            io.BytesIO(data), work, default_scenario=self.default_scenario,
+            save=save if self.per_chunk else None, progress=progress,
+            manifest=manifest, remove_missing=job.remove_missing, file_md5=file_hash,
+            cancel=job.cancelled,
+        )
+        if not self.per_chunk:
+            save(res["inserted"] + res["changed"] + res["removed"])
+        # Nye kumulesoner fra uttrekket føres inn i sonetabellen
+        with shared.lock:
+            zones = shared.db.get(ZONES_KEY)
+            table = zone_table(zones, shared.acc.zones())
+        if table != zones:
+            shared.commit({ZONES_KEY: table}, replace=True)
+        # Manifestet lagres først når radene faktisk står på disk
+        if not shared.flush():
+            raise RuntimeError(f"Kunne ikke lagre databasen: {shared.writer.last_error}")
+        manifest.save()
+        job.result = res
+        if self.snapshots is not None and (res["inserted"] or res["changed"] or res["removed"]):
+            job.version = self._snapshot(res, f"Import {job.filename}")
+
+    def _snapshot(self, res: Dict[str, Any], label: str) -> str:
+        """Ny versjon = forrige versjon + nøklene importen endret (lest under låsen).
+
+        Finnes ingen versjon fra før, lagres hele databasen.
+        """
+        shared, snaps = self.shared, self.snapshots
+        with shared.lock:
+            if snaps.latest() is None:
+                data = shared.db.to_dict()
+            else:
+                data = None
+                changes = {k: shared.db.get(k) for k in res["inserted"] + res["changed"] + res["removed"]}
+                meta = {k: shared.db[k] for k in shared.db.meta}
+        if data is not None:
+            return snaps.snapshot(data, label=label)["id"]
+        return snaps.snapshot_changes(changes, meta=meta, label=label)["id"]
@@ -0,0 +1,181 @@
+"""Stokastisk tap per kumulesone (Monte Carlo).
+
+Den deterministiske modellen gir én EML per risiko (SI × effektiv sats). Her
+er satsen i stedet midtpunktet i en fordeling for skadegraden: per hendelse
+trekkes en felles intensitet ``M`` for hele sonen (gamma, snitt 1) og en
+skadegrad per risiko ``B`` (beta med snitt = effektiv sats), og tapet er
+``SI × min(M × B, 1)`` summert over sonen. Spredningen i ``B`` (``kappa``) og
+hvor sterkt risikoene henger sammen (``event_cv``) er satt per scenario.
+
+Hendelsene regnes i biter (høyst ``MAX_CELLS`` risiko×hendelse-verdier per
+bit), og bitene kan fordeles på prosesser. Hver bit har sin egen frødel
+(``SeedSequence.spawn``), så samme frø gir samme resultat uansett antall
+prosesser. ``SimulationCache`` holder resultatene til risikoene i sonen endres.
+"""
+import hashlib
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Any, Dict, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class ScenarioSpread(NamedTuple):
+    # Beta-konsentrasjon rundt satsen (lav = stor spredning per risiko)
+    kappa: float
+    # Variasjonskoeffisient for felles intensitet per hendelse (høy = sterk samvariasjon)
+    event_cv: float
+
+
+# Prototyp-parametre (som BASE/ALPHA/...): brann rammer enkeltbygg, flom og skred hele området
+SCENARIO_SPREAD = {
+    "Brann": ScenarioSpread(kappa=3.0, event_cv=0.4),
+    "Skred": ScenarioSpread(kappa=6.0, event_cv=1.0),
+    "Flom": ScenarioSpread(kappa=8.0, event_cv=0.8),
+    "Annet": ScenarioSpread(kappa=5.0, event_cv=0.6),
+}
+DEFAULT_SPREAD = SCENARIO_SPREAD["Annet"]
+
+DEFAULT_EVENTS = 10_000
+DEFAULT_SEED = 1
+TAIL_LEVEL = 0.995
+# Risiko×hendelse-verdier per bit (float64: 16 MB)
+MAX_CELLS = 2_000_000
+# Under dette (risikoer × hendelser) lønner det seg ikke å starte prosesser
+PARALLEL_MIN_CELLS = 50_000_000
+# Antall soneresultater som holdes i cachen
+CACHE_SIZE = 64
+
+_RATE_EPS = 1e-6
+
+
+def _seed_for(seed: int, zone: str, scenario: str) -> np.random.SeedSequence:
+    # crc32 (ikke hash()): samme frø i alle prosesser og mellom kjøringer
+    return np.random.SeedSequence([int(seed), zlib.crc32(zone.encode("utf-8")), zlib.crc32(scenario.encode("utf-8"))])
+
+
+def _simulate_chunk(si: np.ndarray, a: np.ndarray, b: np.ndarray, event_cv: float, n_events: int,
+                    seed: np.random.SeedSequence) -> np.ndarray:
+    """Tap per hendelse for én bit (kjøres i arbeiderprosessene)."""
+    rng = np.random.default_rng(seed)
+    if event_cv > 0:
+        shape = 1.0 / (event_cv * event_cv)
+        intensity = rng.gamma(shape, 1.0 / shape, size=(n_events, 1))
+    else:
+        intensity = np.ones((n_events, 1))
+    ratio = rng.beta(a, b, size=(n_events, len(si)))
+    np.multiply(ratio, intensity, out=ratio)
+    np.minimum(ratio, 1.0, out=ratio)
+    return ratio @ si
+
+
+def simulate_losses(si: Sequence[float], rate: Sequence[float], scenario: str, zone: str = "",
+                    n_events: int = DEFAULT_EVENTS, seed: int = DEFAULT_SEED,
+                    workers: Optional[int] = 1) -> np.ndarray:
+    """Akkumulert tap per simulert hendelse (float64, lengde ``n_events``).
+
+    ``workers`` > 1 fordeler bitene på prosesser (``None`` = antall kjerner) når
+    simuleringen er stor nok (``PARALLEL_MIN_CELLS``).
+    """
+    si = np.asarray(si, dtype=np.float64)
+    rate = np.clip(np.asarray(rate, dtype=np.float64), _RATE_EPS, 1 - _RATE_EPS)
+    n_events = int(n_events)
+    if not len(si) or n_events <= 0:
+        return np.zeros(max(n_events, 0))
+    spread = SCENARIO_SPREAD.get(scenario, DEFAULT_SPREAD)
+    a, b = rate * spread.kappa, (1 - rate) * spread.kappa
+    per_chunk = max(1, MAX_CELLS // len(si))
+    sizes = [min(per_chunk, n_events - start) for start in range(0, n_events, per_chunk)]
+    seeds = _seed_for(seed, zone, scenario).spawn(len(sizes))
+    workers = min(workers or os.cpu_count() or 1, len(sizes))
+    if workers <= 1 or len(si) * n_events < PARALLEL_MIN_CELLS:
+        parts = [_simulate_chunk(si, a, b, spread.event_cv, n, s) for n, s in zip(sizes, seeds)]
+    else:
+        import multiprocessing
+
+        # spawn: appen har tråder (lagring, import), og fork med tråder kan henge
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            parts = list(pool.map(_simulate_chunk, repeat(si), repeat(a), repeat(b), repeat(spread.event_cv),
+                                  sizes, seeds))
+    return np.concatenate(parts)
+
+
+def tail_metrics(losses: np.ndarray, level: float = TAIL_LEVEL) -> Dict[str, float]:
+    """Snitt, VaR (kvantil ``level``) og TVaR (snitt av tapene fra og med VaR)."""
+    if not len(losses):
+        return {"mean": 0.0, "var": 0.0, "tvar": 0.0, "std": 0.0, "max": 0.0}
+    var = float(np.quantile(losses, level))
+    return {
+        "mean": float(losses.mean()),
+        "var": var,
+        "tvar": float(losses[losses >= var].mean()),
+        "std": float(losses.std()),
+        "max": float(losses.max()),
+    }
+
+
+def simulate_zone(si: Sequence[float], rate: Sequence[float], zone: str, scenario: str,
+                  n_events: int = DEFAULT_EVENTS, seed: int = DEFAULT_SEED,
+                  workers: Optional[int] = 1, level: float = TAIL_LEVEL,
+                  keys: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+    """Simuler én kumulesone × scenario. Returnerer ``tail_metrics`` + ``eml`` (deterministisk
+    sum), ``n`` (antall risikoer), ``events``, ``seed``, ``level``, ``seconds`` og ``losses``.
+
+    Med ``keys`` sorteres risikoene på nøkkel først, så resultatet ikke avhenger av rekkefølgen
+    (appen og ``eml_batch.py`` gir samme tall).
+    """
+    t0 = time.perf_counter()
+    si = np.asarray(si, dtype=np.float64)
+    rate = np.asarray(rate, dtype=np.float64)
+    if keys is not None:
+        order = np.argsort(np.asarray(keys, dtype=object), kind="stable")
+        si, rate = si[order], rate[order]
+    losses = simulate_losses(si, rate, scenario, zone, n_events, seed, workers)
+    return {
+        **tail_metrics(losses, level),
+        "eml": float(np.rint(si * rate).sum()),
+        "n": len(si), "events": int(n_events), "seed": int(seed), "level": level,
+        "seconds": time.perf_counter() - t0, "losses": losses,
+    }
+
+
+def fingerprint(keys: Sequence[str], si: Sequence[float], rate: Sequence[float]) -> str:
+    """Innholdshash av sonens risikoer (nøkler, SI, effektiv sats): endres når en risiko endres."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update("\x1f".join(keys).encode("utf-8"))
+    h.update(np.ascontiguousarray(si, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(rate, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+class SimulationCache:
+    """Soneresultater per (sone, scenario, hendelser, frø, nivå, innholdshash), minst brukt ut først."""
+
+    def __init__(self, size: int = CACHE_SIZE, workers: Optional[int] = None):
+        self.size = size
+        self.workers = workers
+        self._results: "OrderedDict[Tuple[Any, ...], Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, zone: str, scenario: str, keys: Sequence[str], si: Sequence[float], rate: Sequence[float],
+            n_events: int = DEFAULT_EVENTS, seed: int = DEFAULT_SEED, level: float = TAIL_LEVEL) -> Dict[str, Any]:
+        key = (zone, scenario, int(n_events), int(seed), level, fingerprint(keys, si, rate))
+        with self._lock:
+            hit = self._results.get(key)
+            if hit is not None:
+                self._results.move_to_end(key)
+                return hit
+        res = simulate_zone(si, rate, zone, scenario, n_events, seed, self.workers, level, keys=keys)
+        with self._lock:
+            self._results[key] = res
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+        return res
+
+    def __len__(self) -> int:
+        return len(self._results)
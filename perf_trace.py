@@ -0,0 +1,89 @@
+"""Tidtaking per kjøring (rerun) av appen.
+
+``RerunTrace.span(navn, n)`` måler en navngitt del av kjøringen (lasting,
+import, tabellbygging, filter, totaler, rendering, lagring). Når tidtakingen
+er av returnerer ``span`` et felles tomt objekt, så kostnaden er ett
+attributtoppslag og et funksjonskall per span. Med ``profile=True`` kjøres
+hele rerunen under cProfile, og resultatet kan lastes ned som ``.prof``
+(pstats/snakeviz) eller leses som tekst.
+"""
+import cProfile
+import io
+import marshal
+import pstats
+import time
+from typing import Any, Dict, List, Optional
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ("trace", "name", "n", "depth", "t0")
+
+    def __init__(self, trace: "RerunTrace", name: str, n: Optional[int]):
+        self.trace = trace
+        self.name = name
+        self.n = n
+
+    def __enter__(self):
+        self.depth = self.trace._depth
+        self.trace._depth += 1
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        dt = time.perf_counter() - self.t0
+        self.trace._depth -= 1
+        self.trace.spans.append({"span": "  " * self.depth + self.name, "ms": dt * 1000.0,
+                                 "antall": self.n, "_start": self.t0 - self.trace.t0})
+        return False
+
+
+class RerunTrace:
+    def __init__(self, enabled: bool = False, profile: bool = False):
+        self.enabled = enabled or profile
+        self.spans: List[Dict[str, Any]] = []
+        self.total_ms: Optional[float] = None
+        self._depth = 0
+        self._profiler: Optional[cProfile.Profile] = None
+        self.t0 = time.perf_counter()
+        if profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def span(self, name: str, n: Optional[int] = None):
+        """``with trace.span("filter") as s: ...; s.n = len(treff)``"""
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name, n)
+
+    def finish(self) -> Optional[Dict[str, Any]]:
+        """Avslutt kjøringen. Returnerer profilen (``text``/``prof``) hvis den ble tatt opp."""
+        self.total_ms = (time.perf_counter() - self.t0) * 1000.0
+        if self._profiler is None:
+            return None
+        self._profiler.disable()
+        self._profiler.create_stats()
+        prof = marshal.dumps(self._profiler.stats)  # samme format som dump_stats()
+        out = io.StringIO()
+        pstats.Stats(self._profiler, stream=out).sort_stats("cumulative").print_stats(60)
+        self._profiler = None
+        return {"text": out.getvalue(), "prof": prof, "total_ms": self.total_ms}
+
+    def rows(self) -> List[Dict[str, Any]]:
+        """Spans i starttidsrekkefølge (nestede spans er rykket inn)."""
+        return [{k: v for k, v in s.items() if k != "_start"} for s in sorted(self.spans, key=lambda s: s["_start"])]
@@ -0,0 +1,216 @@
+"""Skjema for databasen og migrering fra eldre former.
+
+Versjon 3 (``SCHEMA_VERSION``) er versjon 2 med importnøklene slik dagens
+Excel-import lager dem (se under).
+
+Versjon 2:
+
+* én post per risiko på toppnivå (nøkkel -> dict) med feltnavnene appen
+  bruker (``kumulesone``, ``forsnr``, ``risikonr``, ``kundenavn`` …);
+* ``kumuler``: sonetabellen, ``[{"id": …, "navn": …}]`` sortert på id uten duplikater;
+* ``_schema``: versjonsnummeret.
+
+Versjon 1 (uten ``_schema``) hadde i tillegg speillisten ``risikoer`` med de
+samme risikoene en gang til – fra frøfilen med de gamle feltnavnene
+(``kumule_id``, ``forsikringsnummer``, ``risikonummer``, ``navn``), fra
+skjemaet for manuell registrering med ``_key``. ``migrate`` går gjennom
+databasen én gang: gamle feltnavn byttes ut, risikoer som bare finnes i
+speillisten blir poster, listen fjernes og sonetabellen bygges. ``load``
+migrerer og lagrer resultatet én gang; ``legacy_export`` lager den gamle
+formen igjen for eksport.
+
+Den første Excel-importen skrev tekstfeltene med ``str()`` på pandas-verdier:
+tomme celler ble ``"nan"`` og heltall i en kolonne med tomme celler ``"123.0"``,
+og det gikk inn i nøkkelen ``kumule-risiko-adresse``. Dagens import skriver
+``""`` og ``"123"``, så en ny import av samme uttrekk ville lagt inn alle slike
+risikoer en gang til. Fra versjon 2 til 3 får disse postene tekst og nøkkel i ny
+form (``legacy_import_text``). Finnes den nye nøkkelen allerede (uttrekket er
+importert på nytt før migreringen), beholdes den nye posten; de manuelle valgene
+fra den gamle (``MANUAL_FIELDS``) tas med når den nye ikke er rørt i appen.
+"""
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+SCHEMA_VERSION = 3
+SCHEMA_KEY = "_schema"
+ZONES_KEY = "kumuler"
+MIRROR_KEY = "risikoer"
+
+# Gammelt feltnavn -> feltnavnet appen bruker (gjelder bare når det nye mangler)
+FIELD_ALIASES = {
+    "kumule_id": "kumulesone",
+    "forsikringsnummer": "forsnr",
+    "risikonummer": "risikonr",
+    "navn": "kundenavn",
+}
+LEGACY_NAMES = {new: old for old, new in FIELD_ALIASES.items()}
+
+# Tekstfelt fra Excel-importen, og valgene brukeren gjør i appen
+IMPORT_TEXT_FIELDS = ("kumulesone", "risikonr", "forsnr", "adresse", "kundenavn")
+MANUAL_FIELDS = ("include", "scenario", "eml_rate_manual_on", "eml_rate_manual")
+_LEGACY_INT = re.compile(r"-?\d+\.0")
+
+
+def canonical(rec: Dict[str, Any]) -> Dict[str, Any]:
+    """Posten med feltnavnene appen bruker (samme objekt hvis ingenting endres)."""
+    if not any(f in rec for f in FIELD_ALIASES):
+        return rec
+    out = {}
+    for f, v in rec.items():
+        new = FIELD_ALIASES.get(f, f)
+        if new != f and new in rec:
+            continue
+        out[new] = v
+    return out
+
+
+def record_key(rec: Dict[str, Any]) -> str:
+    """Nøkkel for en risiko uten nøkkel: kumulesone-risikonr-adresse (som Excel-importen)."""
+    return "-".join(str(rec.get(f, "") or "").strip() for f in ("kumulesone", "risikonr", "adresse")).strip("-")
+
+
+def zone_table(rows: Any, extra: Iterable[str] = ()) -> List[Dict[str, str]]:
+    """Sonetabellen fra en ``kumuler``-liste (dicts eller navn) + soner som er i bruk."""
+    zones: Dict[str, str] = {}
+    for z in rows if isinstance(rows, list) else []:
+        if isinstance(z, dict):
+            zid = str(z.get("id", z.get("navn", "")) or "").strip()
+            navn = str(z.get("navn", "") or "").strip() or zid
+        else:
+            zid = navn = str(z or "").strip()
+        if zid:
+            zones.setdefault(zid, navn)
+    for zid in extra:
+        zid = str(zid or "").strip()
+        if zid:
+            zones.setdefault(zid, zid)
+    return [{"id": zid, "navn": zones[zid]} for zid in sorted(zones)]
+
+
+def legacy_import_text(v: Any) -> Any:
+    """Tekst fra den første importen i dagens form: ``"nan"`` -> ``""``, ``"123.0"`` -> ``"123"``."""
+    if not isinstance(v, str):
+        return v
+    if v == "nan":
+        return ""
+    return v[:-2] if _LEGACY_INT.fullmatch(v) else v
+
+
+def _import_key(rec: Dict[str, Any]) -> str:
+    return f"{rec.get('kumulesone', '')}-{rec.get('risikonr', '')}-{rec.get('adresse', '')}".strip("-")
+
+
+def _untouched(rec: Dict[str, Any]) -> bool:
+    return not rec.get("include") and not rec.get("eml_rate_manual_on")
+
+
+def rekey_legacy_import(db: Dict[str, Any], report: Dict[str, int]) -> Dict[str, Any]:
+    """Poster fra den første Excel-importen med tekst og nøkkel i dagens form (ny dict)."""
+    out: Dict[str, Any] = {}
+    moved: Dict[str, Dict[str, Any]] = {}
+    zones: Dict[str, str] = {}
+    for k, v in db.items():
+        if isinstance(v, dict) and k == _import_key(v):
+            new = {f: legacy_import_text(x) if f in IMPORT_TEXT_FIELDS else x for f, x in v.items()}
+            if new != v:
+                zones[str(v.get("kumulesone", ""))] = str(new.get("kumulesone", ""))
+                moved[_import_key(new)] = new
+                continue
+        out[k] = v
+    for k, old in moved.items():
+        cur: Optional[Dict[str, Any]] = out.get(k) if isinstance(out.get(k), dict) else None
+        if cur is None:
+            out[k] = old
+            report["rekeyed"] += 1
+        else:
+            if _untouched(cur):
+                out[k] = {**cur, **{f: old[f] for f in MANUAL_FIELDS if f in old}}
+            report["merged"] += 1
+    table = out.get(ZONES_KEY)
+    if zones and isinstance(table, list):
+        out[ZONES_KEY] = zone_table([{"id": zones.get(str(z.get("id")), z.get("id")),
+                                      "navn": zones.get(str(z.get("navn")), z.get("navn"))}
+                                     if isinstance(z, dict) else zones.get(str(z), z) for z in table])
+    return out
+
+
+def version_of(db: Dict[str, Any]) -> int:
+    v = db.get(SCHEMA_KEY)
+    return v if isinstance(v, int) else 1
+
+
+def migrate(db: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, int]]:
+    """Databasen i skjema ``SCHEMA_VERSION`` + hva som ble gjort.
+
+    Rapporten har ``from`` (versjonen før), ``renamed`` (poster med gamle feltnavn),
+    ``mirror`` (oppføringer i speillisten), ``added`` (av dem som ble nye poster),
+    ``rekeyed`` (importposter skrevet om til dagens tekst og nøkkel), ``merged``
+    (importposter der den nye nøkkelen alt fantes, slått sammen med den posten) og ``zones``. En database som allerede er i gjeldende
+    versjon, returneres uendret uten gjennomgang; ``changed`` sier om noe må lagres.
+    """
+    report = {"from": version_of(db), "renamed": 0, "mirror": 0, "added": 0, "rekeyed": 0, "merged": 0,
+              "zones": 0, "changed": False}
+    if report["from"] >= SCHEMA_VERSION and MIRROR_KEY not in db:
+        return db, report
+    if report["from"] >= 2 and MIRROR_KEY not in db:
+        out = rekey_legacy_import(db, report)
+        out[ZONES_KEY] = zone_table(out.get(ZONES_KEY))
+        out[SCHEMA_KEY] = SCHEMA_VERSION
+        report["zones"] = len(out[ZONES_KEY])
+        report["changed"] = True
+        return out, report
+
+    out: Dict[str, Any] = {}
+    used: set = set()
+    for k, v in db.items():
+        if k in (MIRROR_KEY, ZONES_KEY, SCHEMA_KEY):
+            continue
+        if isinstance(v, dict):
+            rec = canonical(v)
+            report["renamed"] += rec is not v
+            used.add(str(rec.get("kumulesone", "") or ""))
+            v = rec
+        out[k] = v
+
+    mirror = db.get(MIRROR_KEY)
+    for entry in mirror if isinstance(mirror, list) else []:
+        if not isinstance(entry, dict):
+            continue
+        report["mirror"] += 1
+        rec = canonical(entry)
+        key = str(rec.get("_key") or "") or record_key(rec)
+        # Posten på toppnivå er den appen har vist og endret; den vinner
+        if not key or key in out:
+            continue
+        out[key] = {f: v for f, v in rec.items() if f != "_key"}
+        used.add(str(out[key].get("kumulesone", "") or ""))
+        report["added"] += 1
+
+    out[ZONES_KEY] = zone_table(db.get(ZONES_KEY), used)
+    out = rekey_legacy_import(out, report)
+    out[SCHEMA_KEY] = SCHEMA_VERSION
+    report["zones"] = len(out[ZONES_KEY])
+    report["changed"] = True
+    return out, report
+
+
+def load(store) -> Tuple[Dict[str, Any], Dict[str, int]]:
+    """``store.load()`` migrert til gjeldende skjema; migreringen lagres én gang."""
+    db, report = migrate(store.load() or {})
+    if report["changed"]:
+        store.write_snapshot(db)
+    return db, report
+
+
+def legacy_export(db: Dict[str, Any]) -> Dict[str, Any]:
+    """Den gamle formen (versjon 1): postene + speillisten ``risikoer`` med gamle feltnavn + ``kumuler``."""
+    out: Dict[str, Any] = {}
+    mirror = []
+    for k, v in db.items():
+        if k in (SCHEMA_KEY, ZONES_KEY):
+            continue
+        out[k] = v
+        if isinstance(v, dict):
+            mirror.append({**{LEGACY_NAMES.get(f, f): x for f, x in v.items()}, "_key": k})
+    zones = db.get(ZONES_KEY)
+    return {MIRROR_KEY: mirror, ZONES_KEY: zones if isinstance(zones, list) else [], **out}
@@ -0,0 +1,172 @@
+"""Trigram-indeks for tekstfiltrene (kunde, adresse, kumulesone).
+
+Hver tekst normaliseres med ``casefold`` (Æ/Ø/Å -> æ/ø/å; bokstavene beholdes,
+ingen fjerning av aksenter) og deles i trigrammer. Et søk slår opp
+posting-listene for trigrammene i søketeksten, tar snittet og verifiserer
+kandidatene med samme regel som ``Series.str.contains(q, case=False)``
+(regex med IGNORECASE). Resultatet blir dermed identisk med et fullt søk,
+men uten å gå gjennom alle rader.
+
+Søk med regex-spesialtegn eller kortere enn tre tegn gjøres som skann.
+Med ``SearchIndex.deferred`` bygges indeksen først ved første søk.
+"""
+import re
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+# Felt i databasen som kan filtreres
+SEARCH_FIELDS = {
+    "kunde": "kundenavn",
+    "adresse": "adresse",
+    "kumule": "kumulesone",
+}
+
+_REGEX_META = set(".^$*+?{}[]\\|()")
+
+# Posting-lister komprimeres når andelen døde rad-id-er blir for stor
+_COMPACT_DEAD_RATIO = 0.5
+
+
+def normalize(text: str) -> str:
+    return text.casefold()
+
+
+def trigrams(norm: str) -> Set[str]:
+    return {norm[i:i + 3] for i in range(len(norm) - 2)}
+
+
+def is_literal(query: str) -> bool:
+    return not any(c in _REGEX_META for c in query)
+
+
+class TrigramIndex:
+    """Substring-indeks for ett felt. Rad-id-er er stigende heltall; endrede
+    poster får ny id og den gamle markeres som død."""
+
+    def __init__(self):
+        self._postings: Dict[str, array] = {}
+        self._key_of: List[Optional[str]] = []   # rad-id -> nøkkel (None = død)
+        self._text_of: List[str] = []            # rad-id -> original tekst
+        self._id_of: Dict[str, int] = {}         # nøkkel -> levende rad-id
+        self._dead = 0
+
+    def __len__(self) -> int:
+        return len(self._id_of)
+
+    def add(self, key: str, text: str) -> None:
+        old = self._id_of.get(key)
+        if old is not None:
+            if self._text_of[old] == text:
+                return
+            self.remove(key)
+        rid = len(self._key_of)
+        self._key_of.append(key)
+        self._text_of.append(text)
+        self._id_of[key] = rid
+        for g in trigrams(normalize(text)):
+            lst = self._postings.get(g)
+            if lst is None:
+                lst = self._postings[g] = array("l")
+            lst.append(rid)
+
+    def remove(self, key: str) -> None:
+        rid = self._id_of.pop(key, None)
+        if rid is None:
+            return
+        self._key_of[rid] = None
+        self._text_of[rid] = ""
+        self._dead += 1
+        if self._dead > _COMPACT_DEAD_RATIO * max(len(self._key_of), 1) and self._dead > 1000:
+            self._compact()
+
+    def _compact(self) -> None:
+        live = [(k, self._text_of[rid]) for k, rid in self._id_of.items()]
+        self.__init__()
+        for k, t in live:
+            self.add(k, t)
+
+    def search(self, query: str) -> Set[str]:
+        """Nøkler der feltet matcher ``query`` som ``str.contains(query, case=False)``."""
+        rx = re.compile(query, flags=re.IGNORECASE)
+        norm = normalize(query)
+        grams = trigrams(norm) if is_literal(query) else set()
+        if grams and all(g in self._postings for g in grams):
+            lists = sorted((self._postings[g] for g in grams), key=len)
+            cand = set(lists[0])
+            for lst in lists[1:]:
+                cand.intersection_update(lst)
+                if not cand:
+                    break
+        elif grams:
+            return set()  # et trigram som ikke finnes i noen tekst
+        else:
+            cand = self._id_of.values()
+        out = set()
+        for rid in cand:
+            key = self._key_of[rid]
+            if key is not None and rx.search(self._text_of[rid]):
+                out.add(key)
+        return out
+
+
+class SearchIndex:
+    """Trigram-indekser for alle ``SEARCH_FIELDS``."""
+
+    def __init__(self):
+        self.fields = {name: TrigramIndex() for name in SEARCH_FIELDS}
+        # Databasen indeksen skal bygges fra ved første søk (``deferred``)
+        self._pending: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def build(cls, db: Dict[str, Any]) -> "SearchIndex":
+        idx = cls()
+        idx._fill(db)
+        return idx
+
+    @classmethod
+    def deferred(cls, db: Dict[str, Any]) -> "SearchIndex":
+        """Bygges fra ``db`` (eller nyeste ``db`` fra ``update_many``) først ved første søk."""
+        idx = cls()
+        idx._pending = db
+        return idx
+
+    def _fill(self, db: Dict[str, Any]) -> None:
+        if hasattr(db, "frame"):
+            # Kolonnelager: les feltene som kolonner i stedet for å materialisere hver risiko
+            f = db.frame(SEARCH_FIELDS.values(), defaults=dict.fromkeys(SEARCH_FIELDS.values(), ""))
+            keys = f["_key"].tolist()
+            for name, field in SEARCH_FIELDS.items():
+                for k, v in zip(keys, f[field].tolist()):
+                    self.fields[name].add(k, str(v))
+        else:
+            self.update_many(db, db.keys())
+
+    def update_many(self, db: Dict[str, Any], keys: Iterable[str]) -> None:
+        if self._pending is not None:
+            self._pending = db
+            return
+        for k in keys:
+            r = db.get(k)
+            for name, field in SEARCH_FIELDS.items():
+                if isinstance(r, dict):
+                    self.fields[name].add(k, str(r.get(field, "")))
+                else:
+                    self.fields[name].remove(k)
+
+    def filter(self, **queries: str) -> Optional[Set[str]]:
+        """Snitt av treff for ikke-tomme filtre (``kunde=``, ``adresse=``, ``kumule=``).
+
+        Returnerer None når ingen filtre er satt.
+        """
+        if self._pending is not None and any(queries.values()):
+            db, self._pending = self._pending, None
+            self._fill(db)
+        result: Optional[Set[str]] = None
+        for name, q in queries.items():
+            if not q:
+                continue
+            hits = self.fields[name].search(q)
+            result = hits if result is None else (result & hits)
+            if not result:
+                return set()
+        return result
@@ -0,0 +1,218 @@
+"""JSON inn/ut for databasen, journalen og eksportfilene.
+
+``dumps``/``loads`` bruker orjson når den er installert (flere ganger raskere
+enn ``json`` og gir UTF-8-bytes direkte), og faller tilbake til ``json`` for
+verdier orjson ikke tar (ikke-str-nøkler, heltall over 64 bit) og for eldre
+filer med ``NaN``/``Infinity``.
+
+Eksport lages først når brukeren ber om den (``export_bytes``), som ren JSON,
+gzip- eller zstd-komprimert JSON eller Parquet (én rad per risiko, krever
+pyarrow), eller som JSON i den gamle formen med ``risikoer``-listen
+(``schema.legacy_export``). ``import_bytes`` kjenner igjen formatet på de første bytene, så
+samme opplaster tar alle.
+"""
+import gzip
+import io
+import json
+from typing import Any, Dict, List, Optional
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson står i requirements.txt
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_PARQUET_MAGIC = b"PAR1"
+
+
+# ==========================================================
+# JSON
+# ==========================================================
+def dumps(obj: Any, indent: bool = False) -> bytes:
+    """``obj`` som UTF-8 JSON (``indent=True``: to mellomrom, som snapshotet)."""
+    if orjson is not None:
+        opt = orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_INDENT_2 if indent else 0)
+        try:
+            return orjson.dumps(obj, option=opt)
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
+
+def loads(raw: Any) -> Any:
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except ValueError:
+            pass  # f.eks. NaN skrevet av json.dumps – prøv standardbiblioteket
+    if isinstance(raw, (bytes, bytearray, memoryview)):
+        raw = bytes(raw).decode("utf-8")
+    return json.loads(raw)
+
+
+def load_file(path: str) -> Any:
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+
+# ==========================================================
+# Eksport / import
+# ==========================================================
+# format -> (visningsnavn, filendelse, MIME-type)
+EXPORT_FORMATS: Dict[str, tuple] = {
+    "json": ("JSON", ".json", "application/json"),
+    "json.gz": ("JSON (gzip)", ".json.gz", "application/gzip"),
+    "json.zst": ("JSON (zstd)", ".json.zst", "application/zstd"),
+    "parquet": ("Parquet (én rad per risiko)", ".parquet", "application/vnd.apache.parquet"),
+    "json.v1": ("JSON (gammel form med risikoer-liste)", ".json", "application/json"),
+}
+
+
+def _has_pyarrow() -> bool:
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def available_export_formats() -> List[str]:
+    """Formatene som kan lages her (zstd og Parquet krever valgfrie pakker)."""
+    out = ["json", "json.gz"]
+    if zstandard is not None:
+        out.append("json.zst")
+    if _has_pyarrow():
+        out.append("parquet")
+    out.append("json.v1")
+    return out
+
+
+def _plain(db: Any) -> Dict[str, Any]:
+    return db.to_dict() if hasattr(db, "to_dict") else db
+
+
+def export_bytes(db: Any, fmt: str = "json") -> bytes:
+    """Hele databasen i valgt format (se ``EXPORT_FORMATS``)."""
+    if fmt == "json":
+        return dumps(_plain(db), indent=True)
+    if fmt == "json.gz":
+        # Kompakt JSON (uten innrykk) komprimerer både raskere og bedre
+        return gzip.compress(dumps(_plain(db)), compresslevel=6, mtime=0)
+    if fmt == "json.zst":
+        if zstandard is None:
+            raise RuntimeError("zstd-eksport krever pakken 'zstandard'")
+        return zstandard.ZstdCompressor(level=10).compress(dumps(_plain(db)))
+    if fmt == "parquet":
+        return _parquet_bytes(db)
+    if fmt == "json.v1":
+        from schema import legacy_export
+
+        return dumps(legacy_export(_plain(db)), indent=True)
+    raise ValueError(f"Ukjent eksportformat: {fmt}")
+
+
+def import_bytes(raw: bytes) -> Dict[str, Any]:
+    """Les en eksport (JSON, .json.gz, .json.zst eller Parquet) tilbake til en dict."""
+    raw = bytes(raw)
+    if raw.startswith(_GZIP_MAGIC):
+        raw = gzip.decompress(raw)
+    elif raw.startswith(_ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError("Filen er zstd-komprimert; installer pakken 'zstandard'")
+        raw = zstandard.ZstdDecompressor().decompressobj().decompress(raw)
+    elif raw.startswith(_PARQUET_MAGIC):
+        return _from_parquet(raw)
+    data = loads(raw)
+    if not isinstance(data, dict):
+        raise ValueError("Filen må være et JSON-objekt (dict)")
+    return data
+
+
+# ==========================================================
+# Parquet
+# ==========================================================
+# Faste kolonner; verdier av annen type (og ukjente felt) legges som JSON i "_extra".
+# Toppnivåverdier som ikke er risikoer (kumuler, _schema) blir rader med _meta = true.
+def _parquet_columns():
+    import pyarrow as pa
+
+    from columnar import CATEGORY_FIELDS, FIELD_ORDER, FLAG_FIELDS, FLOAT_FIELDS, INT8_FIELDS
+
+    def fits(kind: str, v: Any) -> bool:
+        if kind == "bool":
+            return isinstance(v, bool)
+        if isinstance(v, bool):
+            return False
+        if kind == "int":
+            return isinstance(v, int) and -2**63 <= v < 2**63
+        if kind == "float":
+            return isinstance(v, (int, float))
+        return isinstance(v, str)
+
+    types = {
+        **{f: ("str", pa.string()) for f in CATEGORY_FIELDS},
+        **{f: ("float", pa.float64()) for f in FLOAT_FIELDS},
+        **{f: ("int", pa.int64()) for f in INT8_FIELDS},
+        **{f: ("bool", pa.bool_()) for f in FLAG_FIELDS},
+        "updated": ("str", pa.string()),
+    }
+    return [(f, *types[f]) for f in FIELD_ORDER], fits
+
+
+def _parquet_bytes(db: Any) -> bytes:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns, fits = _parquet_columns()
+    known = {f: kind for f, kind, _ in columns}
+    keys: List[str] = []
+    values: Dict[str, List[Any]] = {f: [] for f, _, _ in columns}
+    extra: List[Optional[str]] = []
+    is_meta: List[bool] = []
+    for k, rec in db.items():
+        keys.append(k)
+        is_meta.append(not isinstance(rec, dict))
+        if is_meta[-1]:
+            for lst in values.values():
+                lst.append(None)
+            extra.append(dumps(rec).decode("utf-8"))
+            continue
+        rest = {f: v for f, v in rec.items() if f not in known or not fits(known[f], v)}
+        for f, lst in values.items():
+            lst.append(None if f in rest else rec.get(f))
+        extra.append(dumps(rest).decode("utf-8") if rest else None)
+
+    arrays = [pa.array(keys, pa.string())]
+    arrays += [pa.array(values[f], typ) for f, _, typ in columns]
+    arrays += [pa.array(extra, pa.string()), pa.array(is_meta, pa.bool_())]
+    table = pa.Table.from_arrays(arrays, names=["_key", *values, "_extra", "_meta"])
+    buf = io.BytesIO()
+    # Tekstkolonnene gjentas mye og ordbokkodes av Parquet; zstd hvis tilgjengelig
+    pq.write_table(table, buf, compression="zstd" if pa.Codec.is_available("zstd") else "snappy")
+    return buf.getvalue()
+
+
+def _from_parquet(raw: bytes) -> Dict[str, Any]:
+    import pyarrow.parquet as pq
+
+    cols = pq.read_table(io.BytesIO(raw)).to_pydict()
+    keys = cols.pop("_key")
+    extra = cols.pop("_extra", [None] * len(keys))
+    is_meta = cols.pop("_meta", [False] * len(keys))
+    fields = list(cols.items())
+    db: Dict[str, Any] = {}
+    for i, k in enumerate(keys):
+        if is_meta[i]:
+            db[k] = loads(extra[i])
+            continue
+        rec = {f: vals[i] for f, vals in fields if vals[i] is not None}
+        if extra[i]:
+            rec.update(loads(extra[i]))
+        db[k] = rec
+    return db
@@ -0,0 +1,201 @@
+"""Én delt database per prosess for alle Streamlit-sesjoner.
+
+``SharedDatabase`` holder databasen (som ``ColumnarRecords``), akkumulerings- og
+søkeindeksen én gang i minnet (appen henter den via ``st.cache_resource``).
+Lesere bruker ``db`` uten lås; postene endres aldri på stedet. Skriving går via
+``commit`` under lås:
+
+* hver post får et versjonsnummer (generasjonen den sist ble skrevet i), og en
+  sesjon som skriver poster som er endret etter at den leste dem (``read_at``),
+  får ``ConflictError`` i stedet for å overskrive den andre brukerens endring;
+* endrede poster skrives som nye rader, og når nøkler legges til eller slettes
+  publiseres en ny instans (``fork``), slik at en sesjon som itererer over sin
+  ``db`` aldri ser den endre størrelse underveis;
+* endringen gjelder i minnet med en gang og skrives til disk av ``writer``
+  (``WriteBehind``), som samler raske endringer i én skriving i bakgrunnen.
+
+``refresh`` laster filen på nytt bare når signaturen (mtime/størrelse, for
+SQLite ``data_version``) er endret av noen andre enn denne prosessen, og aldri
+mens egne endringer venter på å bli skrevet. Når store kompakterer journalen
+selv, meldes den nye signaturen hit (``add_compaction_listener``). Ved lasting går databasen gjennom
+``schema.load`` (se ``schema``), så eldre filer migreres før de leses inn.
+
+Med ``column_path`` (JSON-lagring) åpnes databasen ved oppstart fra den binære
+kolonnefilen (``column_file``) når den stemmer med filene på disk, og skrives
+dit etter en lasting fra JSON. ``load_stats`` har hvor lang tid oppstarten tok.
+Søkeindeksen bygges først ved første tekstsøk.
+"""
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+import column_file
+import schema
+from accumulation import AccumulationIndex
+from columnar import ColumnarRecords
+from search_index import SearchIndex
+from write_behind import DEFAULT_DELAY, WriteBehind
+
+
+def _applied(db: ColumnarRecords, new_vals: Dict[str, Any]) -> ColumnarRecords:
+    for k, v in new_vals.items():
+        if v is None:
+            db.pop(k, None)
+        else:
+            db[k] = v
+    return db
+
+
+class ConflictError(Exception):
+    """Postene er endret av en annen sesjon/prosess etter at de ble lest."""
+
+    def __init__(self, keys: List[str]):
+        super().__init__(f"{len(keys)} poster er endret av en annen bruker: {', '.join(keys[:5])}")
+        self.keys = keys
+
+
+class SharedDatabase:
+    def __init__(self, store, default_scenario: str, snapshot_mode: bool = False,
+                 write_delay: float = DEFAULT_DELAY, column_path: Optional[str] = None):
+        self.store = store
+        self.default_scenario = default_scenario
+        # True: hele databasen skrives ved hver commit (STORAGE_MODE = "snapshot")
+        self.snapshot_mode = snapshot_mode
+        self.lock = threading.RLock()
+        self.generation = 0
+        self.versions: Dict[str, int] = {}
+        self._sig = store.signature()
+        t0 = time.perf_counter()
+        self.load_stats: Dict[str, Any] = {"source": "lager", "journal_entries": 0, "column_error": None}
+        opened = column_file.open_current(store, column_path) if column_path else None
+        if opened is not None and schema.version_of(opened[0].meta) < schema.SCHEMA_VERSION:
+            # Skrevet før en skjemaendring: JSON lastes og migreres, kolonnefilen skrives på nytt
+            opened = None
+        if opened is not None:
+            self.db, self.load_stats["journal_entries"] = opened
+            self.load_stats["source"] = "kolonnefil"
+        else:
+            # Poster som skrives mens vi laster, legges oppå kolonnefilen neste gang (samme verdier)
+            stamp = store.stamp() if column_path else None
+            # Eldre databaser (speilliste, gamle feltnavn) migreres og lagres én gang her
+            data, migration = schema.load(store)
+            if migration["changed"]:
+                self._sig = store.signature()
+                stamp = store.stamp() if column_path else None
+            self.db = ColumnarRecords.from_mapping(data)
+            if column_path:
+                try:
+                    column_file.write(self.db, column_path, stamp)
+                except OSError as e:
+                    # Kolonnefilen er bare en hurtigbuffer; neste oppstart laster JSON igjen
+                    self.load_stats["column_error"] = str(e)
+        t1 = time.perf_counter()
+        self.acc = AccumulationIndex.build(self.db, default_scenario)
+        self.search = SearchIndex.deferred(self.db)
+        self.load_stats.update(load_s=t1 - t0, index_s=time.perf_counter() - t1, n=len(self.db))
+        self.writer = WriteBehind(self._write, delay=write_delay)
+        if hasattr(store, "add_compaction_listener"):
+            store.add_compaction_listener(self._compacted)
+
+    # ---------- lesing ----------
+    def version(self, key: str) -> int:
+        return self.versions.get(key, 0)
+
+    def changed_since(self, generation: int) -> List[str]:
+        """Nøklene som er skrevet eller slettet etter ``generation``. Kalles under ``lock``."""
+        return [k for k, g in self.versions.items() if g > generation]
+
+    def refresh(self) -> bool:
+        """Last på nytt hvis filen er endret utenfra. Returnerer True ved ny lasting."""
+        if self.store.signature() == self._sig or self.writer.pending():
+            return False
+        with self.lock:
+            sig = self.store.signature()
+            if sig == self._sig or self.writer.pending():
+                return False
+            data, migration = schema.load(self.store)
+            if migration["changed"]:
+                sig = self.store.signature()
+            old, new = self.db, ColumnarRecords.from_mapping(data)
+            changed = [k for k in old.keys() | new.keys() if old.get(k) != new.get(k)]
+            self._publish(new, changed)
+            self._sig = sig
+            return True
+
+    # ---------- skriving ----------
+    def commit(self, patches: Dict[str, Optional[Dict[str, Any]]], read_at: Optional[int] = None,
+               replace: bool = False, own: Optional[Dict[str, int]] = None) -> int:
+        """Skriv endringer og returner ny generasjon (lagres på disk i bakgrunnen).
+
+        ``patches``: nøkkel -> felt som endres (``None`` = slett). Med ``replace=True``
+        er verdien hele den nye posten (også for ikke-dict-verdier som ``kumuler``).
+        ``read_at``: generasjonen sesjonen leste i; ``None`` hopper over kontrollen.
+        ``own``: sesjonens egne skrivinger (nøkkel -> versjon), oppdateres her, slik at
+        en sesjon ikke får konflikt med sin egen forrige lagring.
+        """
+        if not patches:
+            return self.generation
+        with self.lock:
+            if read_at is not None:
+                own = own if own is not None else {}
+                conflicts = [k for k in patches
+                             if self.versions.get(k, 0) > read_at and self.versions[k] != own.get(k)]
+                if conflicts:
+                    raise ConflictError(conflicts)
+            old = self.db
+            new_vals: Dict[str, Any] = {}
+            for k, p in patches.items():
+                if p is None or replace:
+                    new_vals[k] = p
+                elif isinstance(old.get(k), dict):
+                    new_vals[k] = {**old[k], **p}
+                # (feltendringer for en post som ikke finnes lenger hoppes over)
+            if not new_vals:
+                return self.generation
+            resized = any(v is None or k not in old for k, v in new_vals.items())
+            db = _applied(old.fork() if resized else old, new_vals)
+            if db.needs_compaction():
+                db = db.compacted()
+            self._publish(db, new_vals.keys())
+            self.writer.mark(new_vals)
+            if own is not None:
+                own.update(dict.fromkeys(new_vals, self.generation))
+            return self.generation
+
+    def flush(self) -> bool:
+        """Skriv ventende endringer nå (f.eks. før importmanifestet lagres)."""
+        return self.writer.flush()
+
+    def _write(self, batch: Dict[str, Any]) -> None:
+        """Kalles av ``writer`` (bakgrunnstråd eller ``flush``) med alt som er samlet opp."""
+        # Har noen andre skrevet siden vi sist leste/skrev, må refresh() fortsatt se det
+        external = self.store.signature() != self._sig
+        if self.snapshot_mode:
+            with self.lock:
+                db = self.db
+            self.store.write_snapshot(db.to_dict())
+        else:
+            self.store.append({k: v for k, v in batch.items() if v is not None},
+                              [k for k, v in batch.items() if v is None])
+        if not external:
+            # Egne skrivinger skal ikke utløse refresh()
+            with self.lock:
+                self._sig = self.store.signature()
+
+    def _compacted(self, before: tuple, after: tuple) -> None:
+        """Store har kompaktert journalen selv; det er ingen endring utenfra.
+
+        Kalles under store-låsen (uten ``self.lock``, se ``add_compaction_listener``).
+        Var vi à jour før kompakteringen, er vi det etterpå også.
+        """
+        if self._sig == before:
+            self._sig = after
+
+    def _publish(self, db: Dict[str, Any], keys: Iterable[str]) -> None:
+        keys = list(keys)
+        self.generation += 1
+        for k in keys:
+            self.versions[k] = self.generation
+        self.db = db
+        self.acc.update_many(db, keys)
+        self.search.update_many(db, keys)
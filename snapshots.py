@@ -0,0 +1,398 @@
+"""Versjonerte øyeblikksbilder av databasen med billige differ mellom versjoner.
+
+Lageret er innholdsadressert: risikoene fordeles på ``FANOUT**2`` bøtter etter
+``crc32(nøkkel)``, hver bøtte lagres som ett objekt (zlib-komprimert JSON) med
+blake2b av innholdet som navn, og ``FANOUT`` kataloger lister bøttene sine.
+En versjon er en liten manifestfil med katalogene. Uendrede bøtter og
+kataloger deles mellom versjoner, så en ny versjon koster bare de bøttene som
+er endret siden forrige – lageret vokser med endringene, ikke med porteføljen.
+
+``snapshot_changes`` lager en ny versjon fra forrige versjon + et sett endrede
+nøkler (en import): bare bøttene nøklene ligger i leses og skrives, så det
+koster det samme som endringen, ikke som porteføljen.
+
+Diffen mellom to versjoner sammenligner katalog- og bøttehasher og leser bare
+bøttene som er forskjellige. Mot gjeldende database brukes ``LiveTree``:
+bøttehashene for databasen i minnet, bygget én gang og deretter oppdatert for
+nøklene som endres. Bare risikoene som faktisk er endret regnes om
+(``calc_eml_records``), og differansen summeres per kumulesone × scenario som
+ΔSI, ΔSI/ΔEML/Δantall for inkluderte og antall endrede risikoer.
+
+Mappestruktur (``root``)::
+
+    objects/ab/cdef…     bøtter, kataloger og biter av meta-lister
+    versions/00001.json  manifest: id, tidspunkt, etikett, kataloger, meta
+"""
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+from hashlib import blake2b
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from accumulation import _si
+from eml_engine import calc_eml_records
+from serialization import dumps, loads
+from storage import atomic_write_bytes
+
+# Kataloger per versjon og bøtter per katalog (4096 bøtter: ~75 risikoer per bøtte ved 300k)
+FANOUT = 64
+# Meta-lister (som ``kumuler``) deles i biter så en liste som bare vokser deler de første bitene
+META_CHUNK = 512
+# Objekter (uforanderlige) som holdes i minnet
+OBJECT_CACHE = 8192
+# Sortering i top_movers
+MOVER_KEY = "d_eml_inc"
+
+
+def now_iso() -> str:
+    return datetime.utcnow().isoformat(timespec="seconds") + "Z"
+
+
+def _hash(raw: bytes) -> str:
+    return blake2b(raw, digest_size=12).hexdigest()
+
+
+def _bucket(key: str) -> int:
+    return zlib.crc32(key.encode("utf-8")) % (FANOUT * FANOUT)
+
+
+def _split(db: Any) -> Tuple[List[List[Tuple[str, Dict[str, Any]]]], Dict[str, Any]]:
+    """Risikoene fordelt på bøtter (sortert på nøkkel) + toppnivåverdier som ikke er risikoer."""
+    buckets: List[List[Tuple[str, Dict[str, Any]]]] = [[] for _ in range(FANOUT * FANOUT)]
+    meta: Dict[str, Any] = {}
+    for k, v in db.items():
+        if isinstance(v, dict):
+            buckets[_bucket(k)].append((k, v))
+        else:
+            meta[k] = v
+    for b in buckets:
+        b.sort(key=lambda kv: kv[0])
+    return buckets, meta
+
+
+def _bucket_rows(records: Dict[str, Dict[str, Any]]) -> list:
+    """Innholdet i en bøtte (sortert på nøkkel), slik det lagres."""
+    return [[k, records[k]] for k in sorted(records)]
+
+
+class _Tree:
+    """Databasen som objekter (hash -> rå JSON) + katalog- og meta-hasher, før noe skrives.
+
+    Med ``db=None`` er treet tomt og brukes bare til å samle nye objekter.
+    """
+
+    def __init__(self, db: Any = None):
+        self.objects: Dict[str, bytes] = {}
+        self.bucket_hashes: List[Optional[str]] = []
+        self.n_records = 0
+        self.dirs: List[str] = []
+        self.meta: Dict[str, Any] = {}
+        if db is None:
+            return
+        buckets, meta = _split(db)
+        self.n_records = sum(len(b) for b in buckets)
+        for b in buckets:
+            self.bucket_hashes.append(self._put([[k, v] for k, v in b]) if b else None)
+        self.dirs = [self._put(self.bucket_hashes[d * FANOUT:(d + 1) * FANOUT]) for d in range(FANOUT)]
+        self.meta = {k: self.meta_ref(v) for k, v in meta.items()}
+
+    def meta_ref(self, v: Any) -> Dict[str, Any]:
+        if isinstance(v, list):
+            return {"list": [self._put(v[i:i + META_CHUNK]) for i in range(0, len(v), META_CHUNK)]}
+        return {"value": self._put(v)}
+
+    def _put(self, obj: Any) -> str:
+        raw = dumps(obj)
+        h = _hash(raw)
+        self.objects.setdefault(h, raw)
+        return h
+
+
+class LiveTree:
+    """Bøtte- og katalog-hasher for databasen i minnet, for diff mot «nå».
+
+    Bygges én gang fra hele databasen; ``update`` regner deretter om bare
+    bøttene der nøklene er endret. Holder nøklene per bøtte, ikke innholdet –
+    bøttene som er forskjellige i en diff, leses fra databasen (``bucket``).
+    ``generation`` er generasjonen treet sist ble oppdatert til (settes av kalleren).
+    Ikke trådsikker: kalleren holder databasens lås.
+    """
+
+    def __init__(self, db: Any, generation: int = 0):
+        buckets, _ = _split(db)
+        self.keys = [{k for k, _ in b} for b in buckets]
+        self.bucket_hashes: List[Optional[str]] = [_hash(dumps([[k, v] for k, v in b])) if b else None
+                                                   for b in buckets]
+        self.dirs = [self._dir_hash(d) for d in range(FANOUT)]
+        self.generation = generation
+
+    def _dir_hash(self, d: int) -> str:
+        return _hash(dumps(self.bucket_hashes[d * FANOUT:(d + 1) * FANOUT]))
+
+    def bucket(self, db: Any, b: int) -> list:
+        return _bucket_rows({k: db[k] for k in self.keys[b]})
+
+    def update(self, db: Any, keys: Iterable[str], generation: int) -> None:
+        touched = set()
+        for k in keys:
+            b = _bucket(k)
+            touched.add(b)
+            if isinstance(db.get(k), dict):
+                self.keys[b].add(k)
+            else:
+                self.keys[b].discard(k)
+        for b in touched:
+            self.bucket_hashes[b] = _hash(dumps(self.bucket(db, b))) if self.keys[b] else None
+        for d in {b // FANOUT for b in touched}:
+            self.dirs[d] = self._dir_hash(d)
+        self.generation = generation
+
+
+def _contribution(rec: Dict[str, Any], eml: int, default_scenario: str) -> Tuple[str, str, float, int, bool]:
+    return (str(rec.get("kumulesone", "")), str(rec.get("scenario", default_scenario)), _si(rec), eml,
+            bool(rec.get("include", False)))
+
+
+def top_movers(cells: List[Dict[str, Any]], n: int = 10, key: str = MOVER_KEY) -> List[Dict[str, Any]]:
+    """De ``n`` cellene (kumulesone × scenario) med størst absolutt endring i ``key``."""
+    return sorted(cells, key=lambda c: (-abs(c[key]), c["kumulesone"], c["scenario"]))[:n]
+
+
+class SnapshotStore:
+    def __init__(self, root: str):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.versions_dir = os.path.join(root, "versions")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.versions_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, Any]" = OrderedDict()
+        # Øker for hver versjon som lagres her (nøkkel for hurtigbuffere i appen)
+        self.revision = 0
+
+    # ---------- objekter ----------
+    def _path(self, h: str) -> str:
+        return os.path.join(self.objects_dir, h[:2], h[2:])
+
+    def _has(self, h: str) -> bool:
+        return os.path.exists(self._path(h))
+
+    def _write(self, h: str, raw: bytes) -> int:
+        data = zlib.compress(raw, 6)
+        os.makedirs(os.path.dirname(self._path(h)), exist_ok=True)
+        atomic_write_bytes(self._path(h), data)
+        return len(data)
+
+    def _read(self, h: Optional[str]) -> Any:
+        if h is None:
+            return None
+        hit = self._cache.get(h)
+        if hit is not None:
+            self._cache.move_to_end(h)
+            return hit
+        with open(self._path(h), "rb") as f:
+            obj = loads(zlib.decompress(f.read()))
+        self._cache[h] = obj
+        if len(self._cache) > OBJECT_CACHE:
+            self._cache.popitem(last=False)
+        return obj
+
+    # ---------- versjoner ----------
+    def versions(self) -> List[Dict[str, Any]]:
+        """Alle versjoner (uten katalog-/metahasher), eldste først."""
+        out = []
+        for name in sorted(os.listdir(self.versions_dir)):
+            if name.endswith(".json"):
+                m = self.get(name[:-5])
+                out.append({k: v for k, v in m.items() if k not in ("dirs", "meta")})
+        return out
+
+    def get(self, version_id: str) -> Dict[str, Any]:
+        path = os.path.join(self.versions_dir, f"{version_id}.json")
+        try:
+            with open(path, "rb") as f:
+                return loads(f.read())
+        except FileNotFoundError:
+            raise KeyError(f"Ukjent versjon: {version_id}") from None
+
+    def latest(self) -> Optional[str]:
+        names = sorted(n for n in os.listdir(self.versions_dir) if n.endswith(".json"))
+        return names[-1][:-5] if names else None
+
+    def version_at(self, when: str) -> Optional[str]:
+        """Siste versjon lagret senest ``when`` (ISO-8601, som ``created``)."""
+        found = None
+        for v in self.versions():
+            if v["created"] <= when:
+                found = v["id"]
+        return found
+
+    def snapshot(self, db: Any, label: str = "") -> Dict[str, Any]:
+        """Lagre ``db`` som ny versjon. Bare objekter som ikke finnes fra før skrives."""
+        return self._save(_Tree(db), label)
+
+    def snapshot_changes(self, changes: Dict[str, Any], meta: Optional[Dict[str, Any]] = None,
+                         label: str = "", parent: Optional[str] = None) -> Dict[str, Any]:
+        """Ny versjon = ``parent`` (standard: siste versjon) med ``changes`` lagt oppå.
+
+        ``changes``: nøkkel -> risikoen slik den er nå (``None`` = slettet). ``meta``:
+        toppnivåverdiene som ikke er risikoer (``kumuler`` …); ``None`` beholder dem fra
+        ``parent``. Bare bøttene og katalogene med endrede nøkler leses og skrives.
+        ``KeyError`` hvis det ikke finnes noen versjon å bygge på.
+        """
+        parent = parent or self.latest()
+        if parent is None:
+            raise KeyError("Ingen versjon å bygge på")
+        m = self.get(parent)
+        tree = _Tree()
+        tree.dirs, tree.n_records = list(m["dirs"]), m["n_records"]
+        tree.meta = dict(m["meta"]) if meta is None else {k: tree.meta_ref(v) for k, v in meta.items()}
+        by_bucket: Dict[int, Dict[str, Any]] = {}
+        for k, v in changes.items():
+            by_bucket.setdefault(_bucket(k), {})[k] = v if isinstance(v, dict) else None
+        dir_lists: Dict[int, List[Optional[str]]] = {}
+        for b, recs in by_bucket.items():
+            d, i = divmod(b, FANOUT)
+            if d not in dir_lists:
+                dir_lists[d] = list(self._read(tree.dirs[d]))
+            rows = dict(map(tuple, self._read(dir_lists[d][i]) or ()))
+            before = len(rows)
+            for k, v in recs.items():
+                if v is None:
+                    rows.pop(k, None)
+                else:
+                    rows[k] = v
+            tree.n_records += len(rows) - before
+            dir_lists[d][i] = tree._put(_bucket_rows(rows)) if rows else None
+        for d, hashes in dir_lists.items():
+            tree.dirs[d] = tree._put(hashes)
+        return self._save(tree, label, parent=parent)
+
+    def _save(self, tree: _Tree, label: str, parent: Optional[str] = None) -> Dict[str, Any]:
+        with self._lock:
+            new_objects = new_bytes = 0
+            for h, raw in tree.objects.items():
+                if not self._has(h):
+                    new_bytes += self._write(h, raw)
+                    new_objects += 1
+            latest = self.latest()
+            version_id = f"{int(latest) + 1 if latest else 1:05d}"
+            manifest = {
+                "id": version_id, "created": now_iso(), "label": label, "parent": parent,
+                "n_records": tree.n_records, "new_objects": new_objects, "new_bytes": new_bytes,
+                "dirs": tree.dirs, "meta": tree.meta,
+            }
+            raw = dumps(manifest)
+            atomic_write_bytes(os.path.join(self.versions_dir, f"{version_id}.json"), raw)
+            self.revision += 1
+        return {k: v for k, v in manifest.items() if k not in ("dirs", "meta")}
+
+    def load(self, version_id: str) -> Dict[str, Any]:
+        """Hele databasen slik den var i versjonen (vanlig dict, samme form som snapshotet)."""
+        m = self.get(version_id)
+        db: Dict[str, Any] = {}
+        for k, ref in m["meta"].items():
+            if "list" in ref:
+                db[k] = [x for h in ref["list"] for x in self._read(h)]
+            else:
+                db[k] = self._read(ref["value"])
+        for d in m["dirs"]:
+            for h in self._read(d):
+                for k, rec in self._read(h) or ():
+                    db[k] = rec
+        return db
+
+    # ---------- diff ----------
+    def changes(self, a: str, b: Optional[str] = None, db: Any = None,
+                live: Optional[LiveTree] = None) -> Iterable[Tuple[str, Any, Any]]:
+        """(nøkkel, gammel, ny) for risikoer som er endret fra versjon ``a`` til ``b``
+        (eller til ``db`` når ``b`` er ``None``). Manglende side er ``None``.
+
+        Mot ``db`` brukes ``live`` (à jour med ``db``); uten den bygges et ``LiveTree`` her.
+        """
+        old_dirs = self.get(a)["dirs"]
+        if b is not None:
+            new_dirs = self.get(b)["dirs"]
+
+            def new_hashes(d: int) -> List[Optional[str]]:
+                return self._read(new_dirs[d])
+
+            def new_rows(bi: int, h: Optional[str]) -> Any:
+                return self._read(h)
+        else:
+            live = live if live is not None else LiveTree(db)
+            new_dirs = live.dirs
+
+            def new_hashes(d: int) -> List[Optional[str]]:
+                return live.bucket_hashes[d * FANOUT:(d + 1) * FANOUT]
+
+            def new_rows(bi: int, h: Optional[str]) -> Any:
+                return live.bucket(db, bi)
+
+        for d, (od, nd) in enumerate(zip(old_dirs, new_dirs)):
+            if od == nd:
+                continue
+            for i, (ob, nb) in enumerate(zip(self._read(od), new_hashes(d))):
+                if ob == nb:
+                    continue
+                old = dict(map(tuple, self._read(ob) or ()))
+                new = dict(map(tuple, new_rows(d * FANOUT + i, nb) or ()))
+                for k in sorted(old.keys() | new.keys()):
+                    o, n = old.get(k), new.get(k)
+                    if o != n:
+                        yield k, o, n
+
+    def diff(self, a: str, b: Optional[str] = None, db: Any = None,
+             default_scenario: str = "Brann", live: Optional[LiveTree] = None) -> Dict[str, Any]:
+        """Endring i akkumuleringen fra versjon ``a`` til ``b`` (``None`` = gjeldende ``db``).
+
+        ``cells`` har én rad per kumulesone × scenario som er berørt: ``d_si``, ``d_si_inc``,
+        ``d_eml_inc``, ``d_n_inc`` og ``changed`` (antall endrede risikoer).
+        """
+        changes = list(self.changes(a, b, db, live))
+        old_eml = iter(calc_eml_records([o for _, o, _ in changes if o is not None])["eml"].tolist())
+        new_eml = iter(calc_eml_records([n for _, _, n in changes if n is not None])["eml"].tolist())
+
+        cells: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        for _, old, new in changes:
+            touched = set()
+            for rec, eml, sign in ((old, old_eml, -1), (new, new_eml, +1)):
+                if rec is None:
+                    continue
+                zone, scen, si, e, inc = _contribution(rec, next(eml), default_scenario)
+                c = cells.setdefault((zone, scen), {"kumulesone": zone, "scenario": scen, "d_si": 0.0,
+                                                    "d_si_inc": 0.0, "d_eml_inc": 0, "d_n_inc": 0, "changed": 0})
+                c["d_si"] += sign * si
+                if inc:
+                    c["d_si_inc"] += sign * si
+                    c["d_eml_inc"] += sign * e
+                    c["d_n_inc"] += sign
+                touched.add((zone, scen))
+            for cell in touched:
+                cells[cell]["changed"] += 1
+        # Celler der endringene utlignet hverandre (f.eks. bare nytt tidsstempel) er ikke interessante
+        out = [c for c in cells.values() if c["d_si"] or c["d_si_inc"] or c["d_eml_inc"] or c["d_n_inc"]]
+        return {
+            "from": a, "to": b, "cells": out,
+            "added": sum(o is None for _, o, _ in changes),
+            "removed": sum(n is None for _, _, n in changes),
+            "modified": sum(o is not None and n is not None for _, o, n in changes),
+        }
+
+    def top_movers(self, a: str, b: Optional[str] = None, n: int = 10, db: Any = None,
+                   default_scenario: str = "Brann") -> List[Dict[str, Any]]:
+        return top_movers(self.diff(a, b, db, default_scenario)["cells"], n)
+
+    # ---------- statistikk ----------
+    def storage(self) -> Dict[str, int]:
+        """Antall versjoner, objekter og bytes på disk (objekter + manifester)."""
+        n_obj = n_bytes = 0
+        for d, _, files in os.walk(self.objects_dir):
+            for f in files:
+                n_obj += 1
+                n_bytes += os.path.getsize(os.path.join(d, f))
+        versions = [f for f in os.listdir(self.versions_dir) if f.endswith(".json")]
+        v_bytes = sum(os.path.getsize(os.path.join(self.versions_dir, f)) for f in versions)
+        return {"versions": len(versions), "objects": n_obj, "bytes": n_bytes + v_bytes}
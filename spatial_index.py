@@ -0,0 +1,368 @@
+"""Romlig indeks over risikoenes koordinater og søk etter verste sirkel.
+
+Koordinatene (``latitude``/``longitude``) gjøres om til punkter i 3D
+(jordsentrert, meter) og legges i et rutenett av terninger med side ``h``:
+hver celle har en heltallsnøkkel, punktene ligger sortert på cellenøkkel, og
+alle punkter innenfor ``h`` fra et punkt finnes i de 27 nabocellene. Det gir
+samme avstand overalt (ingen forvrengning nord/sør slik et lengde-/
+breddegradsrutenett får), og rutenettet bygges i én sortering per cellestørrelse.
+
+``worst_circle`` finner plasseringen av en sirkel med radius R (f.eks. 200 m
+brannspredning, 1 km flom) som gir størst sum inkludert EML. Søket er
+gren-og-skranke over mulige sentre: en terning av sentre har øvre grense =
+EML innenfor R + terningens halvdiagonal fra midten, og nedre grense = EML
+innenfor R fra midten (en faktisk plassering). Terningen med høyest øvre grense
+deles i åtte til grensene møtes. Bare punktene nær terningen sjekkes, så søket
+ser aldri på alle par av risikoer. Resultatet har også den øvre grensen, så
+det fremgår om svaret er eksakt eller stoppet på tid/oppløsning.
+"""
+import heapq
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from eml_engine import BATCH_FIELDS, FIELD_DEFAULTS, calc_eml_batch, records_to_columns
+
+EARTH_RADIUS = 6_371_008.8
+# Minste radius (cellenøklene har 21 bit per akse, dvs. celler på minst ~6 m)
+MIN_RADIUS = 10.0
+# Søket stopper når sentrene er bestemt på denne oppløsningen (meter)
+MIN_CELL = 0.5
+DEFAULT_TIME_BUDGET = 5.0
+# Risikoer på randen (innenfor 1 mm) regnes som innenfor sirkelen
+TOLERANCE = 1e-3
+# Terninger med høyst så mange risikoer nær randen løses eksakt (i stedet for å deles videre)
+EXACT_MAX_UNSURE = 32
+# Antall rutenett (punktutvalg × cellestørrelse) som holdes i cachen
+GRID_CACHE = 8
+
+_OFF = 1 << 20
+_SHIFT_X, _SHIFT_Y = 42, 21
+_NEIGHBOURS = np.array(
+    [(dx << _SHIFT_X) + (dy << _SHIFT_Y) + dz for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)],
+    dtype=np.int64,
+)
+
+_CORNERS = np.array([(sx, sy, sz) for sx in (-1, 1) for sy in (-1, 1) for sz in (-1, 1)], dtype=np.float64)
+
+
+def to_xyz(lat: Any, lon: Any) -> np.ndarray:
+    """Breddegrad/lengdegrad (grader) -> punkter på jordoverflaten i meter, form (n, 3)."""
+    phi, lam = np.radians(np.asarray(lat, dtype=np.float64)), np.radians(np.asarray(lon, dtype=np.float64))
+    cos_phi = np.cos(phi)
+    return np.stack([cos_phi * np.cos(lam), cos_phi * np.sin(lam), np.sin(phi)], axis=-1) * EARTH_RADIUS
+
+
+def to_latlon(xyz: np.ndarray) -> Tuple[float, float]:
+    x, y, z = (float(v) for v in xyz)
+    r = (x * x + y * y + z * z) ** 0.5
+    return float(np.degrees(np.arcsin(z / r))), float(np.degrees(np.arctan2(y, x)))
+
+
+def chord(radius_m: float) -> float:
+    """Buelengde langs jordoverflaten -> rett avstand gjennom jorden (det rutenettet måler)."""
+    return 2 * EARTH_RADIUS * np.sin(radius_m / (2 * EARTH_RADIUS))
+
+
+def valid_coords(lat: Any, lon: Any) -> np.ndarray:
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    with np.errstate(invalid="ignore"):
+        return np.isfinite(lat) & np.isfinite(lon) & (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+
+
+def _circle_hits(a: np.ndarray, ra: float, b: np.ndarray, rb: float) -> np.ndarray:
+    """Skjæringspunktene mellom sirklene (``a[i]``, ``ra``) og (``b[i]``, ``rb``) i planet, form (m, 2)."""
+    delta = b - a
+    dist = np.linalg.norm(delta, axis=1)
+    ok = (dist > 0) & (dist <= ra + rb) & (dist >= abs(ra - rb))
+    if not ok.any():
+        return np.zeros((0, 2))
+    a, delta, dist = a[ok], delta[ok], dist[ok, None]
+    along = (ra * ra - rb * rb + dist * dist) / (2 * dist)
+    half = np.sqrt(np.maximum(ra * ra - along * along, 0.0))
+    base = a + along * delta / dist
+    perp = np.stack([-delta[:, 1], delta[:, 0]], axis=-1) / dist
+    return np.concatenate([base + half * perp, base - half * perp])
+
+
+def _best_centre(c: np.ndarray, pts: np.ndarray, w: np.ndarray, r: float,
+                 rho: float) -> Tuple[float, np.ndarray]:
+    """Beste senter innenfor ``rho`` fra ``c`` (på jordoverflaten).
+
+    Risikoer nærmere enn ``r - rho`` er med uansett, og de lenger unna enn ``r + rho``
+    er aldri med; summen endrer seg bare når senteret krysser en sirkel med radius
+    ``r`` rundt en av de andre. Det beste området har derfor et hjørne der to slike
+    sirkler skjærer hverandre eller kanten av søkeområdet, eller ligger langs én sirkel.
+    Kandidatene er disse punktene (regnet i tangentplanet rundt ``c``) og ``c`` selv.
+    """
+    up = c / np.linalg.norm(c)
+    east = np.cross([0.0, 0.0, 1.0], up)
+    if np.linalg.norm(east) < 1e-9:
+        east = np.array([1.0, 0.0, 0.0])
+    east /= np.linalg.norm(east)
+    north = np.cross(up, east)
+    d = np.linalg.norm(pts - c, axis=1)
+    sure = float(w[d <= r - rho].sum())
+    unsure = np.flatnonzero((d > r - rho) & (d <= r + rho))
+    u_pts, u_w = pts[unsure], w[unsure]
+    u = np.stack([(u_pts - c) @ east, (u_pts - c) @ north], axis=-1)
+    i, j = np.triu_indices(len(u), k=1)
+    zero = np.zeros((len(u), 2))
+    plane = np.concatenate([
+        np.zeros((1, 2)),
+        _circle_hits(u[i], r, u[j], r),
+        _circle_hits(zero, rho, u, r),
+        (u[:, None, :] + r * np.array([[1, 0], [0, 1], [-1, 0], [0, -1]])).reshape(-1, 2),
+    ])
+    plane = plane[np.linalg.norm(plane, axis=1) <= rho]
+    xyz = c + plane[:, :1] * east + plane[:, 1:] * north
+    xyz *= (EARTH_RADIUS / np.linalg.norm(xyz, axis=1))[:, None]
+    sums = sure + (np.linalg.norm(u_pts[None, :, :] - xyz[:, None, :], axis=2) <= r + TOLERANCE).astype(np.float64) @ u_w
+    k = int(np.argmax(sums))
+    return float(sums[k]), xyz[k]
+
+
+class _Grid:
+    """Punkter sortert på cellenøkkel (terninger med side ``h``)."""
+
+    def __init__(self, xyz: np.ndarray, h: float):
+        self.h = h
+        keys = self.keys_for(xyz)
+        self.order = np.argsort(keys, kind="stable")
+        self.cells, self.starts, self.counts = np.unique(keys[self.order], return_index=True, return_counts=True)
+
+    def keys_for(self, xyz: np.ndarray) -> np.ndarray:
+        c = np.floor(np.atleast_2d(xyz) / self.h).astype(np.int64) + _OFF
+        return (c[:, 0] << _SHIFT_X) + (c[:, 1] << _SHIFT_Y) + c[:, 2]
+
+    def near(self, xyz: np.ndarray) -> np.ndarray:
+        """Indeksene til punktene i de 27 cellene rundt ``xyz`` (alle innenfor ``h``, og noen flere)."""
+        want = np.unique(self.keys_for(xyz)[:, None] + _NEIGHBOURS[None, :])
+        pos = np.minimum(np.searchsorted(self.cells, want), len(self.cells) - 1)
+        pos = pos[self.cells[pos] == want]
+        if not len(pos):
+            return np.zeros(0, dtype=np.int64)
+        counts = self.counts[pos]
+        starts = np.repeat(self.starts[pos] - np.cumsum(counts) + counts, counts)
+        return self.order[starts + np.arange(counts.sum())]
+
+    def occupied_centres(self) -> np.ndarray:
+        """Midtpunktene til cellene som har punkter, og naboene deres (mulige sentre), form (m, 3)."""
+        cells = np.unique((self.cells[:, None] + _NEIGHBOURS[None, :]).ravel())
+        c = np.stack([(cells >> _SHIFT_X) & 0x1FFFFF, (cells >> _SHIFT_Y) & 0x1FFFFF, cells & 0x1FFFFF], axis=-1)
+        return (c - _OFF + 0.5) * self.h
+
+
+class SpatialIndex:
+    def __init__(self, db: Dict[str, Any], default_scenario: str):
+        fields = ["latitude", "longitude", "kumulesone", "scenario", "include"]
+        defaults = {**FIELD_DEFAULTS, "latitude": np.nan, "longitude": np.nan, "kumulesone": "",
+                    "scenario": default_scenario, "include": False}
+        if hasattr(db, "frame"):
+            f = db.frame(fields + BATCH_FIELDS, defaults=defaults)
+            keys = f["_key"]
+            cols: Any = f
+        else:
+            items = [(k, r) for k, r in db.items() if isinstance(r, dict)]
+            keys = pd.Series([k for k, _ in items], dtype=object)
+            f = pd.DataFrame({c: [r.get(c, defaults[c]) for _, r in items] for c in fields})
+            cols = records_to_columns(r for _, r in items)
+        self.n_total = len(keys)
+        lat = pd.to_numeric(pd.Series(f["latitude"], dtype=object), errors="coerce").to_numpy(np.float64)
+        lon = pd.to_numeric(pd.Series(f["longitude"], dtype=object), errors="coerce").to_numpy(np.float64)
+        ok = valid_coords(lat, lon)
+        eml = calc_eml_batch(cols, n=self.n_total)["eml"]
+        self.keys = np.asarray(keys, dtype=object)[ok]
+        self.lat, self.lon = lat[ok], lon[ok]
+        self.zone = np.asarray(pd.Series(f["kumulesone"], dtype=object).astype(str), dtype=object)[ok]
+        self.scenario = np.asarray(pd.Series(f["scenario"], dtype=object).astype(str), dtype=object)[ok]
+        self.include = np.fromiter((bool(v) for v in f["include"].tolist()), dtype=bool, count=self.n_total)[ok]
+        self.eml = eml[ok]
+        self.xyz = to_xyz(self.lat, self.lon)
+        self._grids: "OrderedDict[Tuple[Any, ...], Tuple[np.ndarray, _Grid]]" = OrderedDict()
+        self._results: "OrderedDict[Tuple[Any, ...], List[Dict[str, Any]]]" = OrderedDict()
+
+    @property
+    def n(self) -> int:
+        """Antall risikoer med gyldige koordinater."""
+        return len(self.keys)
+
+    # ---------- utvalg og rutenett ----------
+    def _subset(self, scenario: Optional[str], only_included: bool,
+                exclude: Tuple[str, ...] = ()) -> np.ndarray:
+        mask = self.eml > 0
+        if only_included:
+            mask &= self.include
+        if scenario:
+            mask &= self.scenario == scenario
+        if exclude:
+            # Mengdeoppslag: np.isin på object-arrays sorterer og er svært tregt
+            skip = set(exclude)
+            mask &= np.fromiter((k not in skip for k in self.keys.tolist()), dtype=bool, count=len(self.keys))
+        return np.flatnonzero(mask)
+
+    def _grid(self, h: float, scenario: Optional[str], only_included: bool,
+              exclude: Tuple[str, ...] = ()) -> Tuple[np.ndarray, _Grid]:
+        key = (round(h, 6), scenario, only_included, exclude)
+        hit = self._grids.get(key)
+        if hit is not None:
+            self._grids.move_to_end(key)
+            return hit
+        idx = self._subset(scenario, only_included, exclude)
+        out = (idx, _Grid(self.xyz[idx], h))
+        self._grids[key] = out
+        if len(self._grids) > GRID_CACHE:
+            self._grids.popitem(last=False)
+        return out
+
+    # ---------- oppslag ----------
+    def within(self, lat: float, lon: float, radius_m: float, scenario: Optional[str] = None,
+               only_included: bool = True) -> pd.DataFrame:
+        """Risikoene innenfor ``radius_m`` fra et punkt, med avstand (m), størst EML først."""
+        radius_m = max(float(radius_m), MIN_RADIUS)
+        return self._members(to_xyz(lat, lon), radius_m, scenario, only_included)
+
+    def _members(self, centre: np.ndarray, radius_m: float, scenario: Optional[str], only_included: bool,
+                 exclude: Tuple[str, ...] = ()) -> pd.DataFrame:
+        idx, grid = self._grid(chord(radius_m), scenario, only_included, exclude)
+        cand = idx[grid.near(centre)]
+        d = np.linalg.norm(self.xyz[cand] - centre, axis=1)
+        hit = d <= chord(radius_m) + TOLERANCE
+        cand, d = cand[hit], d[hit]
+        out = pd.DataFrame({
+            "Nøkkel": self.keys[cand], "Kumulesone": self.zone[cand], "Scenario": self.scenario[cand],
+            "EML": self.eml[cand], "Avstand (m)": np.round(2 * EARTH_RADIUS * np.arcsin(d / (2 * EARTH_RADIUS)), 1),
+            "latitude": self.lat[cand], "longitude": self.lon[cand],
+        })
+        return out.sort_values("EML", ascending=False, kind="stable").reset_index(drop=True)
+
+    # ---------- verste sirkel ----------
+    def worst_circle(self, radius_m: float, scenario: Optional[str] = None, only_included: bool = True,
+                     time_budget: float = DEFAULT_TIME_BUDGET, exclude: Tuple[str, ...] = ()) -> Optional[Dict[str, Any]]:
+        """Plasseringen av en sirkel med radius ``radius_m`` som gir størst sum EML.
+
+        Returnerer ``None`` hvis ingen risikoer har koordinater og EML > 0, ellers
+        ``lat``, ``lon``, ``eml``, ``n``, ``members`` (DataFrame), ``upper_bound``,
+        ``exact`` (øvre grense = funnet sum), ``cubes`` (antall terninger vurdert) og ``seconds``.
+        """
+        t0 = time.perf_counter()
+        radius_m = max(float(radius_m), MIN_RADIUS)
+        r = chord(radius_m)
+        # Celler med side 2R: en sirkel med senter i en celle ligger i cellens 27-nabolag
+        idx, grid = self._grid(2 * r, scenario, only_included, exclude)
+        if not len(idx):
+            return None
+        pts, w = self.xyz[idx], self.eml[idx].astype(np.float64)
+        sq = np.einsum("ij,ij->i", pts, pts)
+
+        best = (0.0, None)
+        heap: List[Tuple[float, int, np.ndarray, float, np.ndarray]] = []
+        seq = 0
+        centres = grid.occupied_centres()
+        # Første skranke per celle: sum av cellens 27-nabolag (bare rutenettet, ingen avstander)
+        cell_w = np.bincount(np.repeat(np.arange(len(grid.cells)), grid.counts),
+                             weights=w[grid.order], minlength=len(grid.cells))
+        cell_keys = grid.keys_for(centres)
+        ub0 = np.zeros(len(centres))
+        for off in _NEIGHBOURS:
+            pos = np.searchsorted(grid.cells, cell_keys + off)
+            pos_c = np.minimum(pos, len(grid.cells) - 1)
+            ub0 += np.where(grid.cells[pos_c] == cell_keys + off, cell_w[pos_c], 0.0)
+        # Bare celler som skjærer jordoverflaten kan inneholde et senter
+        half = grid.h * np.sqrt(3) / 2
+        on_surface = np.abs(np.linalg.norm(centres, axis=1) - EARTH_RADIUS) <= half
+        for i in np.flatnonzero(on_surface & (ub0 > 0)):
+            heap.append((-ub0[i], seq, centres[i], grid.h, None))
+            seq += 1
+        heapq.heapify(heap)
+
+        upper = -heap[0][0] if heap else 0.0
+        cubes = 0
+        exact = True
+        while heap:
+            neg_ub, _, c, size, cand = heapq.heappop(heap)
+            upper = -neg_ub
+            if upper <= best[0] + 0.5:
+                break
+            if size <= MIN_CELL or (best[1] is not None and time.perf_counter() - t0 > time_budget):
+                exact = False
+                break
+            if cand is None:
+                cand = grid.near(c)
+            if not len(cand):
+                continue
+            cubes += 1
+            p, pw, psq = pts[cand], w[cand], sq[cand]
+            # Sentrene i terningen (på jordoverflaten) ligger innenfor rho fra midtpunktet der
+            surface = c * (EARTH_RADIUS / np.linalg.norm(c))
+            rho = size * np.sqrt(3) / 2 + np.linalg.norm(surface - c)
+            d = np.linalg.norm(p - surface, axis=1)
+            if np.count_nonzero((d > r - rho) & (d <= r + rho)) <= EXACT_MAX_UNSURE:
+                # Få risikoer avgjør hvor i terningen senteret bør ligge: regn det ut eksakt
+                value, centre = _best_centre(surface, p, pw, r, rho)
+                if value > best[0]:
+                    best = (value, centre)
+                continue
+            # Åtte underterninger; avstand til punktene nær foreldreterningen
+            child_size = size / 2
+            kids = c + _CORNERS * (size / 4)
+            slack = child_size * np.sqrt(3) / 2
+            kids = kids[np.abs(np.linalg.norm(kids, axis=1) - EARTH_RADIUS) <= slack]
+            if not len(kids):
+                continue
+            # Nedre grense: sirkel med senter i terningens midtpunkt (flyttet ut til jordoverflaten)
+            on_earth = kids * (EARTH_RADIUS / np.linalg.norm(kids, axis=1))[:, None]
+            both = np.concatenate([kids, on_earth])
+            # |p - k|² = |p|² + |k|² - 2 p·k (én matrisemultiplikasjon for alle åtte)
+            d2 = psq[None, :] + np.einsum("ij,ij->i", both, both)[:, None] - 2 * (both @ p.T)
+            inside = d2[:len(kids)] <= (r + slack) ** 2
+            ubs = inside.astype(np.float64) @ pw
+            lbs = (d2[len(kids):] <= (r + TOLERANCE) ** 2).astype(np.float64) @ pw
+            k = int(np.argmax(lbs))
+            if lbs[k] > best[0]:
+                best = (float(lbs[k]), on_earth[k])
+            for j in range(len(kids)):
+                if ubs[j] > best[0] + 0.5:
+                    heapq.heappush(heap, (-ubs[j], seq, kids[j], child_size, cand[inside[j]]))
+                    seq += 1
+        else:
+            upper = best[0]
+
+        if best[1] is None:
+            return None
+        lat, lon = to_latlon(best[1])
+        members = self._members(best[1], radius_m, scenario, only_included, exclude)
+        total = int(members["EML"].sum())
+        return {
+            "lat": lat, "lon": lon, "radius_m": radius_m, "eml": total, "n": len(members),
+            "members": members, "upper_bound": int(round(max(upper, total))), "exact": exact,
+            "cubes": cubes, "seconds": time.perf_counter() - t0,
+        }
+
+    def worst_circles(self, radius_m: float, count: int = 3, scenario: Optional[str] = None,
+                      only_included: bool = True, time_budget: float = DEFAULT_TIME_BUDGET) -> List[Dict[str, Any]]:
+        """De ``count`` verste sirklene uten felles risikoer (grådig: neste søk utelater de forrige treffene).
+
+        ``time_budget`` gjelder per sirkel. Resultatet caches per (radius, antall,
+        scenario, bare inkluderte).
+        """
+        key = (round(float(radius_m), 3), int(count), scenario, only_included)
+        hit = self._results.get(key)
+        if hit is not None:
+            self._results.move_to_end(key)
+            return hit
+        out: List[Dict[str, Any]] = []
+        taken: Tuple[str, ...] = ()
+        for _ in range(max(int(count), 1)):
+            res = self.worst_circle(radius_m, scenario, only_included, time_budget=time_budget, exclude=taken)
+            if res is None or res["eml"] <= 0:
+                break
+            out.append(res)
+            taken = tuple(sorted(set(taken) | set(res["members"]["Nøkkel"].tolist())))
+        self._results[key] = out
+        if len(self._results) > GRID_CACHE:
+            self._results.popitem(last=False)
+        return out
@@ -0,0 +1,196 @@
+"""SQLite-lagring av risikodatabasen.
+
+Samme grensesnitt som ``storage.JournalStore`` (``load``/``append``/``write_snapshot``),
+men hver risiko er én rad med indekserte kolonner, slik at utvalg per
+kumulesone/scenario/include og summer per kumulesone kan gjøres i SQL.
+
+Toppnivåverdier som ikke er dicts (sonetabellen ``kumuler`` og ``_schema``) lagres
+som JSON i ``meta``-tabellen, slik at ``load()`` gir tilbake samme form som
+JSON-filen.
+"""
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from eml_engine import calc_eml_records
+from serialization import dumps, load_file, loads
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    key            TEXT PRIMARY KEY,
+    kumulesone     TEXT NOT NULL,
+    scenario       TEXT NOT NULL,
+    include        INTEGER NOT NULL,
+    forsnr         TEXT NOT NULL,
+    risikonr       TEXT NOT NULL,
+    sum_forsikring REAL NOT NULL,
+    eml            INTEGER NOT NULL,
+    data           TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_records_zone ON records (kumulesone, scenario, include);
+CREATE INDEX IF NOT EXISTS ix_records_policy ON records (forsnr, risikonr);
+CREATE TABLE IF NOT EXISTS meta (
+    key  TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+"""
+
+_UPSERT = """
+INSERT INTO records (key, kumulesone, scenario, include, forsnr, risikonr, sum_forsikring, eml, data)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (key) DO UPDATE SET
+    kumulesone = excluded.kumulesone,
+    scenario = excluded.scenario,
+    include = excluded.include,
+    forsnr = excluded.forsnr,
+    risikonr = excluded.risikonr,
+    sum_forsikring = excluded.sum_forsikring,
+    eml = excluded.eml,
+    data = excluded.data
+"""
+
+
+def _si(rec: Dict[str, Any]) -> float:
+    try:
+        return float(rec.get("sum_forsikring", 0) or 0)
+    except Exception:
+        return 0.0
+
+
+class SqliteStore:
+    def __init__(self, path: str, default_scenario: str = "Brann", json_seed: Optional[str] = None):
+        self.path = path
+        self.default_scenario = default_scenario
+        self._lock = threading.RLock()
+        # Streamlit kjører hver rerun i egen tråd; én delt forbindelse bak lås
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("PRAGMA synchronous=NORMAL")
+        self._con.executescript(SCHEMA)
+        if json_seed and os.path.exists(json_seed) and self.is_empty():
+            self.import_json(json_seed)
+
+    # ---------- konvertering ----------
+    def _rows(self, items: List[Tuple[str, Dict[str, Any]]]):
+        eml = calc_eml_records(r for _, r in items)["eml"].tolist()
+        for (k, r), e in zip(items, eml):
+            yield (
+                k,
+                str(r.get("kumulesone", "")),
+                str(r.get("scenario", self.default_scenario)),
+                int(bool(r.get("include", False))),
+                str(r.get("forsnr", "")),
+                str(r.get("risikonr", "")),
+                _si(r),
+                e,
+                dumps(r).decode("utf-8"),
+            )
+
+    # ---------- grensesnitt felles med JournalStore ----------
+    def is_empty(self) -> bool:
+        with self._lock:
+            cur = self._con.execute("SELECT EXISTS (SELECT 1 FROM records) OR EXISTS (SELECT 1 FROM meta)")
+            return not cur.fetchone()[0]
+
+    def signature(self) -> int:
+        """``PRAGMA data_version`` – endres når en annen forbindelse (prosess) har skrevet."""
+        with self._lock:
+            return self._con.execute("PRAGMA data_version").fetchone()[0]
+
+    def load(self) -> Dict[str, Any]:
+        with self._lock:
+            db: Dict[str, Any] = {k: loads(d) for k, d in self._con.execute("SELECT key, data FROM meta")}
+            for k, d in self._con.execute("SELECT key, data FROM records"):
+                db[k] = loads(d)
+        return db
+
+    def _put(self, changes: Dict[str, Any]) -> None:
+        recs = [(k, v) for k, v in changes.items() if isinstance(v, dict)]
+        other = [(k, v) for k, v in changes.items() if not isinstance(v, dict)]
+        self._con.executemany(_UPSERT, self._rows(recs))
+        self._con.executemany("DELETE FROM meta WHERE key = ?", ((k,) for k, _ in recs))
+        self._con.executemany("DELETE FROM records WHERE key = ?", ((k,) for k, _ in other))
+        self._con.executemany(
+            "INSERT INTO meta (key, data) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET data = excluded.data",
+            ((k, dumps(v).decode("utf-8")) for k, v in other),
+        )
+
+    def append(self, changes: Dict[str, Any], deleted: Iterable[str] = ()) -> None:
+        """UPSERT av endrede poster og sletting av fjernede nøkler i én transaksjon."""
+        deleted = [(k,) for k in deleted]
+        with self._lock, self._con:
+            self._put(changes)
+            self._con.executemany("DELETE FROM records WHERE key = ?", deleted)
+            self._con.executemany("DELETE FROM meta WHERE key = ?", deleted)
+
+    def write_snapshot(self, db: Dict[str, Any]) -> None:
+        with self._lock, self._con:
+            self._con.execute("DELETE FROM records")
+            self._con.execute("DELETE FROM meta")
+            self._put(db)
+
+    # ---------- spørringer ----------
+    def kumuler(self) -> List[str]:
+        with self._lock:
+            cur = self._con.execute(
+                "SELECT DISTINCT kumulesone FROM records WHERE trim(kumulesone) != '' ORDER BY kumulesone"
+            )
+            return [r[0].strip() for r in cur]
+
+    def records_in(self, kumulesone: str, scenario: Optional[str] = None,
+                   include: Optional[bool] = None) -> List[Tuple[str, Dict[str, Any]]]:
+        """Poster i én kumulesone (evt. avgrenset på scenario/include) via sone-indeksen."""
+        sql = "SELECT key, data FROM records WHERE kumulesone = ?"
+        args: list = [kumulesone]
+        if scenario is not None:
+            sql += " AND scenario = ?"
+            args.append(scenario)
+        if include is not None:
+            sql += " AND include = ?"
+            args.append(int(include))
+        with self._lock:
+            return [(k, loads(d)) for k, d in self._con.execute(sql, args)]
+
+    def find_policy(self, forsnr: str, risikonr: Optional[str] = None) -> List[Tuple[str, Dict[str, Any]]]:
+        sql = "SELECT key, data FROM records WHERE forsnr = ?"
+        args = [forsnr]
+        if risikonr is not None:
+            sql += " AND risikonr = ?"
+            args.append(risikonr)
+        with self._lock:
+            return [(k, loads(d)) for k, d in self._con.execute(sql, args)]
+
+    def zone_totals(self, scenario: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+        """Per kumulesone: antall, sum SI, antall inkluderte og sum EML for inkluderte."""
+        sql = (
+            "SELECT kumulesone, COUNT(*), SUM(sum_forsikring), SUM(include), "
+            "SUM(CASE WHEN include THEN sum_forsikring ELSE 0 END), "
+            "SUM(CASE WHEN include THEN eml ELSE 0 END) FROM records"
+        )
+        args: list = []
+        if scenario is not None:
+            sql += " WHERE scenario = ?"
+            args.append(scenario)
+        sql += " GROUP BY kumulesone"
+        with self._lock:
+            return {
+                z: {"n": n, "si": si or 0.0, "n_inc": n_inc or 0, "si_inc": si_inc or 0.0, "eml_inc": eml_inc or 0}
+                for z, n, si, n_inc, si_inc, eml_inc in self._con.execute(sql, args)
+            }
+
+    # ---------- JSON inn/ut ----------
+    def import_json(self, path: str) -> int:
+        data = load_file(path)
+        if not isinstance(data, dict):
+            raise ValueError(f"{path}: forventet JSON-objekt (dict)")
+        self.append(data)
+        return len(data)
+
+    def export_json(self, path: str) -> None:
+        from storage import atomic_write_bytes, dump_snapshot_bytes
+        atomic_write_bytes(path, dump_snapshot_bytes(self.load()))
+
+    def close(self) -> None:
+        with self._lock:
+            self._con.close()
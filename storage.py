@@ -0,0 +1,341 @@
+"""Lagring av risikodatabasen.
+
+``JournalStore`` holder et snapshot (``risiko_db.json``) pluss en append-only
+journal (``risiko_db.json.journal``) med de postene som er endret siden
+snapshotet. Lasting = snapshot + replay av journal. Når journalen passerer
+``compact_bytes`` foldes den inn i et nytt snapshot i en bakgrunnstråd.
+
+Journalformat (én JSON per linje):
+    {"base": "<md5 av snapshot-bytes>"}      – første linje
+    {"k": "<nøkkel>", "v": <verdi>}          – put
+    {"k": "<nøkkel>", "del": true}           – slett
+
+All skriving til snapshot/journal-erstatning går via temp-fil + ``os.replace``,
+slik at et krasj midt i en lagring aldri etterlater en avkuttet database.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from serialization import dumps, loads
+
+# Journal foldes inn i nytt snapshot når den passerer denne størrelsen
+DEFAULT_COMPACT_BYTES = 8 * 1024 * 1024
+
+_DELETED = object()
+
+
+# ==========================================================
+# Hjelpere
+# ==========================================================
+def atomic_write_bytes(path: str, data: bytes) -> None:
+    """Skriv ``data`` til ``path`` via temp-fil i samme mappe + fsync + rename."""
+    d = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=d)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def dump_snapshot_bytes(db: Dict[str, Any]) -> bytes:
+    return dumps(db, indent=True)
+
+
+def load_snapshot_bytes(raw: bytes) -> Dict[str, Any]:
+    if not raw.strip():
+        return {}
+    data = loads(raw)
+    return data if isinstance(data, dict) else {}
+
+
+def _digest(raw: bytes) -> str:
+    return hashlib.md5(raw).hexdigest()
+
+
+def _read_bytes(path: str) -> bytes:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return b""
+
+
+def _journal_line(key: str, value: Any) -> bytes:
+    if value is _DELETED:
+        obj = {"k": key, "del": True}
+    else:
+        obj = {"k": key, "v": value}
+    return dumps(obj) + b"\n"
+
+
+def _journal_header(base: str) -> bytes:
+    return dumps({"base": base}) + b"\n"
+
+
+def _parse_journal(raw: bytes) -> Tuple[Optional[str], list, int]:
+    """-> (base, [(nøkkel, verdi|_DELETED)], antall gyldige bytes).
+
+    En avkuttet siste linje (krasj midt i append) ignoreres.
+    """
+    base = None
+    entries = []
+    good = 0
+    pos = 0
+    while pos < len(raw):
+        nl = raw.find(b"\n", pos)
+        if nl < 0:
+            break  # halv linje uten linjeskift
+        line = raw[pos:nl]
+        try:
+            obj = loads(line) if line.strip() else None
+        except ValueError:
+            break
+        pos = nl + 1
+        good = pos
+        if obj is None:
+            continue
+        if "base" in obj and base is None and not entries:
+            base = obj["base"]
+        elif "k" in obj:
+            entries.append((obj["k"], _DELETED if obj.get("del") else obj.get("v")))
+    return base, entries, good
+
+
+def _replay(db: Dict[str, Any], entries: Iterable[Tuple[str, Any]]) -> Dict[str, Any]:
+    for k, v in entries:
+        if v is _DELETED:
+            db.pop(k, None)
+        else:
+            db[k] = v
+    return db
+
+
+# ==========================================================
+# Journal-lagring
+# ==========================================================
+class JournalStore:
+    def __init__(self, path: str, compact_bytes: int = DEFAULT_COMPACT_BYTES):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.compact_bytes = compact_bytes
+        self._lock = threading.RLock()
+        self._compacting = False
+        self.last_compaction_error: Optional[Exception] = None
+        # fn(signatur før, signatur etter) når store selv har kompaktert (se add_compaction_listener)
+        self._compaction_listeners: List[Callable[[tuple, tuple], None]] = []
+
+    # ---------- lesing ----------
+    def _current_journal(self, snap_id: str) -> Tuple[str, bytes]:
+        """Finn journalen som hører til snapshotet (evt. en ikke-fullført ``.next``)."""
+        for p in (self.journal_path, self.journal_path + ".next"):
+            raw = _read_bytes(p)
+            base, _, _ = _parse_journal(raw)
+            if base == snap_id:
+                return p, raw
+        return self.journal_path, b""
+
+    def load(self) -> Dict[str, Any]:
+        with self._lock:
+            snap_raw = _read_bytes(self.path)
+            db = load_snapshot_bytes(snap_raw)
+            snap_id = _digest(snap_raw)
+            jpath, jraw = self._current_journal(snap_id)
+            base, entries, good = _parse_journal(jraw)
+            _replay(db, entries)
+            if base != snap_id or jpath != self.journal_path or good != len(jraw):
+                # Rydd opp: utdatert/ufullstendig journal erstattes med en ren en
+                body = jraw[jraw.find(b"\n") + 1:good] if base == snap_id else b""
+                atomic_write_bytes(self.journal_path, _journal_header(snap_id) + body)
+                try:
+                    os.unlink(self.journal_path + ".next")
+                except FileNotFoundError:
+                    pass
+            return db
+
+    def signature(self) -> Tuple[Tuple[int, int], ...]:
+        """(mtime_ns, størrelse) for snapshot og journal – endres når noen skriver til filene."""
+        sig = []
+        for p in (self.path, self.journal_path):
+            try:
+                st = os.stat(p)
+                sig.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                sig.append((0, 0))
+        return tuple(sig)
+
+    def stamp(self) -> Dict[str, Any]:
+        """Hvor langt filene på disk er kommet: snapshotets md5, (mtime_ns, størrelse) og
+        journalens lengde + md5. Brukes av ``column_file`` for å se om kolonnefilen er utdatert."""
+        with self._lock:
+            snap_raw = _read_bytes(self.path)
+            st = os.stat(self.path) if snap_raw else None
+            jraw = _read_bytes(self.journal_path)
+        _, _, good = _parse_journal(jraw)
+        return {
+            "snapshot_md5": _digest(snap_raw),
+            "snapshot_sig": [st.st_mtime_ns, st.st_size] if st else [0, 0],
+            "journal_bytes": good,
+            "journal_md5": _digest(jraw[:good]),
+        }
+
+    def journal_since(self, stamp: Dict[str, Any]) -> Optional[Tuple[list, Dict[str, Any]]]:
+        """Journalpostene skrevet etter ``stamp`` + nytt stempel, eller ``None`` hvis snapshotet
+        er byttet ut, journalen er skrevet om eller ikke er ren (da må ``load`` brukes)."""
+        with self._lock:
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                return None
+            jraw = _read_bytes(self.journal_path)
+            snap_md5 = stamp.get("snapshot_md5")
+            if [st.st_mtime_ns, st.st_size] != stamp.get("snapshot_sig"):
+                # Kopiert/berørt fil (f.eks. ved utrulling): samme innhold er godt nok
+                if st.st_size != stamp.get("snapshot_sig", [0, 0])[1] or _digest(_read_bytes(self.path)) != snap_md5:
+                    return None
+            if os.path.exists(self.journal_path + ".next"):
+                return None
+        n = stamp.get("journal_bytes", 0)
+        base, _, good = _parse_journal(jraw)
+        if base != snap_md5 or good != len(jraw) or len(jraw) < n or _digest(jraw[:n]) != stamp.get("journal_md5"):
+            return None
+        _, entries, _ = _parse_journal(jraw[n:])
+        new_stamp = {**stamp, "snapshot_sig": [st.st_mtime_ns, st.st_size], "journal_bytes": len(jraw),
+                     "journal_md5": _digest(jraw)}
+        return entries, new_stamp
+
+    # ---------- skriving ----------
+    def append(self, changes: Dict[str, Any], deleted: Iterable[str] = ()) -> None:
+        """Legg endrede poster (hele verdien per nøkkel) og slettede nøkler til journalen."""
+        buf = b"".join(_journal_line(k, v) for k, v in changes.items())
+        buf += b"".join(_journal_line(k, _DELETED) for k in deleted)
+        if not buf:
+            return
+        with self._lock:
+            if not os.path.exists(self.journal_path):
+                atomic_write_bytes(self.journal_path, _journal_header(_digest(_read_bytes(self.path))))
+            with open(self.journal_path, "ab") as f:
+                f.write(buf)
+                f.flush()
+                os.fsync(f.fileno())
+            size = os.path.getsize(self.journal_path)
+        if size >= self.compact_bytes:
+            self.compact_in_background()
+
+    def write_snapshot(self, db: Dict[str, Any]) -> None:
+        """Skriv hele databasen som nytt snapshot og start en tom journal."""
+        raw = dump_snapshot_bytes(db)
+        with self._lock:
+            self._install(raw, b"")
+
+    def _install(self, snap_raw: bytes, tail: bytes) -> None:
+        # Ny journal skrives først som .next; load() finner den via base-md5 hvis
+        # vi krasjer mellom de to rename-operasjonene.
+        nxt = self.journal_path + ".next"
+        atomic_write_bytes(nxt, _journal_header(_digest(snap_raw)) + tail)
+        atomic_write_bytes(self.path, snap_raw)
+        os.replace(nxt, self.journal_path)
+
+    # ---------- kompaktering ----------
+    def journal_size(self) -> int:
+        try:
+            return os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            return 0
+
+    def compact(self) -> bool:
+        """Fold journalen inn i et nytt snapshot. Returnerer False hvis noe kom i veien."""
+        with self._lock:
+            snap_raw = _read_bytes(self.path)
+            snap_id = _digest(snap_raw)
+            jraw = _read_bytes(self.journal_path)
+        base, entries, good = _parse_journal(jraw)
+        if base != snap_id:
+            return False
+        # Tung jobb (parse + serialisering) uten lås; nye appends havner etter `good`
+        new_raw = dump_snapshot_bytes(_replay(load_snapshot_bytes(snap_raw), entries))
+        with self._lock:
+            cur = _read_bytes(self.journal_path)
+            if _digest(_read_bytes(self.path)) != snap_id or cur[:good] != jraw[:good]:
+                return False  # noen skrev fullt snapshot i mellomtiden
+            before = self.signature()
+            self._install(new_raw, cur[good:])
+            after = self.signature()
+            for fn in list(self._compaction_listeners):
+                fn(before, after)
+        return True
+
+    def add_compaction_listener(self, fn: Callable[[tuple, tuple], None]) -> None:
+        """``fn(før, etter)`` kalles etter hver kompaktering, med signaturene før og etter.
+
+        Kompakteringen endrer filene uten å endre innholdet; den som holder
+        databasen i minnet, kan da flytte sin signatur i stedet for å laste på nytt.
+        Kalles under store-låsen, så ``fn`` må ikke ta andre låser.
+        """
+        self._compaction_listeners.append(fn)
+
+    def compact_in_background(self) -> None:
+        with self._lock:
+            if self._compacting:
+                return
+            self._compacting = True
+
+        def run():
+            try:
+                self.compact()
+                self.last_compaction_error = None
+            except Exception as e:  # pragma: no cover - logges i UI
+                self.last_compaction_error = e
+            finally:
+                with self._lock:
+                    self._compacting = False
+
+        threading.Thread(target=run, name="journal-compaction", daemon=True).start()
+
+
+# ==========================================================
+# Én store per fil i prosessen
+# ==========================================================
+_STORES: Dict[str, Any] = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_store(path: str, compact_bytes: int = DEFAULT_COMPACT_BYTES, backend: str = "json", **kwargs):
+    """Delt store for ``path``. ``backend`` er ``"json"`` (snapshot + journal) eller ``"sqlite"``.
+
+    Ekstra nøkkelord sendes til ``SqliteStore`` (``default_scenario``, ``json_seed``).
+    """
+    key = os.path.abspath(path)
+    with _STORES_LOCK:
+        store = _STORES.get(key)
+        if store is None:
+            if backend == "sqlite":
+                from sqlite_store import SqliteStore
+                store = SqliteStore(path, **kwargs)
+            elif backend == "json":
+                store = JournalStore(path, compact_bytes=compact_bytes)
+            else:
+                raise ValueError(f"Ukjent lagringsbackend: {backend!r}")
+            _STORES[key] = store
+        return store
+
+
+def changes_for(db: Dict[str, Any], keys: Iterable[str]) -> Tuple[Dict[str, Any], list]:
+    """Del ``keys`` i (endrede verdier, slettede nøkler) ut fra nåværende ``db``."""
+    changes, deleted = {}, []
+    for k in keys:
+        if k in db:
+            changes[k] = db[k]
+        else:
+            deleted.append(k)
+    return changes, deleted
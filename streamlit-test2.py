@@ -1,15 +1,29 @@
-import json
+import time
+
+# Kald start: tiden fra første kjøring av skriptet i prosessen til første ferdige visning (se app_clock)
+_script_t0 = time.perf_counter()
+
 from datetime import datetime
+import io
 from pathlib import Path
-from typing import Dict, Any, Optional
+from collections.abc import Mapping
+from typing import Dict, Any, Iterable, List, Optional, Tuple
 from datetime import date
 
+import pandas as pd
 import streamlit as st
 
 st.set_page_config(page_title="EML-prototype", layout="wide")
 import streamlit as st, sys
 from pathlib import Path
-st.caption(f"DEBUG: fil={Path(__file__).name}  |  Streamlit={st.__version__}")
+
+# Tidtaking per kjøring – slås på i sidepanelet (⏱️ Tidtaking), koster ingenting når den er av
+from perf_trace import RerunTrace
+
+trace = RerunTrace(
+    enabled=st.session_state.get("perf_panel", False),
+    profile=st.session_state.pop("perf_profile_next", False),
+)
 import traceback
 import streamlit as st, traceback
 st.set_option("client.showErrorDetails", True)
@@ -34,44 +48,36 @@ st.caption(f"Kjører fil: {Path(__file__).resolve()}")
 # Konfig
 # ==========================================================
 DB_FILENAME = "risiko_db.json"
-SCENARIOS = ["Brann", "Skred", "Flom", "Annet"]
-
-# Forventede kolonner (case-insensitiv matching)
-EXPECTED_COLS = {
-    "kumulenr": "Kumulenr",
-    "risikonr": "Risikonr",
-    "forsnr": "Forsnr",
-    "adresse": "Adresse",
-    "kundenavn": "Kundenavn",
-    "tariffsum": "Tariffsum",
-}
+# Innholdshash per importert rad (delta-import av nye versjoner av uttrekket)
+IMPORT_MANIFEST_FILENAME = "risiko_db.import_manifest.json"
+# "json": risiko_db.json (+ journal), "sqlite": risiko_db.sqlite med indekser
+# (første gang fylles SQLite-filen fra risiko_db.json)
+STORAGE_BACKEND = "json"
+SQLITE_FILENAME = "risiko_db.sqlite"
+# "journal": kun endrede poster legges til i risiko_db.json.journal (foldes inn i bakgrunnen)
+# "snapshot": hele databasen skrives på nytt ved hver lagring
+STORAGE_MODE = "journal"
+JOURNAL_COMPACT_BYTES = 8 * 1024 * 1024
+# Versjoner av databasen (innholdsadressert, uendrede deler deles mellom versjoner)
+SNAPSHOT_DIR = DB_FILENAME + ".versjoner"
+# Binær kolonnefil ved siden av JSON (minnekartlegges ved oppstart i stedet for å tolke JSON)
+COLUMN_FILENAME = DB_FILENAME + ".kolonner"
+from eml_engine import SCENARIOS
+# Rader per side i rutenett-redigeringen (st.data_editor)
+GRID_PAGE_SIZE = 500
+
+# Forventede kolonner (case-insensitiv matching) – se excel_import.py
+from excel_import import EXPECTED_COLS
+from import_jobs import ImportJobs
+from whatif import WhatIfMatrix, base_sweep
+from spatial_index import SpatialIndex
+from excel_report import write_report
+from monte_carlo import DEFAULT_EVENTS, DEFAULT_SEED, TAIL_LEVEL, SimulationCache
+from snapshots import LiveTree, SnapshotStore, top_movers
 
 # ==========================================================
 # Hjelpere
 # ==========================================================
-DB_FILENAME = "risiko_db.json"
-
-def load_db_from_file(path):
-    import json
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            if isinstance(data, dict):
-                return data
-    except Exception as e:
-        st.warning(f"Klarte ikke å lese {path}, oppretter ny database ({e})")
-    return {"risikoer": [], "kumuler": []}
-
-def save_db_to_file(path, data):
-    import json
-    try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        st.error(f"Klarte ikke å lagre til {path}: {e}")
-
-# 👉 Last databasen her:
-db = load_db_from_file(DB_FILENAME)
 import hashlib
 from typing import Dict
 
@@ -91,101 +97,314 @@ def now_iso() -> str:
     return datetime.utcnow().isoformat(timespec="seconds") + "Z"
 
 
-def load_db_from_file(path: str) -> Dict[str, Any]:
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return data if isinstance(data, dict) else {}
-    except Exception:
-        st.error(...); st.stop() #return {}
+def page_slice(frame, key: str, page_size: int = GRID_PAGE_SIZE):
+    """Vis sidevelger når rammen er større enn én side. -> (utsnitt, sidenummer)."""
+    n_pages = max(1, -(-len(frame) // page_size))
+    if n_pages == 1:
+        return frame, 1
+    page = int(st.number_input(f"Side (av {n_pages})", min_value=1, max_value=n_pages, value=1, step=1, key=key))
+    start = (page - 1) * page_size
+    return frame.iloc[start:start + page_size], page
 
 
-def save_db_to_file(path: str, db: dict):
-    try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(db, f, ensure_ascii=False, indent=2)
-        return True, None
-    except Exception as e:
-        st.error(f"Feil: {e}")
-        st.exception(e)  # viser traceback i appen
-        st.stop()
+def changed_keys(orig, edited, cols) -> list:
+    """Indeksnøkler der minst én av ``cols`` er endret i en data_editor."""
+    diff = None
+    for c in cols:
+        d = orig[c].ne(edited[c])
+        diff = d if diff is None else (diff | d)
+    return list(orig.index[diff]) if diff is not None else []
 
-st.write("DEBUG: type(db)=", type(db).__name__) #sjekk at db faktisk inneholder noe
 
+from storage import get_store
+from shared_db import ConflictError, SharedDatabase
+from serialization import EXPORT_FORMATS, available_export_formats, export_bytes, import_bytes
+from schema import ZONES_KEY, migrate, zone_table
 
-# --- Enkel maskinell EML-modell (rate) ---
-BASE = 0.6
-ALPHA = [1.00, 1.15, 1.35, 1.60]
-BETA = [0.40, 0.30, 0.20, 0.10]
-GAMMA = [0.05, 0.10, 0.15, 0.20]
-EXPO = [1.30, 1.15, 1.00, 0.85]
 
+def db_store(path: str = DB_FILENAME):
+    if STORAGE_BACKEND == "sqlite":
+        return get_store(SQLITE_FILENAME, backend="sqlite",
+                         default_scenario=SCENARIOS[0], json_seed=path)
+    return get_store(path, JOURNAL_COMPACT_BYTES)
 
-def clamp01(x: float) -> float:
-    return max(0.0, min(1.0, float(x)))
 
+@st.cache_resource(show_spinner="Laster database …")
+def shared_database(backend: str, path: str) -> SharedDatabase:
+    # Én database (med akkumulerings- og søkeindeks) i minnet for alle sesjoner.
+    # JSON: snapshot + replay av journal, SQLite: alle rader
+    return SharedDatabase(db_store(path), SCENARIOS[0],
+                          snapshot_mode=(backend == "json" and STORAGE_MODE == "snapshot"),
+                          column_path=COLUMN_FILENAME if backend == "json" else None)
+
+
+@st.cache_resource
+def app_clock() -> Dict[str, Optional[float]]:
+    # Første kjøring i prosessen; "first_render" settes når den kjøringen er ferdig
+    return {"t0": _script_t0, "first_render": None}
+
+
+@st.cache_resource
+def import_jobs(backend: str, path: str) -> ImportJobs:
+    # Én importkø per prosess (importer deler manifest og database)
+    return ImportJobs(shared_database(backend, path), IMPORT_MANIFEST_FILENAME, SCENARIOS[0],
+                      per_chunk=(backend == "sqlite" or STORAGE_MODE == "journal"),
+                      snapshots=snapshot_store(SNAPSHOT_DIR))
+
+
+@st.cache_resource
+def snapshot_store(root: str) -> SnapshotStore:
+    return SnapshotStore(root)
 
-def calc_eml_rate_machine(rec: Dict[str, Any]) -> float:
-    # Prototyp – inntil vi kobler faktorer; gi 30 % default hvis mangler
-    try:
-        b = int(rec.get("brannrisiko", 0))
-        lim = int(rec.get("begrensende_faktorer", 0))
-        prot = int(rec.get("deteksjon_beskyttelse", 0))
-        expo = int(rec.get("eksponering_nabo", 0))
-        rate = BASE * ALPHA[b] * EXPO[expo]
-        rate *= (1 - BETA[prot])
-        rate *= (1 - GAMMA[lim])
-        return clamp01(rate)
-    except Exception:
-        return 0.30
 
+@st.cache_resource(show_spinner="Forbereder sammenligning mot gjeldende database …")
+def live_tree(backend: str, path: str) -> LiveTree:
+    # Bøttehashene for databasen i minnet bygges én gang per prosess; se synced_live_tree
+    shared = shared_database(backend, path)
+    with shared.lock:
+        return LiveTree(shared.db, shared.generation)
 
-def calc_eml_rate_effective(rec: Dict[str, Any]) -> float:
-    if rec.get("eml_rate_manual_on"):
-        return clamp01(float(rec.get("eml_rate_manual", 0.0)))
-    return calc_eml_rate_machine(rec)
 
+def synced_live_tree(backend: str, path: str) -> LiveTree:
+    # Kalles under shared.lock: regner om bare bøttene med nøkler skrevet siden sist
+    shared = shared_database(backend, path)
+    live = live_tree(backend, path)
+    if live.generation != shared.generation:
+        live.update(shared.db, shared.changed_since(live.generation), shared.generation)
+    return live
 
-def calc_eml_effective(rec: Dict[str, Any]) -> int:
+
+@st.cache_resource(max_entries=8, show_spinner="Sammenligner versjoner …")
+def version_diff(root: str, a: str, b: Optional[str], backend: str, path: str, generation: int) -> Dict[str, Any]:
+    # b = None: mot gjeldende database (generasjonen i nøkkelen); to lagrede versjoner endres aldri
+    snaps = snapshot_store(root)
+    if b is not None:
+        return snaps.diff(a, b, default_scenario=SCENARIOS[0])
+    shared = shared_database(backend, path)
+    with shared.lock:
+        return snaps.diff(a, None, db=shared.db, default_scenario=SCENARIOS[0],
+                          live=synced_live_tree(backend, path))
+
+
+def save_version(root: str, backend: str, path: str, label: str) -> Dict[str, Any]:
+    # Forrige versjon + risikoene som er endret siden; den første versjonen lagres hel
+    snaps = snapshot_store(root)
+    shared = shared_database(backend, path)
+    with shared.lock:
+        parent = snaps.latest()
+        if parent is None:
+            data = shared.db.to_dict()
+        else:
+            data = None
+            live = synced_live_tree(backend, path)
+            changes = {k: new for k, _, new in snaps.changes(parent, None, db=shared.db, live=live)}
+            meta = {k: shared.db[k] for k in shared.db.meta}
+    if data is not None:
+        return snaps.snapshot(data, label=label)
+    return snaps.snapshot_changes(changes, meta=meta, label=label, parent=parent)
+
+
+@st.cache_resource(max_entries=4)
+def version_listing(root: str, generation: int, revision: int) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    # Manifestene og lagerbruken (os.walk) leses bare når en versjon er lagret (revision)
+    # eller databasen er endret (en import lagrer versjonen fra arbeidstråden)
+    snaps = snapshot_store(root)
+    return snaps.versions(), snaps.storage()
+
+
+@st.cache_resource
+def mc_cache() -> SimulationCache:
+    # Halerisiko per kumulesone × scenario; regnes på nytt bare når risikoene i sonen endres
+    return SimulationCache()
+
+
+@st.cache_resource(max_entries=2, show_spinner="Forbereder what-if …")
+def whatif_matrix(backend: str, path: str, generation: int) -> WhatIfMatrix:
+    # Tolkes én gang per databasegenerasjon; parametersett caches inne i matrisen
+    return WhatIfMatrix(shared_database(backend, path).db, SCENARIOS[0])
+
+
+@st.cache_resource(max_entries=2, show_spinner="Bygger romlig indeks …")
+def spatial_index(backend: str, path: str, generation: int) -> SpatialIndex:
+    # Koordinatene legges i rutenettet én gang per databasegenerasjon; søkeresultater caches i indeksen
+    return SpatialIndex(shared_database(backend, path).db, SCENARIOS[0])
+
+
+def save_changes(patches: Dict[str, Any], replace: bool = False, check: bool = True) -> bool:
+    """Skriv endringer (nøkkel -> endrede felt, None = slett) til den delte databasen.
+
+    Med ``check`` avvises lagringen hvis en annen bruker har endret noen av postene
+    siden siden ble vist (optimistisk samtidighet med versjon per post).
+    """
+    global db
     try:
-        si = float(rec.get("sum_forsikring", 0) or 0)
-        return int(round(si * calc_eml_rate_effective(rec)))
-    except Exception:
-        return 0
+        with trace.span("lagre", len(patches)):
+            shared.commit(patches, read_at=read_at if check else None,
+                          replace=replace, own=own_writes if check else None)
+        db = shared.db
+        return True
+    except ConflictError as e:
+        st.warning(
+            f"{len(e.keys)} av risikoene er endret av en annen bruker siden siden ble vist – "
+            "ingenting ble lagret. Se over verdiene og lagre på nytt."
+        )
+        return False
+    except Exception as e:
+        st.error(f"Feil: {e}")
+        st.exception(e)  # viser traceback i appen
+        st.stop()
+
+
+
+# --- Enkel maskinell EML-modell (rate) – se eml_engine.py ---
+from eml_engine import (
+    BASE, ALPHA, BETA, GAMMA, EXPO, DEFAULT_PARAMS, EmlParams,
+    clamp01, calc_eml_rate_machine, calc_eml_rate_effective, calc_eml_effective,
+    calc_eml_records,
+)
 
 
 # ==========================================================
 # Session
 # ==========================================================
-if "db" not in st.session_state:
-    st.session_state.db = load_db_from_file(DB_FILENAME) or {}
-db: Dict[str, Any] = st.session_state.db
+# Delt for alle sesjoner; lastes på nytt bare når filen er endret utenfra (mtime)
+clock = app_clock()
+with trace.span("last DB (delt)"):
+    shared = shared_database(STORAGE_BACKEND, DB_FILENAME)
+with trace.span("sjekk fil (mtime)"):
+    shared.refresh()
+db: Dict[str, Any] = shared.db
+
+# Akkumulering per (kumulesone, scenario) og trigram-indeks for tekstfiltrene –
+# bygges én gang per prosess, oppdateres i SharedDatabase.commit
+from accumulation import BOARD_SIZE, AccumulationIndex
+from search_index import SearchIndex
+from db_views import build_db_frame, zone_headers, zone_items
+
+acc: AccumulationIndex = shared.acc
+search: SearchIndex = shared.search
+
+# Optimistisk samtidighet: lagring sjekkes mot generasjonen forrige kjøring ble vist i
+read_at = st.session_state.get("db_read_at", shared.generation)
+st.session_state.db_read_at = shared.generation
+own_writes: Dict[str, int] = st.session_state.setdefault("db_own_writes", {})
 
 # ==========================================================
 # Sidebar – Import/eksport
 # ==========================================================
+def save_status():
+    """Lagrestatus: ulagrede endringer (skrives i bakgrunnen) eller tidspunkt for siste lagring."""
+    s = shared.writer.status()
+    if s["error"] is not None:
+        st.error(f"💾 Lagring feilet, prøver igjen ({s['pending']} endringer venter): {s['error']}")
+    elif s["pending"]:
+        st.caption(f"💾 Ulagrede endringer: {s['pending']} – lagres om et øyeblikk")
+    elif s["saved_at"] is not None:
+        st.caption(f"✅ Alle endringer lagret kl. {s['saved_at']:%H:%M:%S}")
+    if s["pending"] and st.button("Lagre nå", key="flush_now"):
+        shared.flush()
+
+
 with st.sidebar:
+    # Oppdateres av seg selv så lenge noe venter på å bli skrevet
+    if shared.writer.pending():
+        st.fragment(run_every=2.0)(save_status)()
+    else:
+        save_status()
+    # Fylles inn nederst i skriptet (første visning er ferdig først da)
+    startup_slot = st.empty()
     st.header("📁 Import / eksport")
-    up_json = st.file_uploader("Last opp database (JSON)", type=["json"], key="json_up")
+    up_json = st.file_uploader("Last opp database (JSON, .json.gz, .json.zst, Parquet)",
+                               type=["json", "gz", "zst", "parquet"], key="json_up")
     if up_json is not None:
-        try:
-            loaded = json.load(up_json)
-            if isinstance(loaded, dict):
-                db.update(loaded)
-                save_db_to_file(DB_FILENAME, db)
-                st.success("Database importert.")
-                st.rerun()
-            else:
-                st.error("Filen må være et JSON-objekt (dict)")
-        except Exception as e:
-            st.error(f"Ugyldig JSON: {e}")
+        raw = up_json.getvalue()
+        up_md5 = hashlib.md5(raw).hexdigest()
+        # Filen blir liggende i opplasteren; importer den bare én gang
+        if st.session_state.get("json_up_md5") != up_md5:
+            try:
+                with trace.span("import JSON/Parquet") as sp:
+                    # Eldre eksporter (risikoer-liste, gamle feltnavn) gjøres om til gjeldende skjema
+                    loaded, _ = migrate(import_bytes(raw))
+                    loaded[ZONES_KEY] = zone_table([*loaded[ZONES_KEY], *(db.get(ZONES_KEY) or [])])
+                    sp.n = len(loaded)
+                if save_changes(loaded, replace=True, check=False):
+                    st.session_state.json_up_md5 = up_md5
+                    st.success("Database importert.")
+                    st.rerun()
+            except Exception as e:
+                st.error(f"Ugyldig fil: {e}")
+
+    # Eksporten lages først når noen ber om den (ikke ved hver kjøring)
+    formats = available_export_formats()
+    exp_fmt = st.selectbox("Eksportformat", formats, format_func=lambda f: EXPORT_FORMATS[f][0], key="export_fmt")
+    if st.button("Lag eksport", key="export_make"):
+        with trace.span("eksport (serialisering)", len(db)):
+            st.session_state.export_file = (exp_fmt, shared.generation, export_bytes(db, exp_fmt))
+    exp = st.session_state.get("export_file")
+    if exp is not None and exp[0] == exp_fmt:
+        _, exp_gen, exp_data = exp
+        label, suffix, mime = EXPORT_FORMATS[exp_fmt]
+        st.download_button(
+            f"⬇️ Last ned database – {label}",
+            data=exp_data,
+            file_name=f"risiko_db{suffix}",
+            mime=mime,
+        )
+        size = len(exp_data)
+        note = f"{size / 1e6:,.1f} MB".replace(",", " ") if size >= 1e6 else f"{size / 1e3:.0f} kB"
+        if exp_gen != shared.generation:
+            note += " – laget før siste endring i databasen, lag på nytt for å få med alt"
+        st.caption(note)
+
+    # Excel-rapport: sammendrag + ett ark per kumulesone (strømmes, se excel_report.py)
+    if st.button("📊 Lag Excel-rapport (akkumulering)", key="xlsx_report_make"):
+        bar = st.progress(0.0, text="Skriver Excel-rapport …")
+        buf = io.BytesIO()
+        # Totalene tas ut under låsen, så en import som går samtidig ikke blander seg inn
+        with shared.lock:
+            report_db, report_cells = shared.db, acc.cells()
+        with trace.span("Excel-rapport", len(report_db)):
+            stats = write_report(report_db, buf, SCENARIOS[0], cells=report_cells,
+                                 progress=lambda done, total: bar.progress(done / total,
+                                                                           text=f"Kumulesone {done} av {total}"))
+        bar.empty()
+        st.session_state.xlsx_report = (shared.generation, buf.getvalue(), stats)
+    xlsx = st.session_state.get("xlsx_report")
+    if xlsx is not None:
+        xlsx_gen, xlsx_data, xlsx_stats = xlsx
+        st.download_button(
+            "⬇️ Last ned Excel-rapport",
+            data=xlsx_data,
+            file_name="eml_akkumulering.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )
+        n_rows = f"{xlsx_stats['rows']:,}".replace(",", " ")
+        note = f"{xlsx_stats['zones']} kumulesoner, {n_rows} inkluderte risikoer ({xlsx_stats['seconds']:.1f} s)"
+        if xlsx_gen != shared.generation:
+            note += " – laget før siste endring i databasen, lag på nytt for å få med alt"
+        st.caption(note)
+
+    # Én data_editor per kumulesone i stedet for tusenvis av enkelt-widgets
+    grid_mode = st.toggle("Rutenett-redigering", value=True,
+                          help="Slå av for gammel visning med én rad med widgets per risiko.")
+
+    if st.button("🔍 Kontroller akkumulering"):
+        with shared.lock:
+            problems = acc.verify(shared.db)
+        if problems:
+            st.error(f"{len(problems)} avvik mellom indeks og full omberegning:")
+            st.write(problems[:50])
+        else:
+            st.success(f"Akkumuleringsindeksen stemmer ({len(acc)} risikoer).")
 
-    st.download_button(
-        "⬇️ Last ned database (JSON)",
-        data=json.dumps(db, ensure_ascii=False, indent=2),
-        file_name="risiko_db.json",
-        mime="application/json",
-    )
+    # Tidtaking per kjøring; tabellen fylles inn nederst i skriptet
+    with st.expander("⏱️ Tidtaking", expanded=False):
+        st.toggle("Vis tidtaking per kjøring", key="perf_panel")
+        if st.button("Profiler neste kjøring (cProfile)"):
+            st.session_state["perf_profile_next"] = True
+            st.rerun()
+        perf_slot = st.empty()
+        prof_slot = st.empty()
 
 # ==========================================================
 # Faner: Database og Scenario
@@ -194,12 +413,52 @@ with st.sidebar:
 
 
 
-tab_db, tab_scen = st.tabs(["📚 Database", "📈 EML-scenario"])
+tab_db, tab_scen, tab_whatif, tab_geo, tab_ver = st.tabs(
+    ["📚 Database", "📈 EML-scenario", "🧮 What-if", "🗺️ Sirkelsøk", "🕰️ Versjoner"]
+)
 
 # ----------------------------------------------------------
 # 📚 DATABASE – Import, filtrering og utvalg pr. kumulesone
 # ----------------------------------------------------------
 with tab_db:
+    # ---------- toppliste: største akkumuleringer i hele porteføljen ----------
+    # Ligger ferdig i akkumuleringsindeksen (oppdateres ved hver lagring); her er det bare oppslag
+    st.subheader("🏆 Største akkumuleringer")
+    board_n = int(st.number_input("Antall kumulesoner × scenarioer", min_value=1, max_value=BOARD_SIZE,
+                                  value=5, step=1, key="board_n"))
+    with trace.span("toppliste") as sp:
+        # Importjobben oppdaterer indeksen fra sin egen tråd; les under låsen
+        with shared.lock:
+            board = acc.leaderboard(board_n)
+        sp.n = len(board)
+        if not board:
+            st.info("Ingen inkluderte risikoer ennå.")
+        else:
+            st.dataframe(
+                pd.DataFrame({
+                    "Plass": list(range(1, len(board) + 1)),
+                    "Kumulesone": [c["kumulesone"] for c in board],
+                    "Scenario": [c["scenario"] for c in board],
+                    "Sum EML inkl.": [int(c["eml_inc"]) for c in board],
+                    "Sum SI inkl.": [round(c["si_inc"]) for c in board],
+                    "Antall inkl.": [int(c["n_inc"]) for c in board],
+                    "Overstyrt inkl.": [int(c["n_manual_inc"]) for c in board],
+                }),
+                hide_index=True,
+            )
+            with st.expander(f"Største enkeltrisikoer (inntil {board_n} per kumulesone × scenario)", expanded=False):
+                top_rows = []
+                for place, c in enumerate(board, start=1):
+                    for k, eml, si in c["risks"]:
+                        r = db.get(k) or {}
+                        top_rows.append({
+                            "Plass": place, "Kumulesone": c["kumulesone"], "Scenario": c["scenario"],
+                            "Forsnr": str(r.get("forsnr", "")), "Risikonr": str(r.get("risikonr", "")),
+                            "Kunde": str(r.get("kundenavn", "")), "Adresse": str(r.get("adresse", "")),
+                            "SI": round(si), "EML (effektiv)": int(eml),
+                        })
+                st.dataframe(pd.DataFrame(top_rows), hide_index=True)
+
     st.subheader("1) Last opp Excel og importer alle rader")
 
 with st.expander("Forventede Excel-kolonner", expanded=False):
@@ -207,90 +466,99 @@ with st.expander("Forventede Excel-kolonner", expanded=False):
 
 up_xlsx = st.file_uploader("Last opp Excel (.xlsx)", type=["xlsx"], key="xlsx_all")
 
-# Init import-state
-if "last_import_md5" not in st.session_state:
-    st.session_state.last_import_md5 = None
+remove_missing = st.checkbox(
+    "Fjern risikoer som ikke lenger finnes i uttrekket", value=False,
+    help="Gjelder bare rader som kom fra forrige Excel-import (ikke manuelt registrerte).",
+)
 
 # Vis knapp kun hvis fil er valgt
 can_import = up_xlsx is not None
 do_import = st.button("📥 Importer fra valgt fil", disabled=not can_import)
 
+# Importen kjøres som bakgrunnsjobb; resten av appen kan brukes imens.
+# Jobbene (og resultatene) huskes per sesjon, også etter at opplasteren er tømt.
+jobs = import_jobs(STORAGE_BACKEND, DB_FILENAME)
+my_job_ids = st.session_state.setdefault("import_job_ids", [])
 if do_import and up_xlsx is not None:
-    try:
-        import pandas as pd, io
-        raw = up_xlsx.read()
-        file_hash = md5_bytes(raw)
+    job = jobs.submit(bytes(up_xlsx.getbuffer()), up_xlsx.name, remove_missing=remove_missing)
+    my_job_ids.append(job.id)
 
-        # Hindre dobbelt-import av samme fil
-        if file_hash == st.session_state.last_import_md5:
-            st.info("Samme fil er allerede importert. Ingen endringer.")
-        else:
-            df = pd.read_excel(io.BytesIO(raw), engine="openpyxl")
-            st.caption(f"📄 Kolonner funnet: {list(df.columns)}")
 
-            df.columns = [str(c).strip() for c in df.columns]
-            lower = {c.lower(): c for c in df.columns}
-            def col(k: str) -> Optional[str]: return lower.get(EXPECTED_COLS[k].lower())
+def _fmt_int(n: int) -> str:
+    return f"{n:,}".replace(",", " ")
+
 
-            required = ["kumulenr", "risikonr"]
-            missing = [EXPECTED_COLS[k] for k in required if col(k) is None]
-            if missing:
-                st.error("Mangler påkrevde kolonner: " + ", ".join(missing))
+def render_import_jobs():
+    my_jobs = [j for j in (jobs.get(i) for i in my_job_ids) if j is not None]
+    active = any(j.active for j in my_jobs)
+    # Ferdig siden forrige visning: kjør hele siden på nytt så tabellene viser de nye radene
+    if st.session_state.get("import_active") and not active:
+        st.session_state.import_active = False
+        st.rerun()
+    st.session_state.import_active = active
+    others = [j for j in jobs.active() if j.id not in my_job_ids]
+    for job in reversed(my_jobs[-5:]):
+        title = f"Import {job.id} – {job.filename}"
+        if job.active:
+            if job.status == "venter":
+                wait = " (venter på en annen import)" if others else ""
+                st.progress(0.0, text=f"{title}: i kø{wait}")
             else:
-                imported = 0
-                for _, row in df.iterrows():
-                    kumule = str(row.get(col("kumulenr"), ""))
-                    risiko = str(row.get(col("risikonr"), ""))
-                    forsnr = str(row.get(col("forsnr"), ""))
-                    adresse = str(row.get(col("adresse"), ""))
-                    kunde = str(row.get(col("kundenavn"), ""))
-
-                    navn = f"{kumule}-{risiko}-{adresse}".strip("-")
-
-                    try:
-                        si = float(row.get(col("tariffsum"), 0) or 0)
-                    except Exception:
-                        si = 0.0
-
-                    rec = db.get(navn, {})
-                    rec.update({
-                        "kumulesone": kumule,
-                        "risikonr": risiko,
-                        "forsnr": forsnr,
-                        "adresse": adresse,
-                        "kundenavn": kunde,
-                        "sum_forsikring": si,
-                        "eml_rate_manual_on": rec.get("eml_rate_manual_on", False),
-                        "eml_rate_manual": rec.get("eml_rate_manual", 0.0),
-                        "include": rec.get("include", False),
-                        "scenario": rec.get("scenario", SCENARIOS[0]),
-                        "updated": now_iso(),
-                    })
-                    db[navn] = rec
-                    imported += 1
-
-                ok, err = save_db_to_file(DB_FILENAME, db)
-                if ok:
-                    st.success(f"Importert {imported} rader til databasen.")
-                    st.session_state.last_import_md5 = file_hash
-                    # Ikke rerun automatisk; la brukeren se status og tabell under.
-                else:
-                    st.error(f"Kunne ikke lagre DB: {err}")
-    except Exception as e:
-        st.error(f"Kunne ikke lese Excel: {e}")
+                total = f" av {_fmt_int(job.rows_total)}" if job.rows_total else ""
+                st.progress(job.fraction(), text=(
+                    f"{title}: {_fmt_int(job.rows_parsed)}{total} rader lest, "
+                    f"{_fmt_int(job.rows_merged)} flettet inn ({job.seconds():.0f} s)"))
+            st.button("Avbryt", key=f"import_cancel_{job.id}", on_click=job.cancel,
+                      disabled=job.cancelled())
+        elif job.status == "feilet":
+            st.error(f"{title}: {job.error}")
+        elif job.status == "avbrutt":
+            st.warning(f"{title}: avbrutt etter {_fmt_int(job.rows_parsed)} rader – "
+                       f"{_fmt_int(job.rows_merged)} rader var allerede lagret og blir stående.")
+        elif job.duplicate:
+            st.info(f"{title}: samme fil er allerede importert. Ingen endringer.")
+        elif job.result is not None:
+            res = job.result
+            rate = _fmt_int(round(res["rows_per_sec"]))
+            st.success(
+                f"{title}: lest {_fmt_int(res['rows'])} rader ({res['seconds']:.1f} s – {rate} rader/s): "
+                f"{len(res['inserted'])} nye, {len(res['changed'])} endret, "
+                f"{res['unchanged']} uendret, {len(res['removed'])} fjernet, {len(res['rejected'])} avvist."
+                + (f" Lagret som versjon {job.version}." if job.version else "")
+            )
+            with st.expander(f"Detaljer for import {job.id}", expanded=False):
+                st.caption(f"📄 Kolonner funnet: {res['columns']}")
+                if res["rejected"]:
+                    st.write(f"**Avviste rader** ({len(res['rejected'])}):")
+                    st.dataframe(pd.DataFrame(res["rejected"][:1000]), hide_index=True)
+                for label, keys in (("Nye", res["inserted"]), ("Endret", res["changed"]),
+                                    ("Fjernet", res["removed"])):
+                    if keys:
+                        st.write(f"**{label}** ({len(keys)}):")
+                        st.write(", ".join(keys[:200]) + (" …" if len(keys) > 200 else ""))
+    if my_jobs and not active and st.button("Skjul importresultater", key="import_clear"):
+        my_job_ids.clear()
+        st.rerun()
+
+
+# Oppdateres av seg selv hvert sekund så lenge en import pågår
+if any(j.active for j in (jobs.get(i) for i in my_job_ids) if j is not None):
+    st.fragment(run_every=1.0)(render_import_jobs)()
+else:
+    render_import_jobs()
 
 
-    st.markdown("---")
-    st.subheader("2) Filtrer og velg per kumulesone")
+st.markdown("---")
+st.subheader("2) Filtrer og velg per kumulesone")
 
-    # Tekstfiltre
-    colf1, colf2, colf3 = st.columns(3)
-    with colf1:
-        filt_kunde = st.text_input("Filter: Kunde inneholder", value="")
-    with colf2:
-        filt_adresse = st.text_input("Filter: Adresse inneholder", value="")
-    with colf3:
-        filt_kumule = st.text_input("Filter: Kumulesone inneholder", value="")
+# Tekstfiltre
+colf1, colf2, colf3 = st.columns(3)
+with colf1:
+    st.text_input("Filter: Kunde inneholder", value="", key="filt_kunde")
+with colf2:
+    st.text_input("Filter: Adresse inneholder", value="", key="filt_adresse")
+with colf3:
+    st.text_input("Filter: Kumulesone inneholder", value="", key="filt_kumule")
 # Sikre at filtre finnes (default tomme)
 filt_kunde = st.session_state.get("filt_kunde", "")
 filt_adresse = st.session_state.get("filt_adresse", "")
@@ -304,110 +572,122 @@ try:
     # Liten statusboks så vi ser at DB faktisk er fylt
     st.caption(f"🔎 Objekter i database: {len(db)}")
 
-    rows = []
-    for key, r in db.items():
-        if not isinstance(r, dict):
-            continue
-        rows.append({
-            "_key": key,
-            "Kumulesone": str(r.get("kumulesone", "")),
-            "Forsnr": str(r.get("forsnr", "")),
-            "Risikonr": str(r.get("risikonr", "")),
-            "Kunde": str(r.get("kundenavn", "")),
-            "Adresse": str(r.get("adresse", "")),
-            "Sum forsikring": float(r.get("sum_forsikring", 0) or 0),
-            "EML (effektiv)": calc_eml_effective(r),
-            "Kilde": ("🟩 Manuell" if bool(r.get("eml_rate_manual_on", False)) else "⚙️ Maskinell"),
-            "Inkluder": bool(r.get("include", False)),
-            "Scenario": r.get("scenario", SCENARIOS[0]),
-        })
-
-    df = pd.DataFrame(rows)
+    with trace.span("tabell (DataFrame)", len(db)) as sp:
+        df = build_db_frame(db, SCENARIOS[0])
+        sp.n = len(df)
+    # Kolonner i rutenettet per kumulesone
+    GRID_COLS = ["Forsnr", "Risikonr", "Kunde", "Adresse", "Sum forsikring",
+                 "EML (effektiv)", "Kilde", "Inkluder", "Scenario"]
 
     if df.empty:
         st.info("Ingen data i databasen. Last opp Excel over.")
     else:
-        # Filtrene
-        m = pd.Series([True] * len(df))
-        if filt_kunde:
-            m &= df["Kunde"].astype(str).str.contains(filt_kunde, case=False, na=False)
-        if filt_adresse:
-            m &= df["Adresse"].astype(str).str.contains(filt_adresse, case=False, na=False)
-        if filt_kumule:
-            m &= df["Kumulesone"].astype(str).str.contains(filt_kumule, case=False, na=False)
-        dfv = df[m].copy()
+        # Filtrene – snitt av posting-lister i trigram-indeksen (samme treff som str.contains)
+        with trace.span("filter") as sp:
+            with shared.lock:
+                hits = search.filter(kunde=filt_kunde, adresse=filt_adresse, kumule=filt_kumule)
+            dfv = df if hits is None else df[df["_key"].isin(hits)].copy()
+            sp.n = len(dfv)
 
         if dfv.empty:
             st.warning("Filtrene dine skjuler alle rader. Tøm filtrene for å se alt.")
         else:
-            # Gruppér og vis per kumulesone
-            for kumule, grp in dfv.groupby("Kumulesone", dropna=False):
-                total_si = int(grp["Sum forsikring"].sum())
-                total_eml_inc = int(df[(df["Kumulesone"] == kumule) & (df["Inkluder"])]["EML (effektiv)"].sum())
-                with st.expander(
-                    f"Kumulesone {kumule} – {len(grp)} risikoer | "
-                    f"Sum SI: {total_si:,.0f} | Sum EML (inkluderte): {total_eml_inc:,.0f}".replace(",", " "),
-                    expanded=False,
-                ):
-                    sc_col1, sc_col2, sc_col3 = st.columns([2, 1, 1])
-                    with sc_col1:
-                        scen_label = st.selectbox(
-                            f"Scenario for kumule {kumule}", options=SCENARIOS, index=0, key=f"scen_{kumule}"
-                        )
-                    with sc_col2:
-                        if st.button("Velg ALLE i kumule", key=f"selall_{kumule}"):
-                            for _, row in grp.iterrows():
-                                k = row["_key"]
-                                db[k]["include"] = True
-                                db[k]["scenario"] = scen_label
-                            save_db_to_file(DB_FILENAME, db)
-                            st.rerun()
-                    with sc_col3:
-                        if st.button("Fjern ALLE i kumule", key=f"clrall_{kumule}"):
-                            for _, row in grp.iterrows():
+            # Gruppér og vis per kumulesone; EML (inkluderte) er O(1)-oppslag i akkumuleringsindeksen
+            with trace.span("sonetotaler (groupby)") as sp:
+                with shared.lock:
+                    headers = zone_headers(dfv, acc)
+                sp.n = len(headers)
+            with trace.span("render kumulesoner", len(headers)):
+                for kumule, grp in dfv.groupby("Kumulesone", dropna=False, observed=True):
+                    _, total_si, total_eml_inc = headers[kumule]
+                    with st.expander(
+                        f"Kumulesone {kumule} – {len(grp)} risikoer | "
+                        f"Sum SI: {total_si:,.0f} | Sum EML (inkluderte): {total_eml_inc:,.0f}".replace(",", " "),
+                        expanded=False,
+                    ):
+                        sc_col1, sc_col2, sc_col3 = st.columns([2, 1, 1])
+                        with sc_col1:
+                            scen_label = st.selectbox(
+                                f"Scenario for kumule {kumule}", options=SCENARIOS, index=0, key=f"scen_{kumule}"
+                            )
+                        with sc_col2:
+                            if st.button("Velg ALLE i kumule", key=f"selall_{kumule}"):
+                                if save_changes({k: {"include": True, "scenario": scen_label} for k in grp["_key"]}):
+                                    st.rerun()
+                        with sc_col3:
+                            if st.button("Fjern ALLE i kumule", key=f"clrall_{kumule}"):
+                                if save_changes({k: {"include": False} for k in grp["_key"]}):
+                                    st.rerun()
+
+                        st.write("**Risikoer i kumulesonen:**")
+                        if grid_mode:
+                            view, page = page_slice(
+                                grp.sort_values(["Risikonr"]).set_index("_key"), key=f"page_{kumule}"
+                            )
+                            view = view[GRID_COLS].copy()
+                            view["Scenario"] = view["Scenario"].where(view["Scenario"].isin(SCENARIOS), SCENARIOS[0])
+                            edited = st.data_editor(
+                                view,
+                                key=f"grid_{kumule}_{page}",
+                                hide_index=True,
+                                disabled=[c for c in GRID_COLS if c not in ("Inkluder", "Scenario")],
+                                column_config={
+                                    "Sum forsikring": st.column_config.NumberColumn(format="%.0f"),
+                                    "EML (effektiv)": st.column_config.NumberColumn(format="%d"),
+                                    "Inkluder": st.column_config.CheckboxColumn("Inkl."),
+                                    "Scenario": st.column_config.SelectboxColumn("Scen.", options=SCENARIOS, required=True),
+                                },
+                            )
+                            if st.button("💾 Lagre utvalg i denne kumulesonen", key=f"save_{kumule}"):
+                                # Bare rader som faktisk er endret skrives tilbake
+                                keys = [k for k in changed_keys(view, edited, ["Inkluder", "Scenario"]) if k in db]
+                                stamp = now_iso()
+                                patches = {}
+                                for k in keys:
+                                    val = bool(edited.at[k, "Inkluder"])
+                                    patches[k] = {"include": val, "updated": stamp}
+                                    if val:
+                                        patches[k]["scenario"] = edited.at[k, "Scenario"]
+                                if save_changes(patches):
+                                    st.success(f"Valg lagret for kumulesonen ({len(keys)} endret).")
+                        else:
+                            # Radvis avhuking med mer info
+                            changed_include: Dict[str, bool] = {}
+                            changed_scenario: Dict[str, str] = {}
+                            for _, row in grp.sort_values(["Risikonr"]).iterrows():
                                 k = row["_key"]
-                                db[k]["include"] = False
-                            save_db_to_file(DB_FILENAME, db)
-                            st.rerun()
-
-                    # Radvis avhuking med mer info
-                    changed_include: Dict[str, bool] = {}
-                    changed_scenario: Dict[str, str] = {}
-                    st.write("**Risikoer i kumulesonen:**")
-                    for _, row in grp.sort_values(["Risikonr"]).iterrows():
-                        k = row["_key"]
-                        c1, c2, c3, c4, c5, c6, c7, c8 = st.columns([1.2, 1.2, 2.2, 3, 1.6, 1.8, 1, 1.6])
-                        c1.write(str(row["Forsnr"]))
-                        c2.write(str(row["Risikonr"]))
-                        c3.write(str(row["Kunde"]))
-                        c4.write(str(row["Adresse"]))
-                        c5.write(f"{int(row['Sum forsikring']):,}".replace(",", " "))
-
-                        src_is_manual = bool(db.get(k, {}).get("eml_rate_manual_on", False))
-                        c6.write(
-                            (
-                                f"EML≈ {int(row['EML (effektiv)']):,}\n"
-                                f"{'🟩 Manuell' if src_is_manual else '⚙️ Maskinell'}"
-                            ).replace(",", " ")
-                        )
-
-                        changed_include[k] = c7.checkbox("Inkl.", value=bool(row["Inkluder"]), key=f"inc_{k}")
-                        current_scen = row["Scenario"] if row["Scenario"] in SCENARIOS else SCENARIOS[0]
-                        changed_scenario[k] = c8.selectbox(
-                            "Scen.", options=SCENARIOS, index=SCENARIOS.index(current_scen), key=f"sce_{k}"
-                        )
-
-                    if st.button("💾 Lagre utvalg i denne kumulesonen", key=f"save_{kumule}"):
-                        for k, val in changed_include.items():
-                            if k in db:
-                                db[k]["include"] = bool(val)
-                                if val:
-                                    db[k]["scenario"] = changed_scenario.get(
-                                        k, db[k].get("scenario", SCENARIOS[0])
-                                    )
-                                db[k]["updated"] = now_iso()
-                        save_db_to_file(DB_FILENAME, db)
-                        st.success("Valg lagret for kumulesonen.")
+                                c1, c2, c3, c4, c5, c6, c7, c8 = st.columns([1.2, 1.2, 2.2, 3, 1.6, 1.8, 1, 1.6])
+                                c1.write(str(row["Forsnr"]))
+                                c2.write(str(row["Risikonr"]))
+                                c3.write(str(row["Kunde"]))
+                                c4.write(str(row["Adresse"]))
+                                c5.write(f"{int(row['Sum forsikring']):,}".replace(",", " "))
+
+                                src_is_manual = bool(db.get(k, {}).get("eml_rate_manual_on", False))
+                                c6.write(
+                                    (
+                                        f"EML≈ {int(row['EML (effektiv)']):,}\n"
+                                        f"{'🟩 Manuell' if src_is_manual else '⚙️ Maskinell'}"
+                                    ).replace(",", " ")
+                                )
+
+                                changed_include[k] = c7.checkbox("Inkl.", value=bool(row["Inkluder"]), key=f"inc_{k}")
+                                current_scen = row["Scenario"] if row["Scenario"] in SCENARIOS else SCENARIOS[0]
+                                changed_scenario[k] = c8.selectbox(
+                                    "Scen.", options=SCENARIOS, index=SCENARIOS.index(current_scen), key=f"sce_{k}"
+                                )
+
+                            if st.button("💾 Lagre utvalg i denne kumulesonen", key=f"save_{kumule}"):
+                                patches = {}
+                                for k, val in changed_include.items():
+                                    if k in db:
+                                        patches[k] = {"include": bool(val), "updated": now_iso()}
+                                        if val:
+                                            patches[k]["scenario"] = changed_scenario.get(
+                                                k, db[k].get("scenario", SCENARIOS[0])
+                                            )
+                                if save_changes(patches):
+                                    st.success("Valg lagret for kumulesonen.")
 
 except Exception as e:
     st.error(f"Visningsfeil: {e}")
@@ -428,16 +708,24 @@ st.set_option("client.showErrorDetails", True)
 with tab_scen:
     st.subheader("Velg kumulesone og scenario for beregning og overstyring")
 
-    # --- Defensive logging ---
-    st.write("DEBUG: type(db)=", type(db).__name__)
-    if not isinstance(db, dict):
-        st.error("DB er ikke et dict. Sjekk load_db_from_file().")
+    if not isinstance(db, Mapping):
+        st.error("DB er ikke en mapping. Sjekk shared_database().")
         st.stop()
 
     # Finn tilgjengelige kumulesoner (tomme filtreres bort)
     try:
-        kumuler = sorted({str(r.get("kumulesone", "")).strip()
-                          for r in db.values() if isinstance(r, dict)} - {""})
+        with trace.span("kumulesoneliste") as sp:
+            if STORAGE_BACKEND == "sqlite":
+                # Lesingene går rett mot SQLite; endringer i skrivekøen må stå der først
+                shared.flush()
+                kumuler = db_store().kumuler()
+            else:
+                # Sonene står allerede i akkumuleringsindeksen; ingen gjennomgang av alle poster.
+                # Kopien tas under låsen (importjobben legger til soner fra sin egen tråd)
+                with shared.lock:
+                    zone_ids = acc.zones()
+                kumuler = sorted({z.strip() for z in zone_ids} - {""})
+            sp.n = len(kumuler)
     except Exception as e:
         st.error("Klarte ikke å lese kumuler fra db.")
         st.exception(e)
@@ -458,85 +746,320 @@ with tab_scen:
             changed_manual_rate: Dict[str, float] = {}
 
             # Kopi av items for å unngå mutasjon-while-iterasjon-problemer
-            db_items = list(db.items())
-
-            for k, r in db_items:
-                if not isinstance(r, dict):
-                    continue
-                if str(r.get("kumulesone", "")) != str(sel_kumule):
-                    continue
-                if not bool(r.get("include", False)):
-                    continue
-                if str(r.get("scenario", SCENARIOS[0])) != scen:
-                    continue
-
-                si = float(r.get("sum_forsikring", 0) or 0)
-                try:
-                    rate_machine = calc_eml_rate_machine(r)
-                except Exception as e:
-                    rate_machine = 0.0
-                    st.warning(f"Kunne ikke beregne maskin-sats for {k}: {e}")
-
-                manual_on_default = bool(r.get("eml_rate_manual_on", False))
-                manual_rate_default = float(r.get("eml_rate_manual", 0.0)) * 100.0
-
-                c1, c2, c3, c4, c5, c6, c7, c8 = st.columns([1.2, 1.2, 2.2, 3, 1.6, 1.6, 1.2, 1.8])
-                c1.write(str(r.get("forsnr", "")))
-                c2.write(str(r.get("risikonr", "")))
-                c3.write(str(r.get("kundenavn", "")))
-                c4.write(str(r.get("adresse", "")))
-                c5.write(f"SI {int(si):,}".replace(",", " "))
-                c6.write(f"Mask.sats {rate_machine*100:.1f}%")
-                changed_manual_on[k] = c7.checkbox("Overstyr", value=manual_on_default, key=f"ovr_{k}")
-                changed_manual_rate[k] = c8.number_input(
-                    "Manuell %", min_value=0.0, max_value=100.0, step=0.5,
-                    value=manual_rate_default, key=f"mrate_{k}"
-                )
-
-                eff_rate = (changed_manual_rate[k] / 100.0) if changed_manual_on[k] else rate_machine
-                eml_val = int(round(si * eff_rate))
-                st.markdown(f"**EML (effektiv):** {eml_val:,.0f} NOK".replace(",", " "))
-                st.markdown("---")
-
-            if st.button("💾 Lagre manuelle overstyringer for denne kumulesonen"):
-                for k, on_val in changed_manual_on.items():
-                    if k in db and isinstance(db[k], dict):
-                        db[k]["eml_rate_manual_on"] = bool(on_val)
-                        db[k]["eml_rate_manual"] = float(changed_manual_rate.get(k, 0.0)) / 100.0
-                        db[k]["updated"] = now_iso()
-                save_db_to_file(DB_FILENAME, db)
-                st.success("Overstyringer lagret.")
+            with trace.span("scenario-utvalg") as sp:
+                if STORAGE_BACKEND == "sqlite":
+                    # Kun radene for valgt kumulesone/scenario hentes (indeks på sone, scenario, include)
+                    shared.flush()
+                    db_items = db_store().records_in(str(sel_kumule), scenario=scen, include=True)
+                else:
+                    db_items = zone_items(db, sel_kumule, scen, SCENARIOS[0])
+                sp.n = len(db_items)
+            # Maskinsats og EML for hele utvalget i én runde
+            with trace.span("EML-beregning", len(db_items)):
+                batch = calc_eml_records(r for _, r in db_items)
+
+            with trace.span("render scenario", len(db_items)):
+                if grid_mode:
+                    import numpy as np
+
+                    frame = pd.DataFrame(
+                        {
+                            "Forsnr": [str(r.get("forsnr", "")) for _, r in db_items],
+                            "Risikonr": [str(r.get("risikonr", "")) for _, r in db_items],
+                            "Kunde": [str(r.get("kundenavn", "")) for _, r in db_items],
+                            "Adresse": [str(r.get("adresse", "")) for _, r in db_items],
+                            "SI": [float(r.get("sum_forsikring", 0) or 0) for _, r in db_items],
+                            "Mask.sats %": batch["rate_machine"] * 100.0,
+                            "Overstyr": [bool(r.get("eml_rate_manual_on", False)) for _, r in db_items],
+                            "Manuell %": [float(r.get("eml_rate_manual", 0.0)) * 100.0 for _, r in db_items],
+                            "EML (lagret)": batch["eml"],
+                        },
+                        index=[k for k, _ in db_items],
+                    )
+                    view, page = page_slice(frame, key=f"spage_{sel_kumule}_{scen}")
+                    edited = st.data_editor(
+                        view,
+                        key=f"sgrid_{sel_kumule}_{scen}_{page}",
+                        hide_index=True,
+                        disabled=[c for c in view.columns if c not in ("Overstyr", "Manuell %")],
+                        column_config={
+                            "SI": st.column_config.NumberColumn(format="%.0f"),
+                            "Mask.sats %": st.column_config.NumberColumn(format="%.1f"),
+                            "Overstyr": st.column_config.CheckboxColumn(),
+                            "Manuell %": st.column_config.NumberColumn(min_value=0.0, max_value=100.0, step=0.5, format="%.1f"),
+                            "EML (lagret)": st.column_config.NumberColumn(format="%d"),
+                        },
+                    )
+                    # EML for siden med ulagrede endringer (vektorisert)
+                    eff_rate = np.where(edited["Overstyr"], edited["Manuell %"].fillna(0.0) / 100.0,
+                                        edited["Mask.sats %"] / 100.0)
+                    eml_page = int(np.rint(edited["SI"].to_numpy() * eff_rate).sum())
+                    eml_page_txt = f"{eml_page:,.0f}".replace(",", " ")
+                    st.markdown(f"**EML (effektiv) på siden, inkl. ulagrede endringer:** {eml_page_txt} NOK")
+
+                    if st.button("💾 Lagre manuelle overstyringer for denne kumulesonen"):
+                        keys = [k for k in changed_keys(view, edited, ["Overstyr", "Manuell %"])
+                                if k in db and isinstance(db[k], dict)]
+                        stamp = now_iso()
+                        # Tømt celle (NaN) lagres som 0 %, samme regel som forhåndsvisningen over
+                        rates = edited["Manuell %"].fillna(0.0)
+                        patches = {
+                            k: {
+                                "eml_rate_manual_on": bool(edited.at[k, "Overstyr"]),
+                                "eml_rate_manual": float(rates.at[k]) / 100.0,
+                                "updated": stamp,
+                            }
+                            for k in keys
+                        }
+                        if save_changes(patches):
+                            st.success(f"Overstyringer lagret ({len(keys)} endret).")
+                else:
+                    for (k, r), rate_machine in zip(db_items, batch["rate_machine"].tolist()):
+                        si = float(r.get("sum_forsikring", 0) or 0)
+
+                        manual_on_default = bool(r.get("eml_rate_manual_on", False))
+                        manual_rate_default = float(r.get("eml_rate_manual", 0.0)) * 100.0
+
+                        c1, c2, c3, c4, c5, c6, c7, c8 = st.columns([1.2, 1.2, 2.2, 3, 1.6, 1.6, 1.2, 1.8])
+                        c1.write(str(r.get("forsnr", "")))
+                        c2.write(str(r.get("risikonr", "")))
+                        c3.write(str(r.get("kundenavn", "")))
+                        c4.write(str(r.get("adresse", "")))
+                        c5.write(f"SI {int(si):,}".replace(",", " "))
+                        c6.write(f"Mask.sats {rate_machine*100:.1f}%")
+                        changed_manual_on[k] = c7.checkbox("Overstyr", value=manual_on_default, key=f"ovr_{k}")
+                        changed_manual_rate[k] = c8.number_input(
+                            "Manuell %", min_value=0.0, max_value=100.0, step=0.5,
+                            value=manual_rate_default, key=f"mrate_{k}"
+                        )
+
+                        eff_rate = (changed_manual_rate[k] / 100.0) if changed_manual_on[k] else rate_machine
+                        eml_val = int(round(si * eff_rate))
+                        st.markdown(f"**EML (effektiv):** {eml_val:,.0f} NOK".replace(",", " "))
+                        st.markdown("---")
+
+                    if st.button("💾 Lagre manuelle overstyringer for denne kumulesonen"):
+                        patches = {}
+                        for k, on_val in changed_manual_on.items():
+                            if k in db and isinstance(db[k], dict):
+                                patches[k] = {
+                                    "eml_rate_manual_on": bool(on_val),
+                                    "eml_rate_manual": float(changed_manual_rate.get(k, 0.0)) / 100.0,
+                                    "updated": now_iso(),
+                                }
+                        if save_changes(patches):
+                            st.success("Overstyringer lagret.")
 
             # ---------- Totaler ----------
-            rows_tot = []
-            for k, r in db_items:
-                if not isinstance(r, dict):
-                    continue
-                if str(r.get("kumulesone", "")) != str(sel_kumule):
-                    continue
-                if not bool(r.get("include", False)):
-                    continue
-                if str(r.get("scenario", SCENARIOS[0])) != scen:
-                    continue
-                si = float(r.get("sum_forsikring", 0) or 0)
-                try:
-                    rate = calc_eml_rate_effective(r)
-                except Exception as e:
-                    rate = 0.0
-                rows_tot.append({"SI": si, "EML": int(round(si * rate))})
-
-            dft = pd.DataFrame(rows_tot)
-            if not dft.empty:
-                total_si = int(dft["SI"].sum())
-                total_eml = int(dft["EML"].sum())
-                st.metric("Sum SI i kumulesone", f"{total_si:,.0f}".replace(",", " "))
-                st.metric("Sum EML i kumulesone", f"{total_eml:,.0f}".replace(",", " "))
+            with shared.lock:
+                cell = acc.cell(str(sel_kumule), scen)
+            if cell["n_inc"]:
+                st.metric("Sum SI i kumulesone", f"{int(cell['si_inc']):,.0f}".replace(",", " "))
+                st.metric("Sum EML i kumulesone", f"{int(cell['eml_inc']):,.0f}".replace(",", " "))
+
+            # ---------- Halerisiko (Monte Carlo) ----------
+            if db_items and st.toggle("Halerisiko (Monte Carlo)", value=False, key="mc_on",
+                                      help="Simulert tap for sonen når skadegraden varierer rundt EML-satsen"):
+                m1, m2 = st.columns(2)
+                mc_events = int(m1.number_input("Hendelser", min_value=1_000, max_value=200_000,
+                                                value=DEFAULT_EVENTS, step=1_000, key="mc_events"))
+                mc_seed = int(m2.number_input("Frø", min_value=0, value=DEFAULT_SEED, step=1, key="mc_seed"))
+                with trace.span("Monte Carlo", len(db_items) * mc_events):
+                    mc = mc_cache().get(
+                        str(sel_kumule), scen, [k for k, _ in db_items],
+                        [float(r.get("sum_forsikring", 0) or 0) for _, r in db_items],
+                        batch["rate_effective"], n_events=mc_events, seed=mc_seed,
+                    )
+                level_txt = f"{TAIL_LEVEL * 100:.1f}".replace(".", ",")
+                t1, t2, t3 = st.columns(3)
+                t1.metric("Forventet tap", _fmt_int(round(mc["mean"])))
+                t2.metric(f"VaR {level_txt} %", _fmt_int(round(mc["var"])))
+                t3.metric(f"TVaR {level_txt} %", _fmt_int(round(mc["tvar"])),
+                          help="Snitt av tapene i de verste hendelsene (fra og med VaR)")
+                st.caption(f"{_fmt_int(mc['events'])} hendelser, frø {mc['seed']}, {mc['n']} risikoer – "
+                           f"deterministisk EML {_fmt_int(round(mc['eml']))} ({mc['seconds']:.2f} s).")
 
         except Exception as e:
             st.error("Klarte ikke å beregne/oppdatere scenario.")
             st.exception(e)   # viser full traceback
             st.stop()
 
+# ----------------------------------------------------------
+# 🧮 WHAT-IF – EML for alle kumulesoner × scenarioer med egne parametre
+# ----------------------------------------------------------
+def _parse_table(text: str) -> tuple:
+    return tuple(float(x.strip().replace(",", ".")) for x in text.split(";") if x.strip())
+
+
+with tab_whatif:
+    st.subheader("What-if: EML per kumulesone og scenario")
+    st.caption("Endre modellparametrene og se effekten på alle kumulesoner samtidig. "
+               "Manuelle satser beholdes; bare maskinsatsen påvirkes. Ingenting lagres.")
+
+    with trace.span("what-if (forbered)", len(db)):
+        wm = whatif_matrix(STORAGE_BACKEND, DB_FILENAME, shared.generation)
+
+    c_base, c_inc = st.columns([1, 1])
+    wi_base = c_base.number_input("BASE", min_value=0.0, max_value=2.0, value=float(BASE), step=0.05,
+                                  format="%.3f", key="wi_base")
+    wi_only_inc = c_inc.toggle("Bare inkluderte risikoer", value=True, key="wi_only_inc")
+    tcols = st.columns(4)
+    wi_tables = {}
+    for col, (name, default) in zip(tcols, [("ALPHA", ALPHA), ("BETA", BETA), ("GAMMA", GAMMA), ("EXPO", EXPO)]):
+        wi_tables[name] = col.text_input(name, value="; ".join(f"{x:g}" for x in default),
+                                         key=f"wi_{name.lower()}", help="Fire verdier, skilt med semikolon")
+    try:
+        wi_params = EmlParams(wi_base, *(_parse_table(wi_tables[n]) for n in ("ALPHA", "BETA", "GAMMA", "EXPO"))).validated()
+    except ValueError as e:
+        st.error(f"Ugyldige parametre: {e}")
+        wi_params = None
+
+    if wi_params is not None and wm.zones:
+        with trace.span("what-if (matrise)", wm.n):
+            mat = wm.frame(wi_params, wi_only_inc)
+        show_delta = wi_params != DEFAULT_PARAMS and st.toggle(
+            "Vis endring mot standardparametre", value=False, key="wi_delta")
+        if show_delta:
+            mat = mat - wm.frame(DEFAULT_PARAMS, wi_only_inc)
+        st.dataframe(mat, column_config={
+            c: st.column_config.NumberColumn(c, format="localized") for c in mat.columns})
+        tot = int(mat["Totalt"].sum())
+        st.metric("Sum EML alle kumulesoner" + (" (endring)" if show_delta else ""), _fmt_int(tot))
+
+        st.markdown("**Sveip av BASE**")
+        s1, s2, s3, s4 = st.columns(4)
+        sw_from = s1.number_input("Fra", min_value=0.0, max_value=2.0, value=0.4, step=0.05, key="wi_sw_from")
+        sw_to = s2.number_input("Til", min_value=0.0, max_value=2.0, value=0.8, step=0.05, key="wi_sw_to")
+        sw_steps = s3.number_input("Steg", min_value=2, max_value=100, value=20, step=1, key="wi_sw_steps")
+        sw_scen = s4.selectbox("Scenario", ["Alle"] + wm.scenarios, key="wi_sw_scen")
+        sets = base_sweep(sw_from, sw_to, int(sw_steps), wi_params)
+        with trace.span("what-if (sveip)", len(sets)):
+            sweep = wm.zone_sweep(sets, [p.base for p in sets],
+                                  scenario=None if sw_scen == "Alle" else sw_scen, only_included=wi_only_inc)
+        movement = (sweep.max(axis=1) - sweep.min(axis=1)).sort_values(ascending=False)
+        top = movement.index[:10]
+        st.line_chart(sweep.loc[top].T.rename_axis("BASE"))
+        st.dataframe(
+            pd.DataFrame({"EML ved fra": sweep.iloc[:, 0], "EML ved til": sweep.iloc[:, -1],
+                          "Bevegelse (maks − min)": movement}).loc[movement.index],
+        )
+        ci = wm.cache_info()
+        st.caption(f"{wm.n} risikoer, {len(wm.zones)} kumulesoner – "
+                   f"{ci['parametersett']}/{ci['maks']} parametersett i cache")
+    elif wi_params is not None:
+        st.info("Ingen kumulesoner i databasen ennå.")
+
+# ----------------------------------------------------------
+# 🗺️ SIRKELSØK – verste plassering av en sirkel med radius R
+# ----------------------------------------------------------
+with tab_geo:
+    st.subheader("Verste sirkel: størst sum EML innenfor radius")
+    with trace.span("romlig indeks", len(db)):
+        geo = spatial_index(STORAGE_BACKEND, DB_FILENAME, shared.generation)
+    st.caption(f"{geo.n} av {geo.n_total} risikoer har koordinater.")
+    if not geo.n:
+        st.info("Ingen risikoer har koordinater ennå. Fyll ut Breddegrad/Lengdegrad i Excel-uttrekket "
+                "eller i skjemaet for manuell registrering.")
+    else:
+        g1, g2, g3, g4 = st.columns(4)
+        geo_radius = g1.number_input("Radius (m)", min_value=10, max_value=50_000, value=200, step=50,
+                                     key="geo_radius", help="F.eks. 200 m brannspredning, 1000 m flom")
+        geo_scen = g2.selectbox("Scenario", ["Alle"] + SCENARIOS, key="geo_scen")
+        geo_count = g3.number_input("Antall sirkler", min_value=1, max_value=5, value=1, step=1, key="geo_count",
+                                    help="Flere sirkler uten felles risikoer, i synkende rekkefølge")
+        geo_only_inc = g4.toggle("Bare inkluderte", value=True, key="geo_only_inc")
+        if st.button("Finn verste sirkel", key="geo_run"):
+            st.session_state.geo_search = (float(geo_radius), None if geo_scen == "Alle" else geo_scen,
+                                           int(geo_count), bool(geo_only_inc))
+        search_args = st.session_state.get("geo_search")
+        if search_args is not None:
+            with trace.span("sirkelsøk", geo.n):
+                circles = geo.worst_circles(search_args[0], search_args[2], scenario=search_args[1],
+                                            only_included=search_args[3])
+            if not circles:
+                st.info("Ingen risikoer med EML og koordinater i utvalget.")
+            for i, c in enumerate(circles, start=1):
+                st.markdown(f"**Sirkel {i}** – senter {c['lat']:.6f}, {c['lon']:.6f} (radius {c['radius_m']:.0f} m)")
+                m1, m2, m3 = st.columns(3)
+                m1.metric("Sum EML", _fmt_int(c["eml"]))
+                m2.metric("Risikoer", c["n"])
+                m3.metric("Kumulesoner", c["members"]["Kumulesone"].nunique())
+                if c["exact"]:
+                    st.caption(f"Eksakt maksimum ({c['cubes']} søkeceller, {c['seconds']:.2f} s).")
+                else:
+                    st.caption(f"Beste plassering funnet innen tidsgrensen; ingen plassering gir mer enn "
+                               f"{_fmt_int(c['upper_bound'])} ({c['seconds']:.2f} s).")
+                members = c["members"]
+                st.map(pd.concat([members[["latitude", "longitude"]],
+                                  pd.DataFrame({"latitude": [c["lat"]], "longitude": [c["lon"]]})]), zoom=13)
+                st.dataframe(members.drop(columns=["latitude", "longitude"]).head(500), hide_index=True)
+
+# ----------------------------------------------------------
+# 🕰️ VERSJONER – lagrede versjoner av databasen og endring i akkumuleringen mellom dem
+# ----------------------------------------------------------
+NOW_LABEL = "Nå (gjeldende database)"
+
+with tab_ver:
+    st.subheader("Versjoner og endring i akkumulering")
+    snaps = snapshot_store(SNAPSHOT_DIR)
+    v1, v2 = st.columns([3, 1])
+    ver_label = v1.text_input("Etikett", value="", key="ver_label", placeholder="F.eks. «Før fornyelse 1.1.»")
+    v2.write("")
+    if v2.button("💾 Lagre versjon nå", key="ver_save"):
+        with trace.span("lagre versjon", len(db)):
+            info = save_version(SNAPSHOT_DIR, STORAGE_BACKEND, DB_FILENAME, ver_label.strip())
+        st.success(f"Versjon {info['id']} lagret ({info['n_records']} risikoer, "
+                   f"{info['new_objects']} nye objekter, {_fmt_int(info['new_bytes'])} bytes).")
+
+    versions, usage = version_listing(SNAPSHOT_DIR, shared.generation, snaps.revision)
+    if not versions:
+        st.info("Ingen versjoner lagret ennå. Versjoner lagres ved hver import som endrer noe, eller med knappen over.")
+    else:
+        st.dataframe(
+            pd.DataFrame({
+                "Versjon": [v["id"] for v in versions],
+                "Lagret (UTC)": [v["created"] for v in versions],
+                "Etikett": [v["label"] for v in versions],
+                "Risikoer": [v["n_records"] for v in versions],
+                "Nye bytes": [v["new_bytes"] for v in versions],
+            }).iloc[::-1],
+            hide_index=True,
+        )
+        names = {v["id"]: f"{v['id']} – {v['created']}" + (f" – {v['label']}" if v["label"] else "")
+                 for v in versions}
+        ids = list(names)
+        f1, f2, f3 = st.columns([2, 2, 1])
+        ver_from = f1.selectbox("Fra", ids[::-1], index=min(1, len(ids) - 1), format_func=names.get, key="ver_from")
+        ver_to = f2.selectbox("Til", [NOW_LABEL] + ids[::-1], index=0,
+                              format_func=lambda v: names.get(v, v), key="ver_to")
+        ver_top = int(f3.number_input("Antall", min_value=1, max_value=100, value=10, step=1, key="ver_top"))
+        to_id = None if ver_to == NOW_LABEL else ver_to
+        with trace.span("versjonsdiff"):
+            d = version_diff(SNAPSHOT_DIR, ver_from, to_id, STORAGE_BACKEND, DB_FILENAME,
+                             shared.generation if to_id is None else 0)
+        st.caption(f"{d['added']} nye, {d['modified']} endrede og {d['removed']} fjernede risikoer.")
+
+        def diff_frame(cells) -> pd.DataFrame:
+            return pd.DataFrame({
+                "Kumulesone": [c["kumulesone"] for c in cells],
+                "Scenario": [c["scenario"] for c in cells],
+                "ΔEML inkl.": [c["d_eml_inc"] for c in cells],
+                "ΔSI inkl.": [round(c["d_si_inc"]) for c in cells],
+                "ΔSI": [round(c["d_si"]) for c in cells],
+                "ΔAntall inkl.": [c["d_n_inc"] for c in cells],
+                "Endrede risikoer": [c["changed"] for c in cells],
+            })
+
+        if not d["cells"]:
+            st.info("Ingen endring i akkumuleringen mellom de valgte versjonene.")
+        else:
+            st.markdown("**Største endringer (ΔEML for inkluderte)**")
+            st.dataframe(diff_frame(top_movers(d["cells"], ver_top)), hide_index=True)
+            with st.expander(f"Alle berørte kumulesoner × scenarioer ({len(d['cells'])})", expanded=False):
+                st.dataframe(diff_frame(top_movers(d["cells"], len(d["cells"]))), hide_index=True)
+        st.caption(f"Lager: {usage['versions']} versjoner, {usage['objects']} objekter, "
+                   f"{_fmt_int(usage['bytes'])} bytes på disk.")
+
     # ---------- Skjema: Legg til risiko manuelt ----------
    # ---------- Skjema: Legg til risiko manuelt (lagrer på toppnivå i db) ----------
 import uuid
@@ -561,8 +1084,10 @@ with st.form("manual_add_form"):
     scenario_valg = st.selectbox("Scenario (scenario)", SCENARIOS, index=SCENARIOS.index(scen) if scen in SCENARIOS else 0)
 
     # Valgfritt – geokoordinater og fritekst
-    latitude = st.number_input("Latitude (valgfritt)", value=0.0, step=0.0001)
-    longitude = st.number_input("Longitude (valgfritt)", value=0.0, step=0.0001)
+    latitude = st.number_input("Latitude (valgfritt)", value=0.0, min_value=-90.0, max_value=90.0,
+                               step=0.0001, format="%.6f")
+    longitude = st.number_input("Longitude (valgfritt)", value=0.0, min_value=-180.0, max_value=180.0,
+                                step=0.0001, format="%.6f")
     beskrivelse = st.text_area("Beskrivelse (valgfritt)", value="")
 
     # EML-metadata (nye felt i databasen)
@@ -592,8 +1117,6 @@ with st.form("manual_add_form"):
             "include": bool(include),           # matcher visningen
 
             # Valgfritt / ekstra
-            #"latitude": latitude,
-            #"longitude": longitude,
             "beskrivelse": beskrivelse,
 
             # EML-metadata (nye felt i databasen)
@@ -608,17 +1131,52 @@ with st.form("manual_add_form"):
             "kilde": "manuell",
             "updated": now_iso(),
         }
+        # 0/0 betyr at koordinater ikke er oppgitt
+        if latitude or longitude:
+            rec["latitude"], rec["longitude"] = float(latitude), float(longitude)
 
         # Sørg for at db er et dict og ikke inneholder colliding keys
-        if not isinstance(db, dict):
-            st.error("DB er korrupt (forventet dict).")
+        if not isinstance(db, Mapping):
+            st.error("DB er korrupt (forventet mapping).")
         else:
-            db[key] = rec  # <- Lagrer på toppnivå slik visningen leser
-            # (valgfritt) hold på en speilliste for eksport/import:
-            if "risikoer" not in db or not isinstance(db["risikoer"], list):
-                db["risikoer"] = []
-            db["risikoer"].append({**rec, "_key": key})
-
-            save_db_to_file(DB_FILENAME, db)
-            st.success(f"La til risiko {forsnr}/{risikonr} i '{kumulesone}' (key={key}).")
-            st.rerun()
+            # Lagres på toppnivå slik visningen leser (den gamle risikoer-listen lages bare ved eksport)
+            if save_changes({key: rec}, replace=True, check=False):
+                st.success(f"La til risiko {forsnr}/{risikonr} i '{kumulesone}' (key={key}).")
+                st.rerun()
+
+# ==========================================================
+# Tidtaking – fyll inn tabellen i sidepanelet
+# ==========================================================
+if clock["first_render"] is None:
+    clock["first_render"] = time.perf_counter() - clock["t0"]
+ls = shared.load_stats
+startup_slot.caption(
+    f"🚀 Første visning etter oppstart: {clock['first_render']:.1f} s – database {ls['load_s']:.1f} s fra "
+    + (f"kolonnefil (+{ls['journal_entries']} journalposter)" if ls["source"] == "kolonnefil"
+       else STORAGE_BACKEND.replace("json", "JSON").replace("sqlite", "SQLite"))
+    + f", indekser {ls['index_s']:.1f} s"
+)
+profile = trace.finish()
+if profile is not None:
+    st.session_state["perf_last_profile"] = profile
+last_profile = st.session_state.get("perf_last_profile")
+if last_profile is not None:
+    with prof_slot.container():
+        st.download_button(
+            f"⬇️ Last ned profil ({last_profile['total_ms']:.0f} ms)",
+            data=last_profile["prof"],
+            file_name="eml_rerun.prof",
+            mime="application/octet-stream",
+        )
+        st.code(last_profile["text"][:20000], language=None)
+if trace.enabled:
+    with perf_slot.container():
+        st.caption(
+            f"Kjøring: {trace.total_ms:.0f} ms | {len(db)} objekter i databasen | "
+            f"Streamlit {st.__version__} | {Path(__file__).name}"
+        )
+        st.dataframe(
+            pd.DataFrame(trace.rows(), columns=["span", "ms", "antall"]).astype({"antall": "Int64"}),
+            hide_index=True,
+            column_config={"ms": st.column_config.NumberColumn(format="%.1f")},
+        )
@@ -0,0 +1,121 @@
+"""Syntetiske porteføljer for benchmark og lasttesting.
+
+Lager databaser i samme form som appen bruker (toppnivå-dict per risiko +
+sonetabellen ``kumuler``, skjema 2 i ``schema.py``) med skjeve kumulesone-størrelser, norske
+adresser og kundenavn, en andel manuelle overstyringer og tilfeldige
+risikofaktorer. Kan også skrive samme portefølje som Excel-uttrekk.
+"""
+import math
+import random
+from typing import Any, Dict, Optional
+
+from eml_engine import SCENARIOS
+from schema import SCHEMA_KEY, SCHEMA_VERSION
+
+GATER = ["Storgata", "Kirkegata", "Industriveien", "Sjøgata", "Fjordveien", "Skolegata", "Bøgata",
+         "Østre Strandgate", "Åsveien", "Kongens gate", "Dronningens gate", "Havnegata", "Ringveien",
+         "Tømmerveien", "Ødegårdsveien", "Ærfuglveien"]
+STEDER = [("3125", "Tønsberg"), ("3210", "Sandefjord"), ("0150", "Oslo"), ("5003", "Bergen"),
+          ("7011", "Trondheim"), ("4006", "Stavanger"), ("6002", "Ålesund"), ("9008", "Tromsø"),
+          ("8006", "Bodø"), ("2317", "Hamar"), ("1606", "Fredrikstad"), ("3611", "Kongsberg")]
+# Sentrum (breddegrad, lengdegrad) for stedene over
+KOORDINATER = [(59.267, 10.408), (59.131, 10.217), (59.913, 10.739), (60.391, 5.322),
+               (63.430, 10.395), (58.970, 5.733), (62.472, 6.150), (69.649, 18.956),
+               (67.280, 14.405), (60.795, 11.068), (59.218, 10.930), (59.668, 9.650)]
+FORNAVN = ["Ola", "Kari", "Petter", "Åse", "Bjørn", "Sølvi", "Ærle", "Øystein", "Håkon", "Ingrid"]
+ETTERNAVN = ["Hansen", "Johansen", "Olsen", "Larsen", "Bø", "Ås", "Sæther", "Løvås", "Strøm", "Dæhli"]
+FIRMA = ["Mek. Verksted", "Trelast", "Fiskeindustri", "Bygg", "Eiendom", "Transport", "Næringsmiddel"]
+
+
+def zone_name(i: int) -> str:
+    sted = STEDER[i % len(STEDER)][1]
+    return f"{sted} {i // len(STEDER) + 1:03d}"
+
+
+def generate_portfolio(
+    n: int,
+    n_zones: Optional[int] = None,
+    seed: int = 0,
+    include_share: float = 0.6,
+    override_share: float = 0.05,
+    skew: float = 1.1,
+    with_mirror: bool = False,
+    geo_share: float = 0.9,
+    geo_spread_m: float = 3000.0,
+) -> Dict[str, Any]:
+    """Portefølje med ``n`` risikoer.
+
+    Kumulesone-størrelsene følger en Zipf-lignende fordeling (``skew``), slik at
+    noen få soner er store og de fleste små. En andel ``geo_share`` får koordinater
+    spredt normalfordelt (``geo_spread_m``) rundt sentrum av stedet. ``with_mirror``
+    gir den gamle formen (skjema 1) med alle risikoene også i ``risikoer``-listen.
+    """
+    rng = random.Random(seed)
+    # Egen generator, så resten av porteføljen er lik med og uten koordinater
+    geo = random.Random(seed + 1)
+    n_zones = n_zones or max(1, n // 200)
+    weights = [1.0 / (i + 1) ** skew for i in range(n_zones)]
+    zones = rng.choices(range(n_zones), weights=weights, k=n)
+
+    db: Dict[str, Any] = {"kumuler": [{"id": z, "navn": z} for z in sorted(map(zone_name, range(n_zones)))]}
+    if with_mirror:
+        db["risikoer"] = []
+    else:
+        db[SCHEMA_KEY] = SCHEMA_VERSION
+    for i, z in enumerate(zones):
+        kumule = zone_name(z)
+        postnr, kommune = STEDER[z % len(STEDER)]
+        adresse = f"{rng.choice(GATER)} {rng.randint(1, 250)}"
+        if rng.random() < 0.7:
+            kunde = f"{rng.choice(ETTERNAVN)} {rng.choice(FIRMA)} AS"
+        else:
+            kunde = f"{rng.choice(FORNAVN)} {rng.choice(ETTERNAVN)}"
+        manual = rng.random() < override_share
+        rec = {
+            "kumulesone": kumule,
+            "risikonr": f"R{i:07d}",
+            "forsnr": str(10_000_000 + i // 3),
+            "adresse": adresse,
+            "postnummer": postnr,
+            "kommune": kommune,
+            "kundenavn": kunde,
+            "sum_forsikring": float(round(rng.lognormvariate(16.0, 1.2), -3)),
+            "brannrisiko": rng.randrange(4),
+            "begrensende_faktorer": rng.randrange(4),
+            "deteksjon_beskyttelse": rng.randrange(4),
+            "eksponering_nabo": rng.randrange(4),
+            "eml_rate_manual_on": manual,
+            "eml_rate_manual": round(rng.uniform(0.05, 0.9), 3) if manual else 0.0,
+            "include": rng.random() < include_share,
+            "scenario": rng.choice(SCENARIOS),
+            "updated": "2024-01-01T00:00:00Z",
+        }
+        if geo.random() < geo_share:
+            lat0, lon0 = KOORDINATER[z % len(KOORDINATER)]
+            rec["latitude"] = round(lat0 + geo.gauss(0, geo_spread_m) / 111_320, 6)
+            rec["longitude"] = round(lon0 + geo.gauss(0, geo_spread_m) / (111_320 * math.cos(math.radians(lat0))), 6)
+        key = f"{kumule}-{rec['risikonr']}-{adresse}"
+        db[key] = rec
+        if with_mirror:
+            db["risikoer"].append({**rec, "_key": key})
+    return db
+
+
+def write_portfolio_xlsx(path: str, db: Dict[str, Any]) -> int:
+    """Skriv porteføljen som Excel-uttrekk med ``EXPECTED_COLS`` (openpyxl write-only)."""
+    from openpyxl import Workbook
+
+    from excel_import import EXPECTED_COLS
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Uttrekk")
+    ws.append([EXPECTED_COLS[k] for k in ("kumulenr", "risikonr", "forsnr", "adresse", "kundenavn", "tariffsum",
+                                          "latitude", "longitude")])
+    n = 0
+    for r in db.values():
+        if isinstance(r, dict):
+            ws.append([r["kumulesone"], r["risikonr"], r["forsnr"], r["adresse"], r["kundenavn"], r["sum_forsikring"],
+                       r.get("latitude"), r.get("longitude")])
+            n += 1
+    wb.save(path)
+    return n
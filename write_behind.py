@@ -0,0 +1,130 @@
+"""Samlet lagring i bakgrunnen (write-behind).
+
+``WriteBehind.mark`` registrerer endrede nøkler (siste verdi vinner, ``None`` =
+slettet) og returnerer med en gang. En bakgrunnstråd venter til det har vært
+stille i ``delay`` sekunder (men aldri lenger enn ``max_delay`` etter første
+ulagrede endring) og gir alt som er samlet opp til ``write`` i ett kall
+(journal-append/SQLite-transaksjon, eller hele snapshotet i snapshot-modus).
+Raske klikk på "Velg ALLE" blir dermed én skriving i stedet for mange.
+
+Feiler skrivingen beholdes endringene (nyere verdier går foran) og prøves igjen.
+``flush`` skriver synkront; den kalles også ved normal avslutning av prosessen
+(``atexit``), så ingen bekreftet endring går tapt når prosessen avsluttes pent.
+"""
+import atexit
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+DEFAULT_DELAY = 0.3
+DEFAULT_MAX_DELAY = 2.0
+RETRY_DELAY = 2.0
+
+
+class WriteBehind:
+    def __init__(self, write: Callable[[Dict[str, Any]], None],
+                 delay: float = DEFAULT_DELAY, max_delay: float = DEFAULT_MAX_DELAY):
+        # write(batch): nøkkel -> ny verdi (None = slettet), skrives i én operasjon
+        self.write = write
+        self.delay = delay
+        self.max_delay = max_delay
+        self.saved_at: Optional[datetime] = None
+        self.last_error: Optional[Exception] = None
+        self.writes = 0
+        self._dirty: Dict[str, Any] = {}
+        self._inflight = 0
+        self._first_dirty = 0.0
+        self._last_mark = 0.0
+        self._cond = threading.Condition()
+        # Holdes under selve skrivingen, så flush() og bakgrunnstråden aldri skriver samtidig
+        self._io_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        atexit.register(self.close)
+
+    # ---------- status ----------
+    def pending(self) -> int:
+        """Antall nøkler som ikke er skrevet ennå (inkludert en skriving som pågår)."""
+        with self._cond:
+            return len(self._dirty) + self._inflight
+
+    def status(self) -> Dict[str, Any]:
+        with self._cond:
+            return {"pending": len(self._dirty) + self._inflight, "saved_at": self.saved_at,
+                    "error": self.last_error, "writes": self.writes}
+
+    # ---------- registrering ----------
+    def mark(self, changes: Dict[str, Any]) -> None:
+        """Registrer endringer (nøkkel -> ny verdi, ``None`` = slettet) for skriving."""
+        if not changes:
+            return
+        with self._cond:
+            now = time.monotonic()
+            if not self._dirty:
+                self._first_dirty = now
+            self._last_mark = now
+            self._dirty.update(changes)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="eml-write-behind", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    # ---------- skriving ----------
+    def flush(self) -> bool:
+        """Skriv alt som venter nå. Returnerer False hvis skrivingen feilet."""
+        try:
+            self._flush_once()
+            return True
+        except Exception:
+            return False
+
+    def close(self) -> None:
+        """Skriv det som venter og stopp bakgrunnstråden (kalles ved avslutning)."""
+        if not self.flush():
+            print(f"EML: {self.pending()} endringer kunne ikke lagres: {self.last_error}", file=sys.stderr)
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _flush_once(self) -> None:
+        with self._io_lock:
+            with self._cond:
+                batch, self._dirty = self._dirty, {}
+                self._inflight = len(batch)
+            if not batch:
+                return
+            try:
+                self.write(batch)
+            except Exception as e:
+                with self._cond:
+                    # Nyere endringer (registrert under skrivingen) går foran de som feilet
+                    self._dirty = {**batch, **self._dirty}
+                    self._inflight = 0
+                    self.last_error = e
+                raise
+            with self._cond:
+                self._inflight = 0
+                self.saved_at = datetime.now()
+                self.last_error = None
+                self.writes += 1
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._dirty and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                # Vent til det har vært stille i delay sekunder (høyst max_delay totalt)
+                while True:
+                    now = time.monotonic()
+                    due = min(self._last_mark + self.delay, self._first_dirty + self.max_delay)
+                    if now >= due or self._closed:
+                        break
+                    self._cond.wait(due - now)
+            try:
+                self._flush_once()
+            except Exception:
+                time.sleep(RETRY_DELAY)